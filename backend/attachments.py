@@ -0,0 +1,260 @@
+# d:\Users\onisi\Documents\web-app-dev\backend\attachments.py
+"""
+チャットの添付ファイル参照。
+
+画像や文書はアップロードストアに保存され、その SHA-256 を添付 ID とする。
+メッセージには {"type": "attachment", "attachment_id": ID} だけを載せ、
+上流へのリクエストを組み立てる直前に画像の data URL やテキストへ展開する。
+展開結果は LRU キャッシュに保持し、長い会話で同じ添付を何度も読み直さない。
+retrieval_min_chars を超える長い文書は全文を載せず、BM25 インデックスから
+現在の質問に関連するチャンクだけを取り出して載せる (プロンプトの大きさを文書の長さに依存させない)。
+CSV / JSON などの表形式ファイルは既定でサマリーを載せ、パートに rows: [開始, 終了) を指定した場合はその範囲の行を載せる。
+長いソースコードはシグネチャのアウトラインを載せ、symbols で指定したシンボルや質問に現れたシンボルだけ本体を載せる。
+"""
+import uuid
+import base64
+import logging
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+import aiofiles
+
+from upload_store import UploadStore
+from rate_limiter import estimate_text_tokens
+from bm25_index import BM25Index
+from document_extractor import DocumentExtractor, is_text_content_type
+from table_summary import TableSummarizer, render_rows, render_summary
+from code_outline import CodeOutliner, find_symbols, render_outline, render_symbols, symbols_in_query
+
+logger = logging.getLogger(__name__)
+
+ATTACHMENT_PART_TYPE = "attachment"
+# 展開時に付けるファイル名などの見出し分
+ESTIMATED_HEADER_TOKENS = 32
+
+
+class AttachmentNotFoundError(KeyError):
+    """ 添付 ID に対応するファイルがアップロードストアに無い場合に送出される。 """
+
+    def __init__(self, attachment_id: str):
+        super().__init__(attachment_id)
+        self.attachment_id = attachment_id
+
+
+class AttachmentRegistry:
+    """ アップロードストアのファイルを添付 ID で参照し、上流用のメッセージパートに展開する。 """
+
+    def __init__(
+        self,
+        store: UploadStore,
+        extractor: Optional[DocumentExtractor] = None,
+        max_text_chars: int = 20000,
+        cache_entries: int = 64,
+        retriever: Optional[BM25Index] = None,
+        retrieval_min_chars: int = 8000,
+        retrieval_top_k: int = 5,
+        summarizer: Optional[TableSummarizer] = None,
+        outliner: Optional[CodeOutliner] = None,
+        outline_min_chars: int = 6000,
+        max_expanded_chars: int = 12000,
+    ):
+        self.store = store
+        self.extractor = extractor
+        self.max_text_chars = max_text_chars
+        self.cache_entries = cache_entries
+        self.retriever = retriever
+        self.retrieval_min_chars = retrieval_min_chars
+        self.retrieval_top_k = retrieval_top_k
+        self.summarizer = summarizer
+        self.outliner = outliner
+        self.outline_min_chars = outline_min_chars
+        self.max_expanded_chars = max_expanded_chars
+        self._expanded: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.retrievals = 0
+
+    async def register_bytes(self, sha256: str, data: bytes, filename: str, content_type: Optional[str]) -> Dict[str, Any]:
+        """ メモリ上のデータをストアに登録し (登録済みなら既存のエントリを使い)、索引エントリを返す。 """
+        entry = self.store.get(sha256)
+        if entry is not None:
+            self.store.record_hit()
+            return entry
+        temp_path = self.store.root / f".attachment-{uuid.uuid4().hex}.part"
+        async with aiofiles.open(temp_path, "wb") as f:
+            await f.write(data)
+        return await self.store.put(sha256, temp_path, filename, content_type, len(data))
+
+    async def _load_text(self, entry: Dict[str, Any]) -> Optional[str]:
+        """ 抽出済み (または抽出した) テキストを返す。抽出器が無い場合は max_text_chars を少し超える分だけ読む。 """
+        if self.extractor is not None:
+            return await self.extractor.extract(entry)
+        if is_text_content_type(entry.get("content_type")):
+            async with aiofiles.open(entry["path"], "r", encoding="utf-8", errors="replace") as f:
+                return await f.read(self.max_text_chars + 1)
+        return None
+
+    def _truncate(self, text: str) -> str:
+        if len(text) > self.max_text_chars:
+            return text[:self.max_text_chars] + "\n[... 以降は省略されました]"
+        return text
+
+    async def _retrieve(self, entry: Dict[str, Any], text: str, query: str) -> Optional[Dict[str, Any]]:
+        """ 文書から query に関連するチャンクを取り出したパートを返す。関連するチャンクが無ければ None。 """
+        if entry["sha256"] not in self.retriever:
+            # アップロード時の登録前に呼ばれた場合や、インデックスから追い出された文書はここで登録する
+            await self.retriever.add_text(entry["sha256"], text)
+        hits = self.retriever.search(query, doc_ids=[entry["sha256"]], top_k=self.retrieval_top_k)
+        if not hits:
+            return None
+        self.retrievals += 1
+        excerpts = "\n\n[...]\n\n".join(hit.text for hit in sorted(hits, key=lambda hit: hit.chunk_index))
+        header = f"[添付ファイル: {entry['filename']} (全 {len(text)} 文字のうち質問に関連する {len(hits)} 箇所の抜粋)]"
+        return {"type": "text", "text": f"\n{header}\n{excerpts}"}
+
+    async def _expand_table(self, entry: Dict[str, Any], rows: Optional[Tuple[int, int]]) -> Optional[Tuple[Dict[str, Any], bool]]:
+        """ 表形式ファイルをサマリー (または指定範囲の行) に展開する。表として扱えない場合は None。 """
+        summary = await self.summarizer.summarize(entry)
+        if summary is None:
+            return None
+        if rows is None:
+            return {"type": "text", "text": "\n" + render_summary(summary, entry["filename"])}, True
+        start, end = rows
+        records = await self.summarizer.rows(entry, start, end)
+        return {"type": "text", "text": "\n" + render_rows(records, max(0, start), summary["rows"], entry["filename"])}, False
+
+    async def _expand_code(self, entry: Dict[str, Any], source: str, query: Optional[str], symbols: Optional[List[str]]) -> Optional[Dict[str, Any]]:
+        """ ソースコードをアウトライン (と指定・質問に現れたシンボルの本体) に展開する。解析できない場合は None。 """
+        outline = await self.outliner.outline(entry)
+        if outline is None:
+            return None
+        text = render_outline(outline, entry["filename"])
+        names = list(symbols or []) + (symbols_in_query(outline, query) if query else [])
+        if names:
+            selected = find_symbols(outline, dict.fromkeys(names))
+            self.outliner.expanded_symbols += len(selected)
+            if selected:
+                text += "\n\n" + render_symbols(source, selected, outline["language"], self.max_expanded_chars)
+            missing = [name for name in symbols or [] if not find_symbols(outline, [name])]
+            if missing:
+                text += f"\n\n[シンボルが見つかりません: {', '.join(missing)}]"
+        return {"type": "text", "text": "\n" + text}
+
+    async def _expand(
+        self,
+        entry: Dict[str, Any],
+        query: Optional[str] = None,
+        rows: Optional[Tuple[int, int]] = None,
+        symbols: Optional[List[str]] = None,
+    ) -> Tuple[Dict[str, Any], bool]:
+        """ (展開したパート, キャッシュしてよいか) を返す。 """
+        content_type = entry.get("content_type") or ""
+        path = Path(entry["path"])
+        if content_type.startswith("image/"):
+            async with aiofiles.open(path, "rb") as f:
+                data = await f.read()
+            data_url = f"data:{content_type};base64,{base64.b64encode(data).decode('ascii')}"
+            return {"type": "image_url", "image_url": {"url": data_url}}, True
+        if self.summarizer is not None and self.summarizer.supports(content_type):
+            expanded = await self._expand_table(entry, rows)
+            if expanded is not None:
+                return expanded
+        text = await self._load_text(entry)
+        if text is not None and self.outliner is not None and self.outliner.supports(content_type) and len(text) > self.outline_min_chars:
+            # 展開するシンボルは質問ごとに変わるためキャッシュしない (アウトライン自体はファイルの隣にキャッシュされる)
+            part = await self._expand_code(entry, text, query, symbols)
+            if part is not None:
+                return part, False
+        if text is not None:
+            # 長い文書の展開結果は質問ごとに変わるため、抜粋も切り詰めた全文もキャッシュしない
+            retrievable = self.retriever is not None and len(text) > self.retrieval_min_chars
+            if retrievable and query:
+                part = await self._retrieve(entry, text, query)
+                if part is not None:
+                    return part, False
+            return {"type": "text", "text": f"\n[添付ファイル: {entry['filename']}]\n{self._truncate(text)}"}, not retrievable
+        # 内容をテキスト化できない形式はファイル名と Groq の file id だけを伝える
+        # (file id は後から付くことがあるためキャッシュしない)
+        reference = f"Groq File ID: {entry['groq_file_id']}" if entry.get("groq_file_id") else content_type
+        return {"type": "text", "text": f"\n[添付ファイル: {entry['filename']} ({reference})]"}, False
+
+    async def expand_part(
+        self,
+        attachment_id: str,
+        query: Optional[str] = None,
+        rows: Optional[Tuple[int, int]] = None,
+        symbols: Optional[List[str]] = None,
+    ) -> Dict[str, Any]:
+        """
+        添付 ID を上流用のメッセージパート (image_url または text) に展開する。
+        query は長い文書の抜粋に、rows は表形式ファイルから取り出す行の範囲に、symbols はソースコードから本体を展開するシンボルに使う。
+        """
+        cached = self._expanded.get(attachment_id) if rows is None and not symbols else None
+        if cached is not None:
+            self._expanded.move_to_end(attachment_id)
+            self.hits += 1
+            return cached
+
+        entry = self.store.get(attachment_id)
+        if entry is None:
+            raise AttachmentNotFoundError(attachment_id)
+        self.misses += 1
+        part, cacheable = await self._expand(entry, query, rows, symbols)
+        if cacheable:
+            self._expanded[attachment_id] = part
+            while len(self._expanded) > self.cache_entries:
+                self._expanded.popitem(last=False)
+        return part
+
+    def estimate_part(self, part: Dict[str, Any], image_tokens: int) -> Tuple[int, bool]:
+        """
+        添付参照パートを展開せずに (推定トークン数, 画像かどうか) を返す。履歴の圧縮で展開前に使う。
+        展開結果がキャッシュにあればその長さを、無ければファイルサイズと max_text_chars から上限を見積もる
+        (UTF-8 で 3 バイト以上の日本語が 1 文字 1 トークンのため、サイズの 1/3 をトークン数の上限とみなす)。
+        """
+        entry = self.store.get(part.get("attachment_id"))
+        if entry is None:
+            # 見つからない添付は展開時に 400 になるため、ここでは数えない
+            return 0, False
+        if (entry.get("content_type") or "").startswith("image/"):
+            return image_tokens, True
+        cached = self._expanded.get(entry["sha256"]) if part.get("rows") is None and not part.get("symbols") else None
+        if cached is not None:
+            return estimate_text_tokens(cached.get("text") or ""), False
+        return min(entry.get("size_bytes", 0) // 3 + 1, self.max_text_chars) + ESTIMATED_HEADER_TOKENS, False
+
+    def forget(self, attachment_id: str) -> None:
+        """ ストアから取り除かれた添付の展開結果と検索インデックスの登録を捨てる。 """
+        self._expanded.pop(attachment_id, None)
+        if self.retriever is not None:
+            self.retriever.remove(attachment_id)
+
+    async def expand_messages(self, messages: List[Dict[str, Any]], query: Optional[str] = None) -> List[Dict[str, Any]]:
+        """
+        メッセージ中の添付参照パートを展開したコピーを返す。参照を含まないメッセージはそのまま使う。
+        query (通常は最新のユーザーの質問) を渡すと、長い文書はその質問に関連する抜粋に置き換える。
+        """
+        expanded_messages = []
+        for message in messages:
+            content = message.get("content")
+            if not isinstance(content, list) or not any(part.get("type") == ATTACHMENT_PART_TYPE for part in content):
+                expanded_messages.append(message)
+                continue
+            parts = []
+            for part in content:
+                if part.get("type") == ATTACHMENT_PART_TYPE:
+                    parts.append(await self.expand_part(part["attachment_id"], query, part.get("rows"), part.get("symbols")))
+                else:
+                    parts.append(part)
+            expanded_messages.append({**message, "content": parts})
+        return expanded_messages
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "cached_parts": len(self._expanded),
+            "hits": self.hits,
+            "misses": self.misses,
+            "retrievals": self.retrievals,
+            "index": self.retriever.stats() if self.retriever is not None else None,
+        }
@@ -0,0 +1,122 @@
+# d:\Users\onisi\Documents\web-app-dev\backend\benchmarks\bench_prompt_scanner.py
+"""
+プロンプトスキャナのマイクロベンチマーク。
+
+100KB 以上の合成テンプレートに対して、旧実装 (変数ごとに先頭から再走査する O(V·N) 版) と
+main.py の単一パス版の find_free_floating_variables、および extract_variables /
+extract_between_tags の実行時間を比較する。
+
+    python backend/benchmarks/bench_prompt_scanner.py
+    python backend/benchmarks/bench_prompt_scanner.py --sizes 100 500 --min-speedup 10
+
+--min-speedup を指定すると、速度向上率がその値を下回った場合に終了コード 1 を返す (回帰検知用)。
+"""
+import argparse
+import random
+import re
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from main import extract_between_tags, extract_variables, find_free_floating_variables  # noqa: E402
+from prompt_scanner import scan_prompt  # noqa: E402
+
+
+def legacy_find_free_floating_variables(prompt_text: str) -> list[str]:
+    """ 比較用の旧実装 (変更前の main.py と同一)。 """
+    variable_usages = re.findall(r'\{\$[A-Z0-9_]+\}', prompt_text)
+
+    free_floating_variables = []
+    for variable in variable_usages:
+        preceding_text = prompt_text[:prompt_text.index(variable)]
+        open_tags = set()
+
+        i = 0
+        while i < len(preceding_text):
+            if preceding_text[i] == '<':
+                if i + 1 < len(preceding_text) and preceding_text[i + 1] == '/':
+                    closing_tag = preceding_text[i + 2:].split('>', 1)[0]
+                    open_tags.discard(closing_tag)
+                    i += len(closing_tag) + 3
+                else:
+                    opening_tag = preceding_text[i + 1:].split('>', 1)[0]
+                    open_tags.add(opening_tag)
+                    i += len(opening_tag) + 2
+            else:
+                i += 1
+
+        if not open_tags:
+            free_floating_variables.append(variable)
+
+    return free_floating_variables
+
+
+def build_template(size_kb: int, seed: int = 0) -> str:
+    """ タグで囲まれた変数と浮動変数が混在する、おおよそ size_kb KB の合成テンプレートを生成する。 """
+    rng = random.Random(seed)
+    filler = "Read the following material carefully and follow every instruction exactly. "
+    parts = ["<Instructions>\n"]
+    length = 0
+    index = 0
+    while length < size_kb * 1024:
+        name = f"VAR_{index % 200}"
+        if rng.random() < 0.2:
+            chunk = f"{filler}Please review the {{${name}}} before answering.\n"
+        else:
+            chunk = f"{filler}\n<section_{index}>\n{{${name}}}\n</section_{index}>\n"
+        parts.append(chunk)
+        length += len(chunk)
+        index += 1
+    parts.append("</Instructions>\n")
+    # 浮動変数が最後まで存在するよう、タグの外側にも変数を置く
+    return "Preamble with {$VAR_0} outside of tags.\n" + "".join(parts) + "Trailing {$VAR_1} usage.\n"
+
+
+def measure(func, *args, repeat: int = 5) -> float:
+    """ repeat 回実行した中の最短時間 (秒) を返す。 """
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="プロンプトスキャナのマイクロベンチマーク")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 250], help="テンプレートサイズ (KB)")
+    parser.add_argument("--repeat", type=int, default=5, help="単一パス版の計測回数")
+    parser.add_argument("--min-speedup", type=float, default=None, help="これを下回る速度向上率で失敗とする")
+    args = parser.parse_args()
+
+    failed = False
+    print(f"{'size':>8} {'usages':>7} {'legacy (s)':>11} {'scanner (s)':>12} {'speedup':>9} {'variables (s)':>14} {'tags (s)':>9}")
+    for size_kb in args.sizes:
+        template = build_template(size_kb)
+        usages = len(re.findall(r'\{\$[A-Z0-9_]+\}', template))
+
+        # 旧実装は常に最初の出現だけを判定するため、各変数の最初の出現どうしで結果が一致することを確認する
+        first_usages = {}
+        for usage in scan_prompt(template).variables:
+            first_usages.setdefault(usage.text, usage)
+        first_free = [text for text, usage in first_usages.items() if usage.is_free_floating]
+        assert first_free == list(dict.fromkeys(legacy_find_free_floating_variables(template)))
+
+        legacy_seconds = measure(legacy_find_free_floating_variables, template, repeat=1)
+        scanner_seconds = measure(find_free_floating_variables, template, repeat=args.repeat)
+        variables_seconds = measure(extract_variables, template, repeat=args.repeat)
+        tags_seconds = measure(extract_between_tags, "Instructions", template, repeat=args.repeat)
+        speedup = legacy_seconds / scanner_seconds if scanner_seconds else float("inf")
+
+        print(f"{size_kb:>6}KB {usages:>7} {legacy_seconds:>11.4f} {scanner_seconds:>12.4f} {speedup:>8.1f}x {variables_seconds:>14.4f} {tags_seconds:>9.4f}")
+        if args.min_speedup is not None and speedup < args.min_speedup:
+            print(f"  -> 速度向上率 {speedup:.1f}x が閾値 {args.min_speedup}x を下回りました。")
+            failed = True
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
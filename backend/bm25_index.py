@@ -0,0 +1,203 @@
+# d:\Users\onisi\Documents\web-app-dev\backend\bm25_index.py
+"""
+アップロード文書のローカル BM25 検索インデックス。
+
+抽出済みテキストを段落単位のチャンクに分け、チャンクごとの転置インデックスを作る。
+日本語は形態素解析器を使わずに文字 bigram、英数字は小文字化した単語をトークンとする。
+外部の検索サービスやベクトル DB は使わず、プロセス内のメモリだけで動作する。
+チャンク分割とトークン化はスレッドで行い、転置インデックスへの反映だけをイベントループ上で行う。
+"""
+import re
+import math
+import asyncio
+from collections import Counter, OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+from single_flight import SingleFlight
+
+# 英数字の単語、または日本語 (ひらがな・カタカナ・漢字) の連続
+TOKEN_PATTERN = re.compile(r"[a-z0-9][a-z0-9_]*|[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff々〆ー]+")
+PARAGRAPH_PATTERN = re.compile(r"\n\s*\n")
+
+
+def tokenize(text: str) -> List[str]:
+    """ 英数字は単語単位、日本語は文字 bigram (1 文字のみの場合は unigram) に分割する。 """
+    tokens = []
+    for match in TOKEN_PATTERN.finditer(text.lower()):
+        token = match.group()
+        if token[0].isascii():
+            tokens.append(token)
+        elif len(token) == 1:
+            tokens.append(token)
+        else:
+            tokens.extend(token[index:index + 2] for index in range(len(token) - 1))
+    return tokens
+
+
+def split_into_chunks(text: str, chunk_chars: int, overlap_chars: int) -> List[str]:
+    """ 段落の区切りを優先して chunk_chars 前後のチャンクに分割する (長い段落は overlap_chars 重ねて分割)。 """
+    chunks: List[str] = []
+    # overlap_chars >= chunk_chars でも先へ進むように、長い段落の分割位置は必ず 1 文字以上ずらす
+    step = max(1, chunk_chars - overlap_chars)
+    current = ""
+    for paragraph in PARAGRAPH_PATTERN.split(text):
+        paragraph = paragraph.strip()
+        if not paragraph:
+            continue
+        if current and len(current) + len(paragraph) + 2 > chunk_chars:
+            chunks.append(current)
+            current = ""
+        while len(paragraph) > chunk_chars:
+            chunks.append(paragraph[:chunk_chars])
+            paragraph = paragraph[step:]
+        current = f"{current}\n\n{paragraph}" if current else paragraph
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+@dataclass
+class PreparedDocument:
+    """ インデックスへの追加前に (スレッドで) 計算しておくチャンクと語の出現回数。 """
+    chunks: List[str]
+    term_counts: List[Counter]
+
+
+def prepare_document(text: str, chunk_chars: int = 800, overlap_chars: int = 100) -> PreparedDocument:
+    chunks = split_into_chunks(text, chunk_chars, overlap_chars)
+    return PreparedDocument(chunks=chunks, term_counts=[Counter(tokenize(chunk)) for chunk in chunks])
+
+
+@dataclass
+class SearchHit:
+    doc_id: str
+    chunk_index: int
+    score: float
+    text: str
+
+
+@dataclass
+class _Chunk:
+    doc_id: str
+    index: int
+    text: str
+    length: int
+
+
+@dataclass
+class _Document:
+    chunk_ids: List[int] = field(default_factory=list)
+    # 語 -> その語を含むチャンク ID (削除時に転置リストを全走査しないため)
+    terms: Dict[str, List[int]] = field(default_factory=dict)
+
+
+class BM25Index:
+    """
+    チャンク単位の BM25 転置インデックス。文書は add_text / remove で逐次更新する。
+    保持する文書数が max_documents を超えた場合は最も長く使われていない文書から取り除く
+    (取り除かれた文書は次に必要になった時に抽出済みテキストから再登録される)。
+    """
+
+    def __init__(self, chunk_chars: int = 800, overlap_chars: int = 100, max_documents: int = 200, k1: float = 1.5, b: float = 0.75):
+        if chunk_chars <= 0 or not 0 <= overlap_chars < chunk_chars:
+            raise ValueError(f"chunk_chars は 1 以上、overlap_chars は 0 以上 chunk_chars 未満である必要があります (chunk_chars={chunk_chars}, overlap_chars={overlap_chars})。")
+        self.chunk_chars = chunk_chars
+        self.overlap_chars = overlap_chars
+        self.max_documents = max_documents
+        self.k1 = k1
+        self.b = b
+        self._chunks: Dict[int, _Chunk] = {}
+        self._documents: "OrderedDict[str, _Document]" = OrderedDict()
+        self._postings: Dict[str, Dict[int, int]] = {}
+        self._next_chunk_id = 0
+        self._total_length = 0
+        self._flights = SingleFlight("bm25_index")
+        self.indexed = 0
+        self.evicted = 0
+        self.searches = 0
+
+    def __contains__(self, doc_id: str) -> bool:
+        return doc_id in self._documents
+
+    async def add_text(self, doc_id: str, text: str) -> None:
+        """ テキストをチャンク分割・トークン化して (スレッドで) 登録する。同じ文書の同時登録は 1 回にまとめる。 """
+        async def prepare_and_add() -> None:
+            prepared = await asyncio.to_thread(prepare_document, text, self.chunk_chars, self.overlap_chars)
+            self.add(doc_id, prepared)
+
+        await self._flights.do(doc_id, prepare_and_add)
+
+    def add(self, doc_id: str, prepared: PreparedDocument) -> None:
+        """ 文書を追加する (既に登録済みの場合は置き換える)。 """
+        if doc_id in self._documents:
+            self.remove(doc_id)
+        document = _Document()
+        for index, (text, counts) in enumerate(zip(prepared.chunks, prepared.term_counts)):
+            chunk_id = self._next_chunk_id
+            self._next_chunk_id += 1
+            length = sum(counts.values())
+            self._chunks[chunk_id] = _Chunk(doc_id, index, text, length)
+            self._total_length += length
+            for term, count in counts.items():
+                self._postings.setdefault(term, {})[chunk_id] = count
+                document.terms.setdefault(term, []).append(chunk_id)
+            document.chunk_ids.append(chunk_id)
+        self._documents[doc_id] = document
+        self.indexed += 1
+        while len(self._documents) > self.max_documents:
+            self.remove(next(iter(self._documents)))
+            self.evicted += 1
+
+    def remove(self, doc_id: str) -> None:
+        document = self._documents.pop(doc_id, None)
+        if document is None:
+            return
+        for chunk_id in document.chunk_ids:
+            self._total_length -= self._chunks.pop(chunk_id).length
+        for term, chunk_ids in document.terms.items():
+            postings = self._postings[term]
+            for chunk_id in chunk_ids:
+                del postings[chunk_id]
+            if not postings:
+                del self._postings[term]
+
+    def search(self, query: str, doc_ids: Optional[Iterable[str]] = None, top_k: int = 5) -> List[SearchHit]:
+        """ query に対するスコア上位 top_k 件のチャンクを返す。doc_ids を指定した場合はその文書だけを対象にする。 """
+        self.searches += 1
+        if not self._chunks:
+            return []
+        allowed: Optional[Set[str]] = set(doc_ids) if doc_ids is not None else None
+        for doc_id in allowed or ():
+            if doc_id in self._documents:
+                self._documents.move_to_end(doc_id)
+        chunk_count = len(self._chunks)
+        average_length = self._total_length / chunk_count or 1.0
+        scores: Dict[int, float] = {}
+        for term in set(tokenize(query)):
+            postings = self._postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (chunk_count - len(postings) + 0.5) / (len(postings) + 0.5))
+            for chunk_id, term_frequency in postings.items():
+                chunk = self._chunks[chunk_id]
+                if allowed is not None and chunk.doc_id not in allowed:
+                    continue
+                norm = term_frequency + self.k1 * (1 - self.b + self.b * chunk.length / average_length)
+                scores[chunk_id] = scores.get(chunk_id, 0.0) + idf * term_frequency * (self.k1 + 1) / norm
+
+        ranked: List[Tuple[int, float]] = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:top_k]
+        return [
+            SearchHit(self._chunks[chunk_id].doc_id, self._chunks[chunk_id].index, score, self._chunks[chunk_id].text)
+            for chunk_id, score in ranked
+        ]
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "documents": len(self._documents),
+            "chunks": len(self._chunks),
+            "terms": len(self._postings),
+            "indexed": self.indexed,
+            "evicted": self.evicted,
+            "searches": self.searches,
+        }
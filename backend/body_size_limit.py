@@ -0,0 +1,94 @@
+# d:\Users\onisi\Documents\web-app-dev\backend\body_size_limit.py
+"""
+リクエストボディのサイズ上限を強制する ASGI ミドルウェア。
+
+Content-Length が上限を超えるリクエストはアプリに渡す前に 413 で拒否する。
+Content-Length が無い (chunked) か偽装されている場合も、受信したバイト数を数え、
+上限を超えた時点で受信を打ち切って 413 を返す。上限はパスごとに limit_for_path で決める。
+"""
+import json
+import logging
+from typing import Callable, Optional
+
+from starlette.exceptions import HTTPException
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+logger = logging.getLogger(__name__)
+
+
+class RequestBodyTooLarge(HTTPException):
+    """
+    受信中のボディが上限を超えた場合に receive() から送出される。
+    HTTPException のサブクラスにすることで、ボディを読んでいる FastAPI の処理が
+    400 などに変換せず、そのまま 413 応答になる。
+    """
+
+    def __init__(self, limit_bytes: int):
+        super().__init__(status_code=413, detail=f"リクエストボディが大きすぎます。最大 {limit_bytes} bytes までです。")
+        self.limit_bytes = limit_bytes
+
+
+class BodySizeLimitMiddleware:
+    """ limit_for_path(path) が返すバイト数 (None は無制限) を超えるボディを拒否する。 """
+
+    def __init__(self, app: ASGIApp, limit_for_path: Callable[[str], Optional[int]]):
+        self.app = app
+        self.limit_for_path = limit_for_path
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        limit_bytes = self.limit_for_path(scope["path"])
+        if limit_bytes is None:
+            await self.app(scope, receive, send)
+            return
+
+        content_length = dict(scope["headers"]).get(b"content-length")
+        if content_length is not None and content_length.isdigit() and int(content_length) > limit_bytes:
+            logger.warning(f"Content-Length が上限を超えています: {scope['path']} ({int(content_length)} > {limit_bytes} bytes)")
+            await self._send_413(send, limit_bytes)
+            return
+
+        received_bytes = 0
+        response_started = False
+
+        async def limited_receive() -> Message:
+            nonlocal received_bytes
+            message = await receive()
+            if message["type"] == "http.request":
+                received_bytes += len(message.get("body", b""))
+                if received_bytes > limit_bytes:
+                    logger.warning(f"受信中のボディが上限を超えたため打ち切りました: {scope['path']} (> {limit_bytes} bytes)")
+                    raise RequestBodyTooLarge(limit_bytes)
+            return message
+
+        async def tracked_send(message: Message) -> None:
+            nonlocal response_started
+            if message["type"] == "http.response.start":
+                response_started = True
+            await send(message)
+
+        try:
+            await self.app(scope, limited_receive, tracked_send)
+        except RequestBodyTooLarge:
+            # 通常は FastAPI の例外処理が 413 応答にするが、ルート外で送出された場合はここで応答する
+            if not response_started:
+                await self._send_413(send, limit_bytes)
+
+    @staticmethod
+    async def _send_413(send: Send, limit_bytes: int) -> None:
+        body = json.dumps(
+            {"detail": f"リクエストボディが大きすぎます。最大 {limit_bytes} bytes までです。"}, ensure_ascii=False
+        ).encode("utf-8")
+        await send({
+            "type": "http.response.start",
+            "status": 413,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode("latin-1")),
+                (b"connection", b"close"),
+            ],
+        })
+        await send({"type": "http.response.body", "body": body})
@@ -0,0 +1,87 @@
+# d:\Users\onisi\Documents\web-app-dev\backend\chat_sessions.py
+"""
+サーバー側のチャットセッション保存。
+
+セッション ID ごとに確定済みのメッセージ履歴と、その履歴のハッシュ (チェーンハッシュ) を保持する。
+クライアントは新しいターンと直前に受け取ったハッシュだけを送り、
+ハッシュが一致すればサーバー側の履歴に新しいターンをつなげて使う。
+"""
+import json
+import time
+import hashlib
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional
+
+EMPTY_HISTORY_HASH = hashlib.sha256(b"").hexdigest()
+
+
+def chain_history_hash(previous_hash: str, messages: List[Dict[str, Any]]) -> str:
+    """ previous_hash の履歴に messages を追加した履歴のハッシュを返す。 """
+    history_hash = previous_hash
+    for message in messages:
+        canonical = json.dumps(message, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+        history_hash = hashlib.sha256((history_hash + canonical).encode("utf-8")).hexdigest()
+    return history_hash
+
+
+@dataclass
+class ChatSession:
+    messages: List[Dict[str, Any]] = field(default_factory=list)
+    history_hash: str = EMPTY_HISTORY_HASH
+    updated_at: float = field(default_factory=time.monotonic)
+
+
+class ChatSessionStore:
+    """
+    上限数と有効期限付きのインメモリ・セッションストア。
+    上限を超えた場合は最も長く使われていないセッションから破棄する。
+    """
+
+    def __init__(self, max_sessions: int = 1000, ttl_seconds: float = 3600, max_messages: int = 200):
+        self.max_sessions = max_sessions
+        self.ttl_seconds = ttl_seconds
+        self.max_messages = max_messages
+        self._sessions: "OrderedDict[str, ChatSession]" = OrderedDict()
+        self.conflicts = 0
+
+    def _evict_expired(self) -> None:
+        cutoff = time.monotonic() - self.ttl_seconds
+        while self._sessions:
+            session_id, session = next(iter(self._sessions.items()))
+            if session.updated_at >= cutoff and len(self._sessions) <= self.max_sessions:
+                break
+            del self._sessions[session_id]
+
+    def get(self, session_id: str) -> Optional[ChatSession]:
+        """ 有効なセッションを返す。存在しない・期限切れの場合は None。 """
+        self._evict_expired()
+        return self._sessions.get(session_id)
+
+    def commit(self, session_id: str, base_hash: Optional[str], new_messages: List[Dict[str, Any]]) -> Optional[str]:
+        """
+        ターンを確定して新しい履歴ハッシュを返す。
+        base_hash が None の場合は new_messages を履歴全体としてセッションを作り直す。
+        base_hash が現在のハッシュと異なる場合 (並行するターンで既に更新された場合) は確定せず None を返す。
+        """
+        session = self._sessions.get(session_id)
+        if base_hash is None:
+            session = ChatSession()
+        elif session is None or session.history_hash != base_hash:
+            self.conflicts += 1
+            return None
+
+        session.messages = (session.messages + new_messages)[-self.max_messages:]
+        session.history_hash = chain_history_hash(session.history_hash, new_messages)
+        session.updated_at = time.monotonic()
+        self._sessions[session_id] = session
+        self._sessions.move_to_end(session_id)
+        self._evict_expired()
+        return session.history_hash
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "sessions": len(self._sessions),
+            "max_sessions": self.max_sessions,
+            "conflicts": self.conflicts,
+        }
@@ -0,0 +1,403 @@
+# d:\Users\onisi\Documents\web-app-dev\backend\code_outline.py
+"""
+アップロードされたソースコードのアウトライン作成。
+
+大きなソースファイルをそのままプロンプトに載せる代わりに、クラス・関数のシグネチャと
+docstring (JSDoc) の 1 行目、行番号だけを並べたアウトラインを作る。
+Python は ast で、JavaScript は文字列・コメント・正規表現を読み飛ばしながら括弧の対応を追う
+簡易トークナイザで解析する。指定されたシンボル (または質問に現れたシンボル) だけは本体を展開する。
+解析はプロセスプールで行い、結果はアップロードファイルの隣 (<ファイル>.outline.json) にキャッシュする。
+"""
+import re
+import ast
+import json
+import bisect
+import logging
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional
+
+import aiofiles
+
+from process_pool import PoolTaskError, ProcessPoolRunner
+from single_flight import SingleFlight
+from document_extractor import decode_text
+
+logger = logging.getLogger(__name__)
+
+OUTLINE_SUFFIX = ".outline.json"
+PYTHON_CONTENT_TYPES = {"text/x-python", "application/x-python", "text/x-script.python"}
+JAVASCRIPT_CONTENT_TYPES = {"application/javascript", "text/javascript", "application/x-javascript", "text/jsx"}
+CODE_CONTENT_TYPES = PYTHON_CONTENT_TYPES | JAVASCRIPT_CONTENT_TYPES
+MAX_DOC_CHARS = 120
+MAX_LISTED_NAMES = 40
+IDENTIFIER_PATTERN = re.compile(r"[A-Za-z_$][\w$]*")
+
+
+def _first_line(doc: Optional[str]) -> Optional[str]:
+    if not doc:
+        return None
+    for line in doc.strip().splitlines():
+        line = line.strip().lstrip("*").strip()
+        if line:
+            return line if len(line) <= MAX_DOC_CHARS else line[:MAX_DOC_CHARS] + "…"
+    return None
+
+
+# ---------------------------------------------------------------- Python
+
+def _python_signature(node: ast.AST) -> str:
+    decorators = "".join(f"@{ast.unparse(decorator)} " for decorator in node.decorator_list)
+    if isinstance(node, ast.ClassDef):
+        bases = [ast.unparse(base) for base in node.bases] + [ast.unparse(keyword) for keyword in node.keywords]
+        return f"{decorators}class {node.name}({', '.join(bases)})" if bases else f"{decorators}class {node.name}"
+    prefix = "async def" if isinstance(node, ast.AsyncFunctionDef) else "def"
+    returns = f" -> {ast.unparse(node.returns)}" if node.returns is not None else ""
+    return f"{decorators}{prefix} {node.name}({ast.unparse(node.args)}){returns}"
+
+
+def _python_outline(source: str) -> Dict[str, Any]:
+    tree = ast.parse(source)
+    symbols: List[Dict[str, Any]] = []
+
+    def visit(body: List[ast.stmt], prefix: str, depth: int) -> None:
+        for node in body:
+            if not isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+                continue
+            is_class = isinstance(node, ast.ClassDef)
+            symbols.append({
+                "name": prefix + node.name,
+                "kind": "class" if is_class else ("method" if depth else "function"),
+                "signature": _python_signature(node),
+                "doc": _first_line(ast.get_docstring(node)),
+                "start": min([node.lineno] + [decorator.lineno for decorator in node.decorator_list]),
+                "end": node.end_lineno,
+                "depth": depth,
+            })
+            if is_class:
+                visit(node.body, f"{prefix}{node.name}.", depth + 1)
+
+    visit(tree.body, "", 0)
+    imports: List[str] = []
+    constants: List[str] = []
+    for node in tree.body:
+        if isinstance(node, ast.Import):
+            imports.extend(alias.name for alias in node.names)
+        elif isinstance(node, ast.ImportFrom):
+            imports.append("." * node.level + (node.module or ""))
+        elif isinstance(node, (ast.Assign, ast.AnnAssign)):
+            targets = node.targets if isinstance(node, ast.Assign) else [node.target]
+            constants.extend(target.id for target in targets if isinstance(target, ast.Name))
+    return {
+        "language": "python",
+        "doc": _first_line(ast.get_docstring(tree)),
+        "imports": list(dict.fromkeys(imports)),
+        "globals": list(dict.fromkeys(constants)),
+        "symbols": symbols,
+    }
+
+
+# ---------------------------------------------------------------- JavaScript
+
+JS_FUNCTION_PATTERN = re.compile(r"^(?:export\s+)?(?:default\s+)?(?:async\s+)?function\s*\*?\s*([\w$]*)\s*\(", re.S)
+JS_CLASS_PATTERN = re.compile(r"^(?:export\s+)?(?:default\s+)?class\b\s*([\w$]*)", re.S)
+JS_ARROW_PATTERN = re.compile(
+    r"^(?:export\s+)?(?:const|let|var)\s+([\w$]+)\s*=\s*(?:async\s+)?(?:function\b|\([^)]*\)\s*=>|[\w$]+\s*=>)", re.S
+)
+JS_METHOD_PATTERN = re.compile(r"^(?:static\s+)?(?:async\s+)?(?:[gs]et\s+)?\*?\s*([\w$#]+)\s*\(.*\)$", re.S)
+JS_IMPORT_PATTERN = re.compile(r"""^\s*import\b[^;'"]*?\bfrom\s*["']([^"']+)["']|^\s*import\s*["']([^"']+)["']""", re.M)
+JS_NON_METHOD_KEYWORDS = {"if", "for", "while", "switch", "catch", "with", "function", "return"}
+# 直前がこれらの文字 (または行頭) の "/" は除算ではなく正規表現リテラルとみなす
+JS_REGEX_PRECEDERS = set("(,=:[!&|?{};+-*%<>~^")
+
+
+class _JavaScriptScanner:
+    """
+    文字列・テンプレート・コメント・正規表現を読み飛ばしながら括弧の対応を追い、
+    トップレベルとクラス本体の宣言を集める。構文の厳密な解析は行わない。
+    """
+
+    def __init__(self, source: str):
+        self.source = source
+        self.line_starts = [0] + [match.end() for match in re.finditer("\n", source)]
+        self.symbols: List[Dict[str, Any]] = []
+        # 開いている括弧: (括弧の文字, 対応するシンボルの添字, クラス本体か)
+        self.stack: List[tuple] = []
+        self.statement_start = 0
+        self.last_doc: Optional[tuple] = None  # (コメントの終了位置, 本文)
+
+    def line_of(self, index: int) -> int:
+        return bisect.bisect_right(self.line_starts, index)
+
+    def at_statement_level(self) -> bool:
+        return not self.stack or self.stack[-1][2]
+
+    def class_prefix(self) -> str:
+        if self.stack and self.stack[-1][2] and self.stack[-1][1] is not None:
+            return self.symbols[self.stack[-1][1]]["name"] + "."
+        return ""
+
+    def _declaration(self, end: int, with_body: bool) -> Optional[int]:
+        """ statement_start から end までを宣言として解釈できればシンボルを登録して添字を返す。 """
+        header = self.source[self.statement_start:end]
+        lines = header.split("\n")
+        in_class = bool(self.stack)
+        # セミコロンの無いコードでは前の文が混ざるため、最後の行から遡って宣言の始まりを探す
+        for offset in range(len(lines) - 1, -1, -1):
+            candidate = "\n".join(lines[offset:]).strip()
+            if not candidate:
+                continue
+            symbol = self._match(candidate, in_class, with_body)
+            if symbol is None:
+                continue
+            start_index = self.statement_start + sum(len(line) + 1 for line in lines[:offset])
+            start_index += len(lines[offset]) - len(lines[offset].lstrip())
+            symbol["start"] = self.line_of(start_index)
+            symbol["end"] = symbol["start"]
+            symbol["depth"] = 1 if in_class else 0
+            if self.last_doc is not None and not self.source[self.last_doc[0]:start_index].strip():
+                symbol["doc"] = _first_line(self.last_doc[1])
+            self.symbols.append(symbol)
+            return len(self.symbols) - 1
+        return None
+
+    def _match(self, candidate: str, in_class: bool, with_body: bool) -> Optional[Dict[str, Any]]:
+        signature = " ".join(candidate.split())
+        if in_class:
+            match = JS_METHOD_PATTERN.match(candidate)
+            if match and with_body and match.group(1) not in JS_NON_METHOD_KEYWORDS:
+                return {"name": self.class_prefix() + match.group(1), "kind": "method", "signature": signature, "doc": None}
+            return None
+        match = JS_CLASS_PATTERN.match(candidate)
+        if match and with_body:
+            return {"name": match.group(1) or "default", "kind": "class", "signature": signature, "doc": None}
+        match = JS_FUNCTION_PATTERN.match(candidate)
+        if match and with_body:
+            return {"name": match.group(1) or "default", "kind": "function", "signature": signature, "doc": None}
+        match = JS_ARROW_PATTERN.match(candidate)
+        if match:
+            return {"name": match.group(1), "kind": "function", "signature": signature.rstrip("{ ").rstrip(), "doc": None}
+        return None
+
+    def _skip_string(self, index: int, quote: str) -> int:
+        source = self.source
+        index += 1
+        while index < len(source):
+            char = source[index]
+            if char == "\\":
+                index += 2
+                continue
+            if char == quote:
+                return index + 1
+            if char == "\n" and quote != "`":
+                # 閉じていない文字列 (JSX のテキスト中のアポストロフィなど) は行末で打ち切る
+                return index
+            index += 1
+        return index
+
+    def _skip_regex(self, index: int) -> int:
+        source = self.source
+        index += 1
+        in_class = False
+        while index < len(source) and source[index] != "\n":
+            char = source[index]
+            if char == "\\":
+                index += 2
+                continue
+            if char == "[":
+                in_class = True
+            elif char == "]":
+                in_class = False
+            elif char == "/" and not in_class:
+                return index + 1
+            index += 1
+        return index
+
+    def _previous_significant(self, index: int) -> str:
+        index -= 1
+        while index >= 0 and self.source[index] in " \t\r\n":
+            index -= 1
+        return self.source[index] if index >= 0 else ""
+
+    def scan(self) -> None:
+        source = self.source
+        index = 0
+        while index < len(source):
+            char = source[index]
+            if char in "\"'`":
+                index = self._skip_string(index, char)
+                continue
+            if source.startswith("//", index):
+                newline = source.find("\n", index)
+                index = len(source) if newline < 0 else newline
+                continue
+            if source.startswith("/*", index):
+                close = source.find("*/", index + 2)
+                end = len(source) if close < 0 else close + 2
+                if source.startswith("/**", index):
+                    self.last_doc = (end, source[index + 3:end - 2])
+                index = end
+                continue
+            if char == "/" and (self._previous_significant(index) in JS_REGEX_PRECEDERS or self._previous_significant(index) == ""):
+                index = self._skip_regex(index)
+                continue
+
+            if char in "([":
+                self.stack.append((char, None, False))
+            elif char == "{":
+                symbol_index = self._declaration(index, with_body=True) if self.at_statement_level() else None
+                is_class_body = symbol_index is not None and self.symbols[symbol_index]["kind"] == "class"
+                self.stack.append((char, symbol_index, is_class_body))
+                if self.at_statement_level():
+                    self.statement_start = index + 1
+            elif char in ")]}":
+                if self.stack:
+                    _, symbol_index, _ = self.stack.pop()
+                    if symbol_index is not None:
+                        self.symbols[symbol_index]["end"] = self.line_of(index)
+                if char == "}" and self.at_statement_level():
+                    self.statement_start = index + 1
+            elif char == ";" and self.at_statement_level():
+                # 本体が式のアロー関数 (const f = (a) => a * 2;) はここで登録する
+                symbol_index = self._declaration(index, with_body=False)
+                if symbol_index is not None:
+                    self.symbols[symbol_index]["end"] = self.line_of(index)
+                self.statement_start = index + 1
+            index += 1
+
+
+def _javascript_outline(source: str) -> Dict[str, Any]:
+    scanner = _JavaScriptScanner(source)
+    scanner.scan()
+    return {
+        "language": "javascript",
+        "doc": None,
+        "imports": list(dict.fromkeys(match.group(1) or match.group(2) for match in JS_IMPORT_PATTERN.finditer(source))),
+        "globals": [],
+        "symbols": sorted(scanner.symbols, key=lambda symbol: symbol["start"]),
+    }
+
+
+# ---------------------------------------------------------------- 共通
+
+def build_outline(path_str: str, content_type: str) -> Optional[Dict[str, Any]]:
+    """ プロセスプールで実行されるアウトライン作成処理。構文エラーなどで解析できない場合は None を返す。 """
+    source = decode_text(Path(path_str).read_bytes())
+    try:
+        outline = _python_outline(source) if content_type in PYTHON_CONTENT_TYPES else _javascript_outline(source)
+    except (SyntaxError, ValueError, RecursionError):
+        return None
+    outline["lines"] = source.count("\n") + 1
+    return outline
+
+
+def find_symbols(outline: Dict[str, Any], names: Iterable[str]) -> List[Dict[str, Any]]:
+    """ 完全な名前 (Class.method) または末尾の名前が一致するシンボルを返す。 """
+    wanted = set(names)
+    return [
+        symbol for symbol in outline["symbols"]
+        if symbol["name"] in wanted or symbol["name"].rsplit(".", 1)[-1] in wanted
+    ]
+
+
+def symbols_in_query(outline: Dict[str, Any], query: str) -> List[str]:
+    """ 質問に識別子として現れたシンボル名 (3 文字以上) を返す。 """
+    identifiers = set(IDENTIFIER_PATTERN.findall(query))
+    return [
+        symbol["name"] for symbol in outline["symbols"]
+        if len(symbol["name"].rsplit(".", 1)[-1]) >= 3 and symbol["name"].rsplit(".", 1)[-1] in identifiers
+    ]
+
+
+def render_outline(outline: Dict[str, Any], filename: str) -> str:
+    """ アウトラインをプロンプトに載せるテキストにする。 """
+    lines = [
+        f"[添付ファイル: {filename} (ソースコードのアウトライン: {outline['language']}, {outline['lines']} 行。関数・メソッドの本体は省略)]",
+        "本体が必要なシンボルは名前を指定すると展開できます。",
+    ]
+    if outline.get("doc"):
+        lines.append(f"概要: {outline['doc']}")
+    for label, key in (("import", "imports"), ("グローバル変数", "globals")):
+        names = outline.get(key) or []
+        if names:
+            more = f" ほか {len(names) - MAX_LISTED_NAMES} 件" if len(names) > MAX_LISTED_NAMES else ""
+            lines.append(f"{label}: {', '.join(names[:MAX_LISTED_NAMES])}{more}")
+    lines.append("")
+    for symbol in outline["symbols"]:
+        doc = f"  # {symbol['doc']}" if symbol.get("doc") else ""
+        lines.append(f"{'    ' * symbol['depth']}L{symbol['start']}-{symbol['end']} {symbol['signature']}{doc}")
+    return "\n".join(lines)
+
+
+def render_symbols(source: str, symbols: List[Dict[str, Any]], language: str, max_chars: int) -> str:
+    """ シンボルの本体をソースから切り出してテキストにする。合計が max_chars を超える分は省略する。 """
+    source_lines = source.split("\n")
+    blocks = []
+    remaining = max_chars
+    for symbol in symbols:
+        body = "\n".join(source_lines[symbol["start"] - 1:symbol["end"]])
+        if remaining <= 0:
+            blocks.append(f"[シンボル {symbol['name']} (L{symbol['start']}-{symbol['end']}) は文字数の上限のため省略されました]")
+            continue
+        if len(body) > remaining:
+            body = body[:remaining] + "\n[... 以降は省略されました]"
+        remaining -= len(body)
+        blocks.append(f"[シンボル {symbol['name']} (L{symbol['start']}-{symbol['end']})]\n```{language}\n{body}\n```")
+    return "\n\n".join(blocks)
+
+
+class CodeOutliner:
+    """ ソースコードのアウトライン作成をプロセスプールで実行し、結果をファイルの隣にキャッシュする。 """
+
+    def __init__(self, workers: int = 1):
+        self.workers = workers
+        self._pool = ProcessPoolRunner("code_outline", workers)
+        self._flights = SingleFlight("code_outline")
+        self.outlined = 0
+        self.cache_hits = 0
+        self.failures = 0
+        self.expanded_symbols = 0
+
+    @staticmethod
+    def cache_path(entry: Dict[str, Any]) -> Path:
+        path = Path(entry["path"])
+        return path.with_name(path.name + OUTLINE_SUFFIX)
+
+    @staticmethod
+    def supports(content_type: Optional[str]) -> bool:
+        return content_type in CODE_CONTENT_TYPES
+
+    async def outline(self, entry: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """ エントリのアウトラインを返す。解析できない場合は None。 """
+        if not self.supports(entry.get("content_type")):
+            return None
+        cache_path = self.cache_path(entry)
+        if cache_path.exists():
+            self.cache_hits += 1
+            async with aiofiles.open(cache_path, "r", encoding="utf-8") as f:
+                return json.loads(await f.read())
+        return await self._flights.do(entry["sha256"], lambda: self._outline_to_cache(entry, cache_path))
+
+    async def _outline_to_cache(self, entry: Dict[str, Any], cache_path: Path) -> Optional[Dict[str, Any]]:
+        label = f"ソースコードのアウトライン作成 ({entry['filename']}, {entry['content_type']})"
+        try:
+            outline = await self._pool.run_cached(cache_path, label, build_outline, entry["path"], entry["content_type"])
+        except PoolTaskError:
+            self.failures += 1
+            return None
+        if outline is not None:
+            self.outlined += 1
+            logger.info(f"ソースコードのアウトラインを作成しました: {entry['filename']} ({len(outline['symbols'])} シンボル)")
+        return outline
+
+    def shutdown(self) -> None:
+        self._pool.shutdown()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "outlined": self.outlined,
+            "cache_hits": self.cache_hits,
+            "failures": self.failures,
+            "expanded_symbols": self.expanded_symbols,
+            "single_flight": self._flights.stats(),
+            "pool": self._pool.stats(),
+        }
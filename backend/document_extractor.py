@@ -0,0 +1,213 @@
+# d:\Users\onisi\Documents\web-app-dev\backend\document_extractor.py
+"""
+アップロードされた文書からのテキスト抽出。
+
+PDF のテキスト抽出・HTML の本文抽出 (script やナビゲーションなどの除去)・文字コード判定といった
+CPU 負荷の高い処理をプロセスプールで実行し、結果をアップロードファイルの隣
+(<ファイル>.extracted.json) に保存する。同じ内容のファイルは 2 回目以降キャッシュを読むだけで済む。
+壊れた PDF など抽出できなかったファイルも null としてキャッシュし、チャットのたびに抽出し直さないようにする。
+PDF の抽出には pypdf、文字コード判定には charset_normalizer を使う (どちらも任意の依存関係)。
+"""
+import re
+import json
+import codecs
+import logging
+from html.parser import HTMLParser
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+import aiofiles
+
+from process_pool import BackgroundTaskSet, PoolTaskError, ProcessPoolRunner
+from single_flight import SingleFlight
+
+try:
+    from pypdf import PdfReader
+except ImportError:  # PDF の抽出は pypdf がある場合のみ
+    PdfReader = None
+
+try:
+    from charset_normalizer import from_bytes as detect_charset
+except ImportError:  # 無い場合は候補の文字コードを順に試す
+    detect_charset = None
+
+logger = logging.getLogger(__name__)
+
+EXTRACTED_SUFFIX = ".extracted.json"
+# テキストとして読める Content-Type (text/* 以外)
+TEXT_LIKE_CONTENT_TYPES = {"application/json", "application/x-yaml", "application/javascript", "application/xml"}
+# BOM も charset_normalizer も無い場合に試す文字コード (日本語のファイルを想定して Shift_JIS 系を含める)
+FALLBACK_ENCODINGS = ("utf-8", "cp932", "euc-jp")
+BOMS = ((codecs.BOM_UTF8, "utf-8-sig"), (codecs.BOM_UTF16_LE, "utf-16"), (codecs.BOM_UTF16_BE, "utf-16"))
+
+# 本文として扱わない HTML 要素 (中のテキストごと捨てる)
+HTML_SKIPPED_TAGS = {"script", "style", "noscript", "template", "svg", "nav", "header", "footer", "aside", "form", "iframe"}
+# 前後で改行を入れるブロック要素
+HTML_BLOCK_TAGS = {
+    "p", "div", "section", "article", "main", "br", "li", "ul", "ol", "table", "tr",
+    "h1", "h2", "h3", "h4", "h5", "h6", "pre", "blockquote", "dd", "dt", "title",
+}
+BLANK_LINES_PATTERN = re.compile(r"\n\s*\n\s*\n+")
+INLINE_SPACE_PATTERN = re.compile(r"[ \t\f\v\r]+")
+
+
+def is_text_content_type(content_type: Optional[str]) -> bool:
+    return bool(content_type) and (content_type.startswith("text/") or content_type in TEXT_LIKE_CONTENT_TYPES)
+
+
+def decode_text(data: bytes) -> str:
+    """ BOM・charset_normalizer・候補の文字コードの順に文字コードを判定してデコードする。 """
+    for bom, encoding in BOMS:
+        if data.startswith(bom):
+            return data.decode(encoding, errors="replace")
+    if detect_charset is not None:
+        best = detect_charset(data).best()
+        if best is not None:
+            return str(best)
+    for encoding in FALLBACK_ENCODINGS:
+        try:
+            return data.decode(encoding)
+        except UnicodeDecodeError:
+            continue
+    return data.decode("utf-8", errors="replace")
+
+
+def compact_text(text: str) -> str:
+    """ 行内の連続する空白と 3 行以上の空行を詰める。 """
+    lines = [INLINE_SPACE_PATTERN.sub(" ", line).strip() for line in text.split("\n")]
+    return BLANK_LINES_PATTERN.sub("\n\n", "\n".join(lines)).strip()
+
+
+class _HTMLTextExtractor(HTMLParser):
+    """ 本文以外の要素を捨て、ブロック要素ごとに改行を入れてテキストを集める。 """
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts: List[str] = []
+        self.skip_depth = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in HTML_SKIPPED_TAGS:
+            self.skip_depth += 1
+        elif tag in HTML_BLOCK_TAGS:
+            self.parts.append("\n")
+
+    def handle_endtag(self, tag):
+        if tag in HTML_SKIPPED_TAGS:
+            self.skip_depth = max(0, self.skip_depth - 1)
+        elif tag in HTML_BLOCK_TAGS:
+            self.parts.append("\n")
+
+    def handle_data(self, data):
+        if not self.skip_depth:
+            self.parts.append(data)
+
+
+def extract_html_text(html: str) -> str:
+    parser = _HTMLTextExtractor()
+    parser.feed(html)
+    parser.close()
+    return "".join(parser.parts)
+
+
+def _extract_pdf_text(path: Path) -> Optional[str]:
+    if PdfReader is None:
+        return None
+    reader = PdfReader(str(path))
+    pages = [page.extract_text() or "" for page in reader.pages]
+    return "\n\n".join(f"[{number} ページ]\n{text}" for number, text in enumerate(pages, start=1) if text.strip())
+
+
+def extract_document_text(path_str: str, content_type: str) -> Optional[str]:
+    """
+    プロセスプールで実行される抽出処理。抽出できない形式 (pypdf の無い PDF など) は None を返す。
+    """
+    path = Path(path_str)
+    if content_type == "application/pdf":
+        text = _extract_pdf_text(path)
+    elif content_type == "text/html":
+        text = extract_html_text(decode_text(path.read_bytes()))
+    elif is_text_content_type(content_type):
+        # ソースコードや Markdown・YAML はインデントに意味があるため、空白を詰めずにそのまま使う
+        return decode_text(path.read_bytes())
+    else:
+        return None
+    return compact_text(text) if text is not None else None
+
+
+class DocumentExtractor:
+    """
+    文書のテキスト抽出をプロセスプールで実行し、結果をアップロードファイルの隣にキャッシュする。
+    on_extracted を指定すると、新たに抽出したテキストを (エントリ, テキスト) で通知する (検索インデックスへの登録など)。
+    """
+
+    def __init__(self, workers: int = 2, on_extracted: Optional[Callable[[Dict[str, Any], str], Awaitable[None]]] = None):
+        self.workers = workers
+        self.on_extracted = on_extracted
+        self._pool = ProcessPoolRunner("document_extractor", workers)
+        self._flights = SingleFlight("document_extraction")
+        self._background = BackgroundTaskSet("テキスト抽出")
+        self.cache_hits = 0
+        self.extracted = 0
+        self.failures = 0
+        if PdfReader is None:
+            logger.warning("pypdf がインストールされていないため、PDF からのテキスト抽出は行いません。")
+
+    @staticmethod
+    def cache_path(entry: Dict[str, Any]) -> Path:
+        path = Path(entry["path"])
+        return path.with_name(path.name + EXTRACTED_SUFFIX)
+
+    def supports(self, content_type: Optional[str]) -> bool:
+        if content_type == "application/pdf":
+            return PdfReader is not None
+        return is_text_content_type(content_type)
+
+    async def extract(self, entry: Dict[str, Any]) -> Optional[str]:
+        """ エントリのファイルから抽出したテキストを返す。未対応の形式や抽出に失敗した場合は None。 """
+        content_type = entry.get("content_type")
+        if not self.supports(content_type):
+            return None
+        cache_path = self.cache_path(entry)
+        if cache_path.exists():
+            self.cache_hits += 1
+            async with aiofiles.open(cache_path, "r", encoding="utf-8") as f:
+                return json.loads(await f.read())
+        return await self._flights.do(entry["sha256"], lambda: self._extract_to_cache(entry, cache_path))
+
+    async def _extract_to_cache(self, entry: Dict[str, Any], cache_path: Path) -> Optional[str]:
+        label = f"テキスト抽出 ({entry['filename']}, {entry['content_type']})"
+        try:
+            text = await self._pool.run_cached(cache_path, label, extract_document_text, entry["path"], entry["content_type"])
+        except PoolTaskError:
+            self.failures += 1
+            return None
+        if text is None:
+            return None
+
+        self.extracted += 1
+        logger.info(f"テキストを抽出しました: {entry['filename']} ({entry['size_bytes']} bytes -> {len(text)} 文字)")
+        if self.on_extracted is not None:
+            try:
+                await self.on_extracted(entry, text)
+            except Exception as e:
+                logger.error(f"抽出後の処理でエラーが発生しました ({entry['filename']}): {e}")
+        return text
+
+    def extract_in_background(self, entry: Dict[str, Any]) -> None:
+        """ アップロード直後に抽出を始めておき、最初のチャットで待たずに済むようにする。 """
+        if self.supports(entry.get("content_type")) and not self.cache_path(entry).exists():
+            self._background.start(self.extract(entry))
+
+    def shutdown(self) -> None:
+        self._pool.shutdown()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "pdf_supported": PdfReader is not None,
+            "extracted": self.extracted,
+            "cache_hits": self.cache_hits,
+            "failures": self.failures,
+            "single_flight": self._flights.stats(),
+            "pool": self._pool.stats(),
+        }
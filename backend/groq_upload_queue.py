@@ -0,0 +1,130 @@
+# d:\Users\onisi\Documents\web-app-dev\backend\groq_upload_queue.py
+"""
+Groq Files API へのバックグラウンドアップロード。
+
+ローカル保存が終わったファイルの SHA-256 を待ち行列に積み、上限数のワーカーが順に
+Groq へアップロードする。進捗はアップロードストアの索引エントリの groq_status に記録する
+(pending -> uploading -> ready / failed)。
+"""
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from upload_store import UploadStore
+
+logger = logging.getLogger(__name__)
+
+GROQ_STATUS_PENDING = "pending"
+GROQ_STATUS_UPLOADING = "uploading"
+GROQ_STATUS_READY = "ready"
+GROQ_STATUS_FAILED = "failed"
+GROQ_STATUS_SKIPPED = "skipped"
+FINISHED_STATUSES = (GROQ_STATUS_READY, GROQ_STATUS_FAILED, GROQ_STATUS_SKIPPED)
+
+
+def groq_status_of(entry: Dict[str, Any]) -> str:
+    """ 索引エントリの Groq アップロード状態を返す (状態を持たない古いエントリも解釈する)。 """
+    if entry.get("groq_file_id"):
+        return GROQ_STATUS_READY
+    return entry.get("groq_status") or GROQ_STATUS_SKIPPED
+
+
+class GroqUploadQueue:
+    """
+    上限数のワーカーで Groq へのアップロードを処理する待ち行列。
+    upload_func は索引エントリを受け取り、Groq の file id を返す。
+    """
+
+    def __init__(self, store: UploadStore, upload_func: Callable[[Dict[str, Any]], Awaitable[str]], workers: int = 2):
+        self.store = store
+        self.upload_func = upload_func
+        self.worker_count = max(1, workers)
+        self._queue: "asyncio.Queue[str]" = asyncio.Queue()
+        self._done: Dict[str, asyncio.Event] = {}
+        self._workers: List[asyncio.Task] = []
+        self.completed = 0
+        self.failed = 0
+
+    def start(self) -> None:
+        if not self._workers:
+            self._workers = [asyncio.create_task(self._worker(number)) for number in range(self.worker_count)]
+
+    async def stop(self) -> None:
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    async def submit(self, sha256: str) -> None:
+        """ Groq への未アップロードのエントリを待ち行列に積む。既に積まれている場合は何もしない。 """
+        if sha256 in self._done:
+            return
+        self._done[sha256] = asyncio.Event()
+        await self.store.update(sha256, groq_status=GROQ_STATUS_PENDING, groq_error=None)
+        self._queue.put_nowait(sha256)
+
+    async def resume_unfinished(self) -> int:
+        """ 前回の実行で完了しなかったアップロード (pending / uploading) を積み直し、その件数を返す。 """
+        unfinished = [
+            sha256 for sha256, entry in self.store.entries()
+            if groq_status_of(entry) in (GROQ_STATUS_PENDING, GROQ_STATUS_UPLOADING)
+        ]
+        for sha256 in unfinished:
+            await self.submit(sha256)
+        return len(unfinished)
+
+    def is_active(self, sha256: str) -> bool:
+        """ sha256 が待ち行列にあるか、アップロード中であれば True。 """
+        return sha256 in self._done
+
+    async def wait(self, sha256: str, timeout: Optional[float] = None) -> bool:
+        """ sha256 のアップロードが終わるまで待つ。待ち行列に無ければ即座に True、タイムアウトした場合は False。 """
+        done = self._done.get(sha256)
+        if done is None:
+            return True
+        try:
+            await asyncio.wait_for(done.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    async def _worker(self, number: int) -> None:
+        while True:
+            sha256 = await self._queue.get()
+            try:
+                await self._process(sha256)
+            except Exception as e:
+                logger.exception(f"Groq アップロードワーカー {number} で予期せぬエラーが発生しました ({sha256[:12]}): {e}")
+            finally:
+                done = self._done.pop(sha256, None)
+                if done is not None:
+                    done.set()
+                self._queue.task_done()
+
+    async def _process(self, sha256: str) -> None:
+        entry = self.store.get(sha256)
+        if entry is None:
+            logger.warning(f"Groq へのアップロード対象のファイルが見つかりません (sha256: {sha256[:12]})。")
+            return
+        if entry.get("groq_file_id"):
+            await self.store.update(sha256, groq_status=GROQ_STATUS_READY)
+            return
+
+        await self.store.update(sha256, groq_status=GROQ_STATUS_UPLOADING)
+        try:
+            groq_file_id = await self.upload_func(entry)
+        except Exception as e:
+            self.failed += 1
+            await self.store.update(sha256, groq_status=GROQ_STATUS_FAILED, groq_error=str(e))
+            return
+        self.completed += 1
+        await self.store.update(sha256, groq_status=GROQ_STATUS_READY, groq_file_id=groq_file_id, groq_error=None)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "workers": len(self._workers),
+            "queued": self._queue.qsize(),
+            "in_progress": len(self._done) - self._queue.qsize(),
+            "completed": self.completed,
+            "failed": self.failed,
+        }
@@ -0,0 +1,147 @@
+# d:\Users\onisi\Documents\web-app-dev\backend\history_compactor.py
+"""
+チャット履歴のトークン予算内への圧縮。
+
+モデルのコンテキスト長から補完トークン数を差し引いた予算に収まるよう、
+古いメッセージから順に (1) 画像パート (2) <think> 推論ブロック (3) メッセージそのもの
+を削っていく。システムメッセージと最新のメッセージは削除しない。
+添付参照パート ({"type": "attachment"}) は展開前に圧縮できるよう、estimate_attachment で
+(推定トークン数, 画像かどうか) を見積もる。削られた添付は展開されない。
+"""
+import re
+import copy
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from rate_limiter import estimate_text_tokens
+
+# メッセージごとのロール・区切りトークン分のオーバーヘッド
+MESSAGE_OVERHEAD_TOKENS = 4
+# reasoning_format=raw のモデルが本文に含める推論ブロック
+THINK_BLOCK_PATTERN = re.compile(r"<think>.*?</think>\s*", re.DOTALL)
+OMITTED_IMAGE_TEXT = "[以前の画像は省略されました]"
+ATTACHMENT_PART_TYPE = "attachment"
+
+# 添付参照パートから (推定トークン数, 画像かどうか) を返す関数
+AttachmentEstimator = Callable[[Dict[str, Any]], Tuple[int, bool]]
+
+
+class HistoryTooLargeError(ValueError):
+    """ 圧縮しても予算に収まらない場合に送出される。 """
+
+    def __init__(self, required_tokens: int, budget_tokens: int):
+        super().__init__(f"必要トークン数 {required_tokens} が予算 {budget_tokens} を超えています。")
+        self.required_tokens = required_tokens
+        self.budget_tokens = budget_tokens
+
+
+@dataclass
+class CompactionResult:
+    messages: List[Dict[str, Any]]
+    original_tokens: int
+    tokens: int
+    images_dropped: int = 0
+    reasoning_dropped: int = 0
+    messages_dropped: int = 0
+
+    @property
+    def compacted(self) -> bool:
+        return bool(self.images_dropped or self.reasoning_dropped or self.messages_dropped)
+
+
+def estimate_message_tokens(message: Dict[str, Any], image_tokens: int, estimate_attachment: Optional[AttachmentEstimator] = None) -> int:
+    """
+    1 メッセージのトークン数を概算する (画像は 1 枚あたり image_tokens とみなす)。
+    添付参照パートは estimate_attachment の見積もりを使い、見積もれない場合は画像 1 枚分とみなす。
+    """
+    content = message.get("content")
+    total = MESSAGE_OVERHEAD_TOKENS
+    if isinstance(content, str):
+        total += estimate_text_tokens(content)
+    elif isinstance(content, list):
+        for part in content:
+            if part.get("type") == "image_url":
+                total += image_tokens
+            elif part.get("type") == ATTACHMENT_PART_TYPE:
+                total += estimate_attachment(part)[0] if estimate_attachment is not None else image_tokens
+            else:
+                total += estimate_text_tokens(part.get("text") or "")
+    return total
+
+
+def _is_image_part(part: Dict[str, Any], estimate_attachment: Optional[AttachmentEstimator]) -> bool:
+    if part.get("type") == "image_url":
+        return True
+    return part.get("type") == ATTACHMENT_PART_TYPE and estimate_attachment is not None and estimate_attachment(part)[1]
+
+
+def _drop_images(message: Dict[str, Any], estimate_attachment: Optional[AttachmentEstimator] = None) -> int:
+    content = message.get("content")
+    if not isinstance(content, list):
+        return 0
+    kept = [part for part in content if not _is_image_part(part, estimate_attachment)]
+    dropped = len(content) - len(kept)
+    if dropped:
+        kept.append({"type": "text", "text": OMITTED_IMAGE_TEXT})
+        message["content"] = kept
+    return dropped
+
+
+def _drop_reasoning(message: Dict[str, Any], estimate_attachment: Optional[AttachmentEstimator] = None) -> bool:
+    content = message.get("content")
+    if message.get("role") != "assistant" or not isinstance(content, str):
+        return False
+    stripped = THINK_BLOCK_PATTERN.sub("", content)
+    if stripped == content:
+        return False
+    message["content"] = stripped
+    return True
+
+
+def compact_history(
+    messages: List[Dict[str, Any]],
+    budget_tokens: int,
+    image_tokens: int = 1000,
+    estimate_attachment: Optional[AttachmentEstimator] = None,
+) -> CompactionResult:
+    """
+    messages を budget_tokens 以内に収めたコピーを返す。元のリストは変更しない。
+    システムメッセージと最新メッセージだけでも収まらない場合は HistoryTooLargeError を送出する。
+    """
+    costs = [estimate_message_tokens(message, image_tokens, estimate_attachment) for message in messages]
+    original_tokens = sum(costs)
+    result = CompactionResult(messages=messages, original_tokens=original_tokens, tokens=original_tokens)
+    if original_tokens <= budget_tokens:
+        return result
+
+    messages = copy.deepcopy(messages)
+    total = original_tokens
+    # 最新メッセージと system メッセージ以外が削減対象 (古い順)
+    candidates = [index for index, message in enumerate(messages[:-1]) if message.get("role") != "system"]
+
+    for reducer, counter in ((_drop_images, "images_dropped"), (_drop_reasoning, "reasoning_dropped")):
+        for index in candidates:
+            if total <= budget_tokens:
+                break
+            reduced = reducer(messages[index], estimate_attachment)
+            if reduced:
+                setattr(result, counter, getattr(result, counter) + int(reduced))
+                new_cost = estimate_message_tokens(messages[index], image_tokens, estimate_attachment)
+                total -= costs[index] - new_cost
+                costs[index] = new_cost
+
+    dropped = set()
+    for index in candidates:
+        # 予算に収まった後も、履歴が assistant から始まらないよう直後の assistant は削除する
+        if total <= budget_tokens and (not dropped or messages[index].get("role") != "assistant"):
+            break
+        dropped.add(index)
+        total -= costs[index]
+
+    if total > budget_tokens:
+        raise HistoryTooLargeError(total, budget_tokens)
+
+    result.messages = [message for index, message in enumerate(messages) if index not in dropped]
+    result.messages_dropped = len(dropped)
+    result.tokens = total
+    return result
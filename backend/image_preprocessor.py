@@ -0,0 +1,127 @@
+# d:\Users\onisi\Documents\web-app-dev\backend\image_preprocessor.py
+"""
+画像の縮小・再圧縮。
+
+ビジョンモデルは大きな画像を内部で縮小するため、送信前に長辺を max_dimension 以下へ縮小し、
+再圧縮してメタデータ (EXIF など) を取り除く。処理はプロセスプールで行い、
+結果は元画像の SHA-256 をキーに LRU キャッシュする。
+Pillow が未インストールの場合は画像をそのまま返す。
+"""
+import io
+import hashlib
+import logging
+from collections import OrderedDict
+from typing import Any, Dict, Tuple
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow は任意の依存関係
+    Image = None
+    ImageOps = None
+
+from process_pool import ProcessPoolRunner
+
+logger = logging.getLogger(__name__)
+
+# 形式を保ったまま再圧縮する画像形式 (それ以外は JPEG、透過がある場合は PNG に変換する)
+PRESERVED_FORMATS = {"JPEG": "image/jpeg", "PNG": "image/png", "WEBP": "image/webp"}
+
+
+def _downscale_image(data: bytes, max_dimension: int, jpeg_quality: int) -> Tuple[bytes, str]:
+    """ プロセスプールで実行される縮小・再圧縮処理。戻り値は (画像のバイト列, Content-Type)。 """
+    with Image.open(io.BytesIO(data)) as image:
+        source_format = image.format
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((max_dimension, max_dimension), Image.LANCZOS)
+
+        has_alpha = image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info)
+        output_format = source_format if source_format in PRESERVED_FORMATS else ("PNG" if has_alpha else "JPEG")
+        if output_format == "JPEG" and image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+
+        # exif / icc_profile などを引き継がずに保存することで、撮影情報 (位置情報を含む) などのメタデータを落とす
+        image.info = {}
+        output = io.BytesIO()
+        if output_format == "JPEG":
+            image.save(output, format="JPEG", quality=jpeg_quality, optimize=True)
+        elif output_format == "WEBP":
+            image.save(output, format="WEBP", quality=jpeg_quality)
+        else:
+            image.save(output, format="PNG", optimize=True)
+        return output.getvalue(), PRESERVED_FORMATS.get(output_format, "image/jpeg")
+
+
+class ImagePreprocessor:
+    """ 画像の縮小・再圧縮をプロセスプールで実行し、結果をキャッシュする。 """
+
+    def __init__(self, max_dimension: int = 1568, jpeg_quality: int = 85, workers: int = 2, cache_entries: int = 128):
+        self.max_dimension = max_dimension
+        self.jpeg_quality = jpeg_quality
+        self.workers = workers
+        self.cache_entries = cache_entries
+        self._pool = ProcessPoolRunner("image_preprocessor", workers)
+        self._cache: "OrderedDict[str, Tuple[bytes, str]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.failures = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        if Image is None:
+            logger.warning("Pillow がインストールされていないため、画像の縮小・再圧縮は行いません。")
+
+    @property
+    def available(self) -> bool:
+        return Image is not None
+
+    def _remember(self, key: str, result: Tuple[bytes, str]) -> None:
+        self._cache[key] = result
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.cache_entries:
+            self._cache.popitem(last=False)
+
+    async def process(self, data: bytes, content_type: str) -> Tuple[bytes, str]:
+        """
+        画像を縮小・再圧縮して (バイト列, Content-Type) を返す。
+        Pillow が無い場合や画像を解釈できない場合は元の画像をそのまま返す。
+        """
+        if not self.available or content_type == "image/gif":
+            return data, content_type
+
+        key = hashlib.sha256(data).hexdigest()
+        cached = self._cache.get(key)
+        if cached is not None:
+            self._cache.move_to_end(key)
+            self.hits += 1
+            return cached
+
+        self.misses += 1
+        try:
+            result = await self._pool.run(_downscale_image, data, self.max_dimension, self.jpeg_quality)
+        except Exception as e:
+            self.failures += 1
+            logger.warning(f"画像の縮小・再圧縮に失敗しました。元の画像を使用します ({content_type}, {len(data)} bytes): {e}")
+            return data, content_type
+
+        # 再圧縮で元より大きくなった場合も、メタデータを含む元の画像ではなく再圧縮後の画像を使う
+        self.bytes_in += len(data)
+        self.bytes_out += len(result[0])
+        self._remember(key, result)
+        # 処理済みの画像が再び渡された場合 (履歴の再送など) に再圧縮を重ねないようにする
+        self._remember(hashlib.sha256(result[0]).hexdigest(), result)
+        logger.debug(f"画像を縮小・再圧縮しました: {len(data)} -> {len(result[0])} bytes ({content_type} -> {result[1]})")
+        return result
+
+    def shutdown(self) -> None:
+        self._pool.shutdown()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "available": self.available,
+            "cache_entries": len(self._cache),
+            "hits": self.hits,
+            "misses": self.misses,
+            "failures": self.failures,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "pool": self._pool.stats(),
+        }
@@ -4,15 +4,43 @@ import json
 import time
 import sys
 import logging
-from fastapi import FastAPI, HTTPException, BackgroundTasks, UploadFile, File
+import importlib.util
+import hashlib
+import asyncio
+import uuid
+import base64
+import mimetypes
+import contextvars
+import httpx
+from fastapi import FastAPI, HTTPException, BackgroundTasks, UploadFile, File, Form, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-from groq import Groq, GroqError, AuthenticationError, RateLimitError, APIConnectionError, BadRequestError
-from pydantic import BaseModel
-from typing import List, Dict, Any, Optional, Union
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import StreamingResponse, JSONResponse
+from groq import AsyncGroq, DefaultAsyncHttpxClient, NOT_GIVEN, GroqError, AuthenticationError, RateLimitError, APIConnectionError, BadRequestError
+from pydantic import BaseModel, ValidationError, model_validator
+from typing import List, Dict, Any, Optional, Tuple, Union, AsyncIterator, Awaitable, Callable
 from pathlib import Path
 import aiofiles
 import re
 
+from result_cache import ResultCache, make_cache_key
+from prompt_scanner import scan_prompt, VariableUsage, TagStreamExtractor
+from rate_limiter import RateLimitScheduler, Reservation
+from single_flight import SingleFlight
+from history_compactor import compact_history, estimate_message_tokens, HistoryTooLargeError
+from chat_sessions import ChatSessionStore
+from upload_store import UploadStore
+from body_size_limit import BodySizeLimitMiddleware
+from image_preprocessor import ImagePreprocessor
+from document_extractor import DocumentExtractor
+from bm25_index import BM25Index
+from table_summary import TableSummarizer
+from code_outline import CodeOutliner
+from url_fetcher import UrlFetcher, UrlFetchError
+from attachments import AttachmentRegistry, AttachmentNotFoundError, ATTACHMENT_PART_TYPE
+from resumable_uploads import ResumableUploadManager, ResumableUploadError
+from groq_upload_queue import GroqUploadQueue, groq_status_of, FINISHED_STATUSES, GROQ_STATUS_FAILED, GROQ_STATUS_SKIPPED
+
 import uvicorn
 import traceback
 
@@ -22,8 +50,27 @@ logger.addHandler(logging.NullHandler())
 
 # --- Global Variables ---
 config: Dict[str, Any] = {}
-groq_client: Optional[Groq] = None
+groq_client: Optional[AsyncGroq] = None
 api_key: Optional[str] = None
+model_catalog: Dict[str, Any] = {"models": None, "etag": None, "expires_at": 0.0}
+model_catalog_refresh_task: Optional[asyncio.Task] = None
+metaprompt_cache: Optional[ResultCache] = None
+rate_limiter: Optional[RateLimitScheduler] = None
+chat_sessions: Optional[ChatSessionStore] = None
+upload_store: Optional[UploadStore] = None
+groq_upload_queue: Optional[GroqUploadQueue] = None
+resumable_uploads: Optional[ResumableUploadManager] = None
+image_preprocessor: Optional[ImagePreprocessor] = None
+attachment_registry: Optional[AttachmentRegistry] = None
+document_extractor: Optional[DocumentExtractor] = None
+document_index: Optional[BM25Index] = None
+table_summarizer: Optional[TableSummarizer] = None
+code_outliner: Optional[CodeOutliner] = None
+url_fetcher: Optional[UrlFetcher] = None
+# 同一の上流呼び出しが同時に実行中の場合に 1 回へまとめる
+model_list_flights = SingleFlight("models")
+metaprompt_flights = SingleFlight("metaprompt")
+chat_flights = SingleFlight("chat")
 
 # --- FastAPI App Initialization ---
 app = FastAPI(
@@ -32,6 +79,37 @@ app = FastAPI(
     version="0.2.0",
 )
 
+# --- Request Body Size Limits ---
+def request_body_limit(path: str) -> Optional[int]:
+    """
+    path に最も長く前方一致するルートの上限をバイト数で返す。
+    アップロードとチャットの上限は file_upload / main_chat の設定から求め (max_size_mb を上げれば上限も上がる)、
+    マルチパートの境界や他のフォームフィールドの分として request_limits.multipart_overhead_mb を加える。
+    一致しない場合は request_limits.default_max_body_mb を使い、未設定なら制限しない。
+    """
+    limit_settings = config.get("request_limits", {})
+    upload_settings = config.get("file_upload", {})
+    chat_settings = config.get("main_chat", {})
+    overhead_mb = limit_settings.get("multipart_overhead_mb", 1)
+    max_file_mb = upload_settings.get("max_size_mb", 10)
+    route_limits_mb = {
+        "/api/upload": max_file_mb + overhead_mb,
+        "/api/upload/batch": max_file_mb * upload_settings.get("batch_max_files", 20) + overhead_mb,
+        # 作成 (JSON) とチャンクの PUT。チャンクは生のバイト列なのでマルチパートの分は不要だが、余裕として加える
+        "/api/upload/resumable": upload_settings.get("resumable", {}).get("max_chunk_mb", 8) + overhead_mb,
+        # 画像は base64 の data URL (4/3 倍) で送られる場合がある
+        "/api/chat": chat_settings.get("max_image_mb", 4) * chat_settings.get("max_images_per_request", 4) * 4 / 3 + overhead_mb,
+    }
+    limit_mb = limit_settings.get("default_max_body_mb")
+    matched_length = -1
+    for route, route_limit_mb in route_limits_mb.items():
+        if (path == route or path.startswith(route + "/")) and len(route) > matched_length:
+            limit_mb, matched_length = route_limit_mb, len(route)
+    return None if limit_mb is None else int(limit_mb * 1024 * 1024)
+
+# CORS より内側に置き、413 応答にも CORS ヘッダが付くようにする
+app.add_middleware(BodySizeLimitMiddleware, limit_for_path=request_body_limit)
+
 # --- CORS Configuration ---
 frontend_origins = os.getenv("FRONTEND_ORIGIN", "http://localhost:3001").split(',')
 app.add_middleware(
@@ -45,8 +123,16 @@ app.add_middleware(
 # --- Constants ---
 CONFIG_FILE = os.path.join(os.path.dirname(__file__), "config.json")
 DEFAULT_SYSTEM_PROMPT = "Respond in fluent Japanese"
+# /api/chat の purpose に指定できる config.json のセクション (それ以外の設定をクライアントに選ばせない)
+CHAT_PURPOSES = {"main_chat"}
 UPLOAD_DIR = Path(__file__).parent / "uploads"
 UPLOAD_DIR.mkdir(exist_ok=True)
+UPLOAD_STORE_DIR = UPLOAD_DIR / "store"
+UPLOAD_INDEX_FILE = UPLOAD_DIR / "index.json"
+UPLOAD_RESUMABLE_DIR = UPLOAD_DIR / "resumable"
+UPLOAD_URL_CACHE_FILE = UPLOAD_DIR / "url_cache.json"
+# モデル単位ではない Groq API (models.list / files.create) の予算名の接頭辞。上限は rate_limits.endpoints で設定する
+ENDPOINT_BUDGET_PREFIX = "endpoint:"
 
 # --- Configuration Loading (Modified for Startup) ---
 def load_config_on_startup():
@@ -70,6 +156,15 @@ def load_config_on_startup():
             if "reasoning_supported_models" not in loaded_config.get("main_chat", {}):
                  logger.info("'main_chat' セクションに 'reasoning_supported_models' が見つかりません。空リストを設定します。")
                  loaded_config["main_chat"]["reasoning_supported_models"] = []
+            if "cache" not in loaded_config["metaprompt"]:
+                logger.info("'metaprompt' セクションに 'cache' が見つかりません。メモリのみのキャッシュを使用します。")
+                loaded_config["metaprompt"]["cache"] = {}
+            if "rate_limits" not in loaded_config:
+                logger.info("設定ファイルに 'rate_limits' セクションが見つかりません。デフォルトのレート制限を使用します。")
+                loaded_config["rate_limits"] = {}
+            if "groq_client" not in loaded_config:
+                logger.info("設定ファイルに 'groq_client' セクションが見つかりません。デフォルトの接続プール設定を使用します。")
+                loaded_config["groq_client"] = {}
 
             config = loaded_config
             return config
@@ -85,6 +180,119 @@ def load_config_on_startup():
         logger.exception("設定ファイル読み込み中のエラー詳細:")
         raise RuntimeError(f"設定ファイルの読み込み中にエラー: {e}")
 
+# --- Groq Client Setup ---
+def create_groq_client(api_key: str, client_settings: Dict[str, Any]) -> AsyncGroq:
+    """
+    全エンドポイントで共有する AsyncGroq クライアントを生成する。
+    httpx の接続プール (keep-alive) を設定値から構成し、h2 パッケージが
+    インストールされている場合のみ HTTP/2 を有効にする。
+    """
+    http2_enabled = client_settings.get("http2", True) and importlib.util.find_spec("h2") is not None
+    if client_settings.get("http2", True) and not http2_enabled:
+        logger.info("h2 パッケージが見つからないため、HTTP/1.1 で接続します (HTTP/2 を使うには 'httpx[http2]' をインストールしてください)。")
+
+    limits = httpx.Limits(
+        max_connections=client_settings.get("max_connections", 100),
+        max_keepalive_connections=client_settings.get("max_keepalive_connections", 20),
+        keepalive_expiry=client_settings.get("keepalive_expiry_seconds", 30.0),
+    )
+    timeout = httpx.Timeout(
+        client_settings.get("timeout_seconds", 60.0),
+        connect=client_settings.get("connect_timeout_seconds", 10.0),
+    )
+    http_client = DefaultAsyncHttpxClient(
+        limits=limits,
+        timeout=timeout,
+        http2=http2_enabled,
+        event_hooks={"response": [record_rate_limit_headers]},
+    )
+    logger.debug(f"   接続プール: 最大接続数 {limits.max_connections}, keep-alive {limits.max_keepalive_connections}, HTTP/2: {http2_enabled}")
+    return AsyncGroq(
+        api_key=api_key,
+        http_client=http_client,
+        timeout=timeout,
+        max_retries=client_settings.get("max_retries", 2),
+    )
+
+# 実行中の Groq 呼び出しの予約。レスポンスフックは呼び出しと同じタスク (コンテキスト) で実行されるため、ここから参照できる
+groq_call_reservation: contextvars.ContextVar[Optional[Reservation]] = contextvars.ContextVar("groq_call_reservation", default=None)
+
+async def record_rate_limit_headers(response: httpx.Response) -> None:
+    """
+    httpx のレスポンスフックとして Groq の応答ヘッダをレート制限スケジューラに反映する。
+    モデル名はチャット補完リクエストの JSON ボディから取得する。
+    この呼び出しの予約は Groq の残量に含まれたものとして、処理中の予約から外す。
+    """
+    if rate_limiter is None:
+        return
+    if response.status_code != 429 and "x-ratelimit-remaining-tokens" not in response.headers and "x-ratelimit-remaining-requests" not in response.headers:
+        return
+    reservation = groq_call_reservation.get()
+    if reservation is not None:
+        budget = reservation.model
+    elif response.request.url.path.endswith("/chat/completions"):
+        try:
+            budget = json.loads(response.request.content).get("model")
+        except (ValueError, AttributeError):
+            return
+    else:
+        return
+    if budget:
+        rate_limiter.update_from_headers(budget, response.headers, response.status_code, reservation)
+
+def estimate_messages_tokens(messages: List[Dict[str, Any]]) -> int:
+    """ チャットメッセージ全体の入力トークン数を概算する (画像は 1 枚あたり固定値で見積もる)。 """
+    image_tokens = config.get("main_chat", {}).get("estimated_tokens_per_image", 1000)
+    return sum(estimate_message_tokens(message, image_tokens) for message in messages)
+
+async def call_groq_with_budget(budget: str, estimated_tokens: int, call: Callable[[], Awaitable[Any]]) -> Any:
+    """
+    レート制限スケジューラで予算 (budget はモデル名、またはエンドポイントの予算名) を確保してから call() で Groq を呼び出す。
+    全ての Groq API 呼び出しはこの関数を経由する。
+    """
+    if rate_limiter is None:
+        return await call()
+    reservation = await rate_limiter.acquire(budget, estimated_tokens)
+    if reservation.waited > 0.01:
+        logger.info(f"レート制限の予算待ちで {reservation.waited:.2f}秒 待機しました ({budget})。")
+    context_token = groq_call_reservation.set(reservation)
+    try:
+        return await call()
+    finally:
+        groq_call_reservation.reset(context_token)
+        # 応答ヘッダが届かなかった場合 (接続エラーなど) も処理中の予約から外す
+        rate_limiter.release(reservation)
+
+async def create_chat_completion(client: AsyncGroq, **params):
+    """
+    レート制限スケジューラでモデルの予算を確保してから chat.completions.create を呼び出す。
+    全てのチャット補完呼び出しはこの関数を経由する。
+    """
+    estimated_tokens = 0
+    if rate_limiter is not None:
+        # max_completion_tokens を丸ごと予約すると TPM の小さいモデルでは毎回バケットが空になるまで待たされるため、
+        # 出力分は completion_reserve_tokens までだけ予約し、実際の消費量は応答ヘッダの残量で補正する
+        max_completion_tokens = params.get("max_completion_tokens") or params.get("max_tokens") or 0
+        completion_reserve = config.get("rate_limits", {}).get("completion_reserve_tokens", 1024)
+        estimated_tokens = estimate_messages_tokens(params["messages"]) + min(max_completion_tokens, completion_reserve)
+    return await call_groq_with_budget(params["model"], estimated_tokens, lambda: client.chat.completions.create(**params))
+
+async def list_groq_models(client: AsyncGroq):
+    """ models.list をエンドポイントの予算 (トークンは消費しない) で呼び出す。 """
+    return await call_groq_with_budget(
+        f"{ENDPOINT_BUDGET_PREFIX}models", 0, lambda: client.models.list(timeout=groq_call_timeout("models"))
+    )
+
+def groq_call_timeout(call_type: str):
+    """
+    groq_client.call_timeouts に設定された呼び出し種別ごとのタイムアウト (秒) を返す。
+    未設定の場合はクライアント既定のタイムアウトを使うため NOT_GIVEN を返す。
+    """
+    call_timeouts = config.get("groq_client", {}).get("call_timeouts", {})
+    if call_type in call_timeouts:
+        return call_timeouts[call_type]
+    return NOT_GIVEN
+
 # --- Startup Event Handler ---
 @app.on_event("startup")
 async def startup_event():
@@ -92,13 +300,111 @@ async def startup_event():
     アプリケーション起動時に実行されるイベントハンドラ。
     設定の読み込み、APIキーの取得、Groqクライアントの初期化を行う。
     """
-    global config, groq_client, api_key
+    global config, groq_client, api_key, metaprompt_cache, rate_limiter, chat_sessions, upload_store, groq_upload_queue, resumable_uploads, image_preprocessor, attachment_registry, document_extractor, document_index, table_summarizer, code_outliner, url_fetcher
     logger.info("--- Application Startup Sequence ---")
     try:
         logger.debug("1. 設定ファイルを読み込んでいます...")
         load_config_on_startup()
         logger.debug("   設定ファイルの読み込み完了。")
 
+        cache_settings = config["metaprompt"]["cache"]
+        cache_dir = cache_settings.get("disk_dir")
+        metaprompt_cache = ResultCache(
+            "metaprompt",
+            max_entries=cache_settings.get("max_entries", 256),
+            max_disk_entries=cache_settings.get("max_disk_entries", 4096),
+            disk_dir=Path(__file__).parent / cache_dir if cache_dir else None,
+        )
+        logger.debug(f"   メタプロンプトキャッシュ初期化完了 (ディスク層: {cache_dir or '無効'})。")
+
+        rate_limit_settings = config["rate_limits"]
+        rate_limiter = RateLimitScheduler(
+            default_limits=rate_limit_settings.get("default", {}),
+            model_limits={
+                **rate_limit_settings.get("models", {}),
+                **{f"{ENDPOINT_BUDGET_PREFIX}{name}": limits for name, limits in rate_limit_settings.get("endpoints", {}).items()},
+            },
+        )
+
+        session_settings = config["main_chat"].get("sessions", {})
+        chat_sessions = ChatSessionStore(
+            max_sessions=session_settings.get("max_sessions", 1000),
+            ttl_seconds=session_settings.get("ttl_seconds", 3600),
+            max_messages=session_settings.get("max_messages", 200),
+        )
+
+        upload_store = UploadStore(UPLOAD_STORE_DIR, UPLOAD_INDEX_FILE, config.get("file_upload", {}).get("index_flush_seconds", 1.0))
+        attachment_settings = config.get("attachments", {})
+        retrieval_settings = attachment_settings.get("retrieval", {})
+        if retrieval_settings.get("enabled", True):
+            document_index = BM25Index(
+                chunk_chars=retrieval_settings.get("chunk_chars", 800),
+                overlap_chars=retrieval_settings.get("overlap_chars", 100),
+                max_documents=retrieval_settings.get("max_documents", 200),
+            )
+        document_extractor = DocumentExtractor(
+            workers=attachment_settings.get("extraction_workers", 2),
+            on_extracted=index_extracted_document,
+        )
+        table_settings = config.get("table_summary", {})
+        if table_settings.get("enabled", True):
+            table_summarizer = TableSummarizer(
+                workers=table_settings.get("workers", 1),
+                chunk_rows=table_settings.get("chunk_rows", 5000),
+                sample_rows=table_settings.get("sample_rows", 5),
+                distinct_limit=table_settings.get("distinct_limit", 10000),
+                top_values=table_settings.get("top_values", 5),
+                max_fetch_rows=table_settings.get("max_fetch_rows", 200),
+            )
+        outline_settings = config.get("code_outline", {})
+        if outline_settings.get("enabled", True):
+            code_outliner = CodeOutliner(workers=outline_settings.get("workers", 1))
+        attachment_registry = AttachmentRegistry(
+            upload_store,
+            extractor=document_extractor,
+            max_text_chars=attachment_settings.get("max_text_chars", 20000),
+            cache_entries=attachment_settings.get("cache_entries", 64),
+            retriever=document_index,
+            retrieval_min_chars=retrieval_settings.get("min_chars", 8000),
+            retrieval_top_k=retrieval_settings.get("top_k", 5),
+            summarizer=table_summarizer,
+            outliner=code_outliner,
+            outline_min_chars=outline_settings.get("min_chars", 6000),
+            max_expanded_chars=outline_settings.get("max_expanded_chars", 12000),
+        )
+        image_settings = config.get("image_preprocessing", {})
+        if image_settings.get("enabled", True):
+            image_preprocessor = ImagePreprocessor(
+                max_dimension=image_settings.get("max_dimension", 1568),
+                jpeg_quality=image_settings.get("jpeg_quality", 85),
+                workers=image_settings.get("workers", 2),
+                cache_entries=image_settings.get("cache_entries", 128),
+            )
+
+        resumable_settings = config.get("file_upload", {}).get("resumable", {})
+        resumable_uploads = ResumableUploadManager(
+            UPLOAD_RESUMABLE_DIR,
+            max_size_bytes=resumable_settings.get("max_size_mb", 200) * 1024 * 1024,
+            max_chunk_bytes=resumable_settings.get("max_chunk_mb", 8) * 1024 * 1024,
+            ttl_seconds=resumable_settings.get("ttl_hours", 24) * 3600,
+        )
+
+        url_settings = config.get("file_upload", {}).get("url_fetch", {})
+        if url_settings.get("enabled", True):
+            url_fetcher = UrlFetcher(
+                UPLOAD_DIR,
+                UPLOAD_URL_CACHE_FILE,
+                max_redirects=url_settings.get("max_redirects", 5),
+                timeout_seconds=url_settings.get("timeout_seconds", 30.0),
+                connect_timeout_seconds=url_settings.get("connect_timeout_seconds", 10.0),
+                max_connections=url_settings.get("max_connections", 20),
+                max_keepalive_connections=url_settings.get("max_keepalive_connections", 10),
+                allow_private_networks=url_settings.get("allow_private_networks", False),
+                cache_entries=url_settings.get("cache_entries", 1000),
+                cache_flush_delay=url_settings.get("cache_flush_seconds", 1.0),
+                chunk_size=config.get("file_upload", {}).get("chunk_size_kb", 1024) * 1024,
+            )
+
         logger.debug("2. Groq API キーを環境変数から取得しています (GROQ_API_KEY)...")
         api_key = os.environ.get("GROQ_API_KEY")
         if not api_key:
@@ -107,9 +413,10 @@ async def startup_event():
         logger.debug("   API キー取得完了。")
 
         logger.debug("3. Groq クライアントを初期化しています...")
-        groq_client = Groq(api_key=api_key)
+        groq_client = create_groq_client(api_key, config.get("groq_client", {}))
         try:
-            groq_client.models.list()
+            live_models = await list_groq_models(groq_client)
+            update_model_catalog(live_models)
             logger.info("   Groq クライアント初期化および接続テスト完了。")
         except AuthenticationError as auth_err:
             logger.error(f"致命的エラー: Groq API 認証エラー (起動時): {auth_err}")
@@ -125,6 +432,16 @@ async def startup_event():
              logger.exception("Groq クライアント初期化中のエラー詳細:")
              logger.debug("   サーバーは起動を続行しますが、API呼び出しは失敗する可能性があります。")
 
+        logger.debug("4. Groq ファイルアップロードのワーカーを起動しています...")
+        groq_upload_queue = GroqUploadQueue(
+            upload_store,
+            upload_entry_to_groq,
+            workers=config.get("file_upload", {}).get("groq_upload_workers", 2),
+        )
+        groq_upload_queue.start()
+        resumed = await groq_upload_queue.resume_unfinished()
+        if resumed:
+            logger.info(f"   前回完了しなかった Groq へのアップロード {resumed} 件を再開しました。")
 
         logger.info("--- Application Startup Complete ---")
 
@@ -136,12 +453,52 @@ async def startup_event():
         logger.exception("予期せぬ起動時エラーの詳細:")
         raise RuntimeError(f"予期せぬ起動時エラー: {e}") from e
 
+# --- Shutdown Event Handler ---
+@app.on_event("shutdown")
+async def shutdown_event():
+    """
+    アプリケーション終了時に共有 Groq クライアントの接続プールを閉じる。
+    """
+    global groq_client
+    if groq_upload_queue:
+        await groq_upload_queue.stop()
+    if upload_store:
+        await upload_store.close()
+    if image_preprocessor:
+        image_preprocessor.shutdown()
+    if document_extractor:
+        document_extractor.shutdown()
+    if table_summarizer:
+        table_summarizer.shutdown()
+    if code_outliner:
+        code_outliner.shutdown()
+    if url_fetcher:
+        await url_fetcher.close()
+    if groq_client:
+        await groq_client.close()
+        groq_client = None
+        logger.info("Groq クライアントの接続プールを閉じました。")
+
 
 # --- Pydantic Models ---
 class MessageContentPart(BaseModel):
     type: str
     text: Optional[str] = None
+    # {"url": "data:..."} のほか、multipart リクエストでは {"part": "<画像パート名>"} で同じリクエストの画像を参照できる
     image_url: Optional[Dict[str, str]] = None
+    # type が "attachment" の場合の添付 ID (アップロードの upload_id)。上流へ送る直前に内容へ展開される
+    attachment_id: Optional[str] = None
+    # 表形式 (CSV / JSON) の添付で [開始, 終了) の行番号 (0 始まり) を指定すると、サマリーの代わりにその範囲の行を展開する
+    rows: Optional[Tuple[int, int]] = None
+    # ソースコードの添付で本体を展開するシンボル名 ("関数名" または "クラス名.メソッド名")。省略時はアウトラインのみ
+    symbols: Optional[List[str]] = None
+
+    @model_validator(mode="after")
+    def require_attachment_id(self) -> "MessageContentPart":
+        """ 添付参照パートには attachment_id が必須 (無い場合は展開時の KeyError ではなく 422 にする)。 """
+        if self.type == ATTACHMENT_PART_TYPE and not self.attachment_id:
+            raise ValueError("type が 'attachment' のパートには attachment_id が必要です。")
+        return self
 
 class Message(BaseModel):
     role: str
@@ -153,6 +510,10 @@ class ChatRequest(BaseModel):
     model_name: Optional[str] = None
     temperature: Optional[float] = None
     max_completion_tokens: Optional[int] = None
+    stream: Optional[bool] = None
+    # サーバー側セッション: history_hash を伴う場合 messages は新しいターンのみ
+    session_id: Optional[str] = None
+    history_hash: Optional[str] = None
 
 class ToolCallFunction(BaseModel):
     name: str
@@ -173,6 +534,8 @@ class ChatResponse(BaseModel):
     reasoning: Optional[Any] = None
     tool_calls: Optional[List[ToolCall]] = None
     executed_tools: Optional[List[ExecutedToolModel]] = None
+    session_id: Optional[str] = None
+    history_hash: Optional[str] = None
 
 class ModelListResponse(BaseModel):
     models: List[str]
@@ -181,9 +544,472 @@ class MetapromptRequest(BaseModel):
     task: str
     variables: Optional[List[str]] = None
 
+    @model_validator(mode="after")
+    def normalize(self) -> "MetapromptRequest":
+        """ キャッシュキーとメタプロンプトが同じ値を使うよう、タスクと変数名はここで一度だけ正規化する。 """
+        self.task = self.task.replace("\r\n", "\n").strip()
+        if self.variables is not None:
+            self.variables = [variable.strip().upper() for variable in self.variables]
+        return self
+
 class MetapromptResponse(BaseModel):
     prompt: str
 
+class MetapromptBatchRequest(BaseModel):
+    items: List[MetapromptRequest]
+
+class MetapromptBatchResult(BaseModel):
+    index: int
+    task: str
+    prompt: Optional[str] = None
+    cached: bool = False
+    error: Optional[str] = None
+
+class ResumableUploadRequest(BaseModel):
+    filename: str
+    size_bytes: int
+    content_type: Optional[str] = None
+    sha256: Optional[str] = None
+
+# --- Chat Helper Functions ---
+def format_sse(event: str, data: Any) -> str:
+    """ Server-Sent Events 形式の 1 イベント分の文字列を生成する。 """
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+def fit_messages_to_context(
+    messages: List[Dict[str, Any]],
+    model_name: str,
+    max_completion_tokens: int,
+    chat_settings: Dict[str, Any],
+    estimate_attachment: Optional[Callable[[Dict[str, Any]], Tuple[int, bool]]] = None,
+) -> List[Dict[str, Any]]:
+    """
+    モデルのコンテキスト長から補完トークン数と安全マージンを引いた予算に履歴を収める。
+    古い画像・推論ブロック・メッセージの順に削り、それでも収まらない場合は上流を呼ばずに 400 を返す。
+    estimate_attachment を渡すと、展開前の添付参照パートをその見積もりで数える。
+    """
+    context_window = chat_settings.get("context_windows", {}).get(model_name, chat_settings.get("default_context_window", 8192))
+    budget_tokens = context_window - max_completion_tokens - chat_settings.get("context_safety_margin_tokens", 256)
+    try:
+        result = compact_history(messages, budget_tokens, chat_settings.get("estimated_tokens_per_image", 1000), estimate_attachment)
+    except HistoryTooLargeError as e:
+        logger.warning(f"チャット履歴がコンテキスト長に収まりません: {model_name} (必要: {e.required_tokens}, 予算: {e.budget_tokens})")
+        raise HTTPException(
+            status_code=400,
+            detail=f"メッセージが長すぎます。モデル '{model_name}' の入力上限 (約 {max(e.budget_tokens, 0)} トークン) に収まりません (推定 {e.required_tokens} トークン)。",
+        )
+    if result.compacted:
+        logger.info(
+            f"チャット履歴を圧縮しました: {result.original_tokens} -> {result.tokens} トークン "
+            f"(画像 {result.images_dropped}, 推論 {result.reasoning_dropped}, メッセージ {result.messages_dropped} 件を削除)"
+        )
+    return result.messages
+
+def latest_user_query(messages: List[Dict[str, Any]]) -> Optional[str]:
+    """ 最後のユーザーメッセージのテキスト部分を返す (長い添付文書から抜粋する際の検索クエリ)。 """
+    for message in reversed(messages):
+        if message.get("role") != "user":
+            continue
+        content = message.get("content")
+        if isinstance(content, str):
+            return content or None
+        if isinstance(content, list):
+            text = "\n".join(part["text"] for part in content if part.get("type") == "text" and part.get("text"))
+            return text or None
+        return None
+    return None
+
+async def expand_attachments(messages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    添付参照パートを画像の data URL や文書のテキストに展開する。見つからない添付は 400。
+    長い文書は最新のユーザーの質問に関連する部分だけに絞り込まれる。
+    """
+    if attachment_registry is None:
+        return messages
+    try:
+        return await attachment_registry.expand_messages(messages, query=latest_user_query(messages))
+    except AttachmentNotFoundError as e:
+        logger.warning(f"添付ファイルが見つかりません: {e.attachment_id}")
+        raise HTTPException(status_code=400, detail=f"添付ファイル '{e.attachment_id}' が見つかりません。再度アップロードしてください。")
+
+async def build_chat_params(request: ChatRequest, chat_settings: Dict[str, Any], history: Optional[List[Dict[str, Any]]] = None) -> Dict[str, Any]:
+    """
+    ChatRequest と設定値から Groq chat.completions.create に渡すパラメータを組み立てる。
+    history にはサーバー側セッションに保存された過去の履歴を渡す (リクエストのメッセージの前に連結する)。
+    履歴・リクエストの添付参照はここで展開するため、セッションには参照だけが保存される。
+    履歴は展開前に添付ごとの見積もりで予算に収め、残ったメッセージの添付だけを展開する
+    (展開後の実際の大きさで見積もりを超えた場合は、もう一度圧縮する)。
+    システムプロンプトはクライアント側で指定されていない場合のみ先頭に付与する。
+    """
+    model_name = request.model_name or chat_settings.get("model_name", "meta-llama/llama-4-scout-17b-16e-instruct")
+    available_model_ids = chat_settings.get("available_model_ids", [])
+    if available_model_ids and model_name not in available_model_ids:
+        logger.warning(f"許可されていないモデルが指定されました: {model_name}")
+        raise HTTPException(status_code=400, detail=f"モデル '{model_name}' は利用できません。")
+
+    messages = (history or []) + [message.model_dump(exclude_none=True) for message in request.messages]
+    if not any(message["role"] == "system" for message in messages):
+        system_prompt = chat_settings.get("system_prompt", DEFAULT_SYSTEM_PROMPT)
+        messages.insert(0, {"role": "system", "content": system_prompt})
+
+    max_completion_tokens = request.max_completion_tokens or chat_settings.get("max_completion_tokens", 8192)
+    if attachment_registry is not None:
+        image_tokens = chat_settings.get("estimated_tokens_per_image", 1000)
+        messages = fit_messages_to_context(
+            messages, model_name, max_completion_tokens, chat_settings,
+            lambda part: attachment_registry.estimate_part(part, image_tokens),
+        )
+    messages = await expand_attachments(messages)
+    messages = fit_messages_to_context(messages, model_name, max_completion_tokens, chat_settings)
+
+    params: Dict[str, Any] = {
+        "model": model_name,
+        "messages": messages,
+        "temperature": request.temperature if request.temperature is not None else chat_settings.get("temperature", 0.6),
+        "top_p": chat_settings.get("top_p", 0.95),
+        "max_completion_tokens": max_completion_tokens,
+    }
+    if model_name in chat_settings.get("reasoning_supported_models", []):
+        params["reasoning_format"] = chat_settings.get("reasoning_format", "parsed")
+    return params
+
+def build_chat_response(completion) -> ChatResponse:
+    """ 非ストリーミングの Groq 応答を ChatResponse に変換する。 """
+    message = completion.choices[0].message
+    tool_calls = None
+    if message.tool_calls:
+        tool_calls = [
+            ToolCall(type=tc.type, function=ToolCallFunction(name=tc.function.name, arguments=tc.function.arguments))
+            for tc in message.tool_calls
+        ]
+    executed_tools = None
+    if getattr(message, "executed_tools", None):
+        executed_tools = [ExecutedToolModel(**tool.model_dump()) for tool in message.executed_tools]
+    return ChatResponse(
+        content=message.content or "",
+        reasoning=getattr(message, "reasoning", None),
+        tool_calls=tool_calls,
+        executed_tools=executed_tools,
+    )
+
+def commit_chat_turn(session_turn: Optional[Dict[str, Any]], assistant_content: str) -> Optional[str]:
+    """
+    成功したターン (リクエストのメッセージ + アシスタントの応答) をセッションに確定し、新しい履歴ハッシュを返す。
+    セッションを使わないリクエスト、または並行するターンと競合した場合は None を返す。
+    """
+    if session_turn is None or chat_sessions is None:
+        return None
+    new_messages = session_turn["messages"] + [{"role": "assistant", "content": assistant_content}]
+    history_hash = chat_sessions.commit(session_turn["session_id"], session_turn["base_hash"], new_messages)
+    if history_hash is None:
+        logger.warning(f"チャットセッション {session_turn['session_id']} は並行するターンで更新されたため、このターンを保存しませんでした。")
+    return history_hash
+
+async def stream_chat_events(params: Dict[str, Any], session_turn: Optional[Dict[str, Any]] = None) -> AsyncIterator[str]:
+    """
+    Groq のストリーミング応答を SSE イベントに変換するジェネレータ。
+    イベント種別: content / reasoning / tool_call / executed_tool / usage / session / error
+    """
+    try:
+        stream = await create_chat_completion(groq_client, **params, stream=True, timeout=groq_call_timeout("chat"))
+        finish_reason = None
+        usage = None
+        content_parts: List[str] = []
+        async for chunk in stream:
+            x_groq = getattr(chunk, "x_groq", None)
+            if x_groq is not None and x_groq.usage is not None:
+                usage = x_groq.usage.model_dump()
+            if not chunk.choices:
+                continue
+            choice = chunk.choices[0]
+            delta = choice.delta
+            if getattr(delta, "reasoning", None):
+                yield format_sse("reasoning", {"delta": delta.reasoning})
+            if delta.content:
+                content_parts.append(delta.content)
+                yield format_sse("content", {"delta": delta.content})
+            if delta.tool_calls:
+                for tool_call in delta.tool_calls:
+                    yield format_sse("tool_call", tool_call.model_dump(exclude_none=True))
+            for executed_tool in getattr(delta, "executed_tools", None) or []:
+                tool_data = executed_tool if isinstance(executed_tool, dict) else executed_tool.model_dump()
+                yield format_sse("executed_tool", ExecutedToolModel(**tool_data).model_dump())
+            if choice.finish_reason:
+                finish_reason = choice.finish_reason
+        yield format_sse("usage", {"usage": usage, "finish_reason": finish_reason})
+        if session_turn is not None:
+            history_hash = commit_chat_turn(session_turn, "".join(content_parts))
+            yield format_sse("session", {"session_id": session_turn["session_id"], "history_hash": history_hash})
+    except RateLimitError as e:
+        logger.warning(f"Groq API レート制限 (チャット ストリーミング): {e}")
+        yield format_sse("error", {"detail": "Groq API のレート制限に達しました。しばらくしてから再試行してください。", "status_code": 429})
+    except GroqError as e:
+        logger.error(f"Groq API エラー (チャット ストリーミング): {e}")
+        yield format_sse("error", {"detail": f"チャット応答の生成中にGroq APIエラーが発生しました: {e}"})
+    except Exception as e:
+        logger.error(f"チャット ストリーミング中に予期せぬエラーが発生しました: {type(e).__name__} - {e}")
+        logger.exception("チャット ストリーミングエラーの詳細:")
+        yield format_sse("error", {"detail": "チャット応答の生成中に予期せぬエラーが発生しました。"})
+
+def decode_image_data_url(url: str) -> Optional[tuple[bytes, str]]:
+    """ base64 の画像 data URL を (バイト列, Content-Type) に分解する。該当しない場合は None。 """
+    header, separator, payload = url.partition(",")
+    if not separator or not header.startswith("data:image/") or not header.endswith(";base64"):
+        return None
+    try:
+        return base64.b64decode(payload, validate=True), header[len("data:"):-len(";base64")]
+    except ValueError:
+        return None
+
+async def preprocess_image(data: bytes, content_type: str) -> tuple[bytes, str]:
+    """ 画像の縮小・再圧縮が有効なら適用する (image_preprocessing 設定)。 """
+    if image_preprocessor is None:
+        return data, content_type
+    return await image_preprocessor.process(data, content_type)
+
+async def parse_multipart_chat_request(http_request: Request, request_json: str) -> tuple[ChatRequest, Dict[str, UploadFile]]:
+    """
+    /api/chat/multipart のリクエストを ChatRequest と画像パートに分解する。
+    "request" フィールドが ChatRequest の JSON で、それ以外のファイルパートが画像として扱われる。
+    JSON の検証エラーは JSON ルートと同じく 422 で返す。
+    """
+    try:
+        request = ChatRequest.model_validate_json(request_json)
+    except ValidationError as e:
+        raise RequestValidationError(e.errors())
+    # フォームは "request" フィールドの解析時に読み込み済みのため、ここでは再読み込みされない
+    form = await http_request.form()
+    image_parts = {name: value for name, value in form.multi_items() if not isinstance(value, str)}
+    return request, image_parts
+
+async def register_image(data: bytes, filename: str, content_type: str) -> str:
+    """
+    チャットに添付された画像を縮小・再圧縮してアップロードストアに登録し、添付 ID を返す。
+    添付 ID は元画像の SHA-256 のため、同じ画像の 2 回目以降は縮小処理も省略される。
+    """
+    sha256 = hashlib.sha256(data).hexdigest()
+    if upload_store.get(sha256) is None:
+        data, content_type = await preprocess_image(data, content_type)
+    await attachment_registry.register_bytes(sha256, data, filename, content_type)
+    return sha256
+
+async def resolve_image_parts(messages: List[Message], image_parts: Dict[str, UploadFile], chat_settings: Dict[str, Any]) -> None:
+    """
+    {"part": 名前} で参照された画像パートと、JSON で送られた data URL の画像を
+    アップロードストアに登録し、添付参照パート ({"type": "attachment", "attachment_id": ...}) に置き換える。
+    セッションには参照だけが保存され、data URL への展開は上流に送る直前に 1 度だけ行われる。
+    """
+    max_image_bytes = chat_settings.get("max_image_mb", 4) * 1024 * 1024
+    for message in messages:
+        if not isinstance(message.content, list):
+            continue
+        for part in message.content:
+            if part.type != "image_url" or not part.image_url:
+                continue
+            part_name = part.image_url.get("part")
+            if part_name is None:
+                decoded = decode_image_data_url(part.image_url.get("url", ""))
+                if decoded is None:
+                    continue
+                image_data, image_type = decoded
+                if len(image_data) > max_image_bytes:
+                    raise HTTPException(status_code=413, detail=f"画像が大きすぎます。最大 {max_image_bytes // (1024 * 1024)}MB までです。")
+                attachment_id = await register_image(image_data, f"image{mimetypes.guess_extension(image_type) or ''}", image_type)
+            else:
+                image = image_parts.get(part_name)
+                if image is None:
+                    raise HTTPException(status_code=400, detail=f"画像パート '{part_name}' がリクエストに含まれていません。")
+                if not (image.content_type or "").startswith("image/"):
+                    raise HTTPException(status_code=415, detail=f"画像パート '{part_name}' は画像ではありません ({image.content_type})。")
+                if image.size is not None and image.size > max_image_bytes:
+                    raise HTTPException(status_code=413, detail=f"画像 '{image.filename}' が大きすぎます。最大 {max_image_bytes // (1024 * 1024)}MB までです。")
+                await image.seek(0)
+                attachment_id = await register_image(await image.read(), Path(image.filename or part_name).name, image.content_type)
+            part.type = ATTACHMENT_PART_TYPE
+            part.image_url = None
+            part.attachment_id = attachment_id
+
+# --- Chat Endpoint ---
+@app.post("/api/chat", response_model=ChatResponse)
+async def chat(request: ChatRequest):
+    """
+    チャット応答を生成するエンドポイント。
+    config.json の main_chat.stream (またはリクエストの stream) が有効な場合は
+    text/event-stream でトークン単位に応答を返し、無効な場合は ChatResponse を返す。
+    画像をバイナリのまま送る場合は /api/chat/multipart を使う。
+    """
+    return await handle_chat(request, {})
+
+@app.post("/api/chat/multipart", response_model=ChatResponse)
+async def chat_multipart(http_request: Request, request: str = Form(..., description="ChatRequest の JSON")):
+    """
+    画像をバイナリのまま送る multipart/form-data 版の /api/chat。
+    "request" フィールドに ChatRequest の JSON を入れ、画像は image_url.part で参照するファイルパートとして送る。
+    """
+    chat_request, image_parts = await parse_multipart_chat_request(http_request, request)
+    return await handle_chat(chat_request, image_parts)
+
+async def handle_chat(request: ChatRequest, image_parts: Dict[str, UploadFile]):
+    """ /api/chat と /api/chat/multipart の共通処理。 """
+    global groq_client, config
+
+    if not groq_client:
+        logger.error("Groq クライアントが利用できません。")
+        raise HTTPException(status_code=503, detail="Groq クライアントが利用できません。サーバーが正しく起動していない可能性があります。")
+
+    purpose = request.purpose or "main_chat"
+    if purpose not in CHAT_PURPOSES:
+        logger.warning(f"未対応の purpose が指定されました: {purpose}")
+        raise HTTPException(status_code=400, detail=f"purpose には次のいずれかを指定してください: {', '.join(sorted(CHAT_PURPOSES))}")
+    chat_settings = config.get(purpose) or config.get("main_chat", {})
+    await resolve_image_parts(request.messages, image_parts, chat_settings)
+
+    # サーバー側セッション: history_hash があればセッションの履歴に新しいターンをつなげる
+    history = None
+    session_turn = None
+    if request.session_id and chat_sessions is not None:
+        if request.history_hash:
+            session = chat_sessions.get(request.session_id)
+            if session is None or session.history_hash != request.history_hash:
+                logger.info(f"チャットセッション {request.session_id} の履歴が一致しません。クライアントに再同期を要求します。")
+                return JSONResponse(
+                    status_code=409,
+                    content={"detail": "サーバー側の会話履歴と一致しません。履歴全体を再送信してください。", "resync": True},
+                )
+            history = session.messages
+        session_turn = {
+            "session_id": request.session_id,
+            "base_hash": request.history_hash,
+            "messages": [message.model_dump(exclude_none=True) for message in request.messages],
+        }
+
+    params = await build_chat_params(request, chat_settings, history)
+    stream = request.stream if request.stream is not None else chat_settings.get("stream", False)
+
+    logger.info(f"チャットリクエスト受信。モデル: {params['model']}, メッセージ数: {len(params['messages'])}, ストリーミング: {stream}")
+
+    if stream:
+        return StreamingResponse(
+            stream_chat_events(params, session_turn),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
+
+    try:
+        if params["temperature"] == 0:
+            # 決定的な呼び出しは同時に届いた同一リクエストと上流呼び出しを共有する
+            completion = await chat_flights.do(
+                make_cache_key(params),
+                lambda: create_chat_completion(groq_client, **params, timeout=groq_call_timeout("chat")),
+            )
+        else:
+            completion = await create_chat_completion(groq_client, **params, timeout=groq_call_timeout("chat"))
+        chat_response = build_chat_response(completion)
+        if session_turn is not None:
+            chat_response.session_id = request.session_id
+            chat_response.history_hash = commit_chat_turn(session_turn, chat_response.content)
+        return chat_response
+    except BadRequestError as e:
+        logger.error(f"Groq API リクエストエラー (チャット): {e}")
+        raise HTTPException(status_code=400, detail=f"チャットリクエストが不正です: {e}")
+    except RateLimitError as e:
+        logger.warning(f"Groq API レート制限 (チャット): {e}")
+        raise HTTPException(status_code=429, detail="Groq API のレート制限に達しました。しばらくしてから再試行してください。")
+    except GroqError as e:
+        logger.error(f"Groq API エラー (チャット): {e}")
+        raise HTTPException(status_code=500, detail=f"チャット応答の生成中にGroq APIエラーが発生しました: {e}")
+    except Exception as e:
+        logger.error(f"チャット応答の生成中に予期せぬエラーが発生しました: {type(e).__name__} - {e}")
+        logger.exception("チャットエラーの詳細:")
+        raise HTTPException(status_code=500, detail="チャット応答の生成中に予期せぬエラーが発生しました。")
+
+# --- Model Catalog Cache ---
+def update_model_catalog(live_models) -> List[str]:
+    """
+    Groq の models.list() の結果と main_chat.available_model_ids の共通部分で
+    モデルカタログのキャッシュを更新し、ETag と有効期限を付け直す。
+    live_models が None の場合は設定値のみを短い TTL で保持する (Groq 未接続時のフォールバック)。
+    """
+    chat_settings = config.get("main_chat", {})
+    catalog_settings = config.get("model_catalog", {})
+    available_model_ids = chat_settings.get("available_model_ids", [])
+
+    if live_models is None:
+        models = list(available_model_ids)
+        ttl_seconds = catalog_settings.get("fallback_ttl_seconds", 30)
+    else:
+        live_model_ids = {model.id for model in live_models.data}
+        models = [model_id for model_id in available_model_ids if model_id in live_model_ids]
+        ttl_seconds = catalog_settings.get("ttl_seconds", 300)
+
+    model_catalog["models"] = models
+    model_catalog["etag"] = '"' + hashlib.sha256(json.dumps(models).encode("utf-8")).hexdigest()[:32] + '"'
+    model_catalog["expires_at"] = time.monotonic() + ttl_seconds
+    logger.debug(f"モデルカタログを更新しました: {models} (TTL: {ttl_seconds}秒)")
+    return models
+
+async def refresh_model_catalog() -> None:
+    """
+    Groq からモデル一覧を取得してカタログを更新する。
+    取得に失敗した場合、既存のキャッシュがあればそれを使い続ける。
+    """
+    try:
+        live_models = await list_groq_models(groq_client)
+        update_model_catalog(live_models)
+    except GroqError as e:
+        logger.warning(f"Groq API からのモデル一覧取得に失敗しました: {e}")
+        if model_catalog["models"] is None:
+            update_model_catalog(None)
+    except Exception as e:
+        logger.error(f"モデル一覧の更新中に予期せぬエラーが発生しました: {type(e).__name__} - {e}")
+        logger.exception("モデル一覧更新エラーの詳細:")
+        if model_catalog["models"] is None:
+            update_model_catalog(None)
+
+async def get_model_catalog() -> Dict[str, Any]:
+    """
+    キャッシュ済みのモデルカタログを返す (stale-while-revalidate)。
+    キャッシュが空の場合のみ Groq の応答を待ち、期限切れの場合は古い値を即座に返しつつ
+    バックグラウンドで 1 つだけ更新タスクを走らせる。同時に発生した更新は 1 回の呼び出しにまとめる。
+    """
+    global model_catalog_refresh_task
+
+    if model_catalog["models"] is None:
+        await model_list_flights.do("models", refresh_model_catalog)
+    elif time.monotonic() >= model_catalog["expires_at"]:
+        if model_catalog_refresh_task is None or model_catalog_refresh_task.done():
+            logger.debug("モデルカタログの有効期限切れ。バックグラウンドで更新します。")
+            model_catalog_refresh_task = asyncio.create_task(model_list_flights.do("models", refresh_model_catalog))
+    return model_catalog
+
+# --- Models Endpoint ---
+@app.get("/api/models", response_model=ModelListResponse)
+async def list_models(request: Request, response: Response):
+    """
+    利用可能なモデル ID の一覧を返すエンドポイント。
+    メモリ上のキャッシュから応答し、ETag / Cache-Control でブラウザ側の再検証を可能にする。
+    """
+    if not groq_client:
+        logger.error("Groq クライアントが利用できません。")
+        raise HTTPException(status_code=503, detail="Groq クライアントが利用できません。サーバーが正しく起動していない可能性があります。")
+
+    catalog = await get_model_catalog()
+    catalog_settings = config.get("model_catalog", {})
+    cache_headers = {
+        "ETag": catalog["etag"],
+        "Cache-Control": (
+            f"public, max-age={catalog_settings.get('browser_max_age_seconds', 60)}, "
+            f"stale-while-revalidate={catalog_settings.get('ttl_seconds', 300)}"
+        ),
+    }
+
+    if_none_match = request.headers.get("if-none-match", "")
+    if catalog["etag"] in [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]:
+        return Response(status_code=304, headers=cache_headers)
+
+    response.headers.update(cache_headers)
+    return ModelListResponse(models=catalog["models"])
+
 # --- Metaprompt Generation Helper Functions ---
 def extract_between_tags(tag: str, string: str, strip: bool = False) -> list[str]:
     ext_list = re.findall(f"<{tag}>(.+?)</{tag}>", string, re.DOTALL)
@@ -218,38 +1044,16 @@ def extract_prompt(metaprompt_response):
 
 
 def extract_variables(prompt_text: str) -> set[str]:
-    pattern = r'\{\$([^}]+)\}'
-    variables = re.findall(pattern, prompt_text)
-    return set(variables)
-
-def find_free_floating_variables(prompt_text: str) -> list[str]:
-    variable_usages = re.findall(r'\{\$[A-Z0-9_]+\}', prompt_text)
-
-    free_floating_variables = []
-    for variable in variable_usages:
-        preceding_text = prompt_text[:prompt_text.index(variable)]
-        open_tags = set()
-
-        i = 0
-        while i < len(preceding_text):
-            if preceding_text[i] == '<':
-                if i + 1 < len(preceding_text) and preceding_text[i + 1] == '/':
-                    closing_tag = preceding_text[i + 2:].split('>', 1)[0]
-                    open_tags.discard(closing_tag)
-                    i += len(closing_tag) + 3
-                else:
-                    opening_tag = preceding_text[i + 1:].split('>', 1)[0]
-                    open_tags.add(opening_tag)
-                    i += len(opening_tag) + 2
-            else:
-                i += 1
+    return {usage.name for usage in scan_prompt(prompt_text).variables if not usage.nested}
 
-        if not open_tags:
-            free_floating_variables.append(variable)
+def find_free_floating_variable_usages(prompt_text: str) -> list[VariableUsage]:
+    """ どのタグにも囲まれていない変数の出現を、繰り返しも含めてオフセット付きで返す。 """
+    return [usage for usage in scan_prompt(prompt_text).variables if usage.is_free_floating]
 
-    return free_floating_variables
+def find_free_floating_variables(prompt_text: str) -> list[str]:
+    return [usage.text for usage in find_free_floating_variable_usages(prompt_text)]
 
-async def remove_inapt_floating_variables(prompt_text: str, client: Groq, model_name: str) -> str:
+async def remove_inapt_floating_variables(prompt_text: str, client: AsyncGroq, model_name: str) -> str:
     remove_floating_variables_prompt_content = """I will give you a prompt template with one or more usages of variables (capitalized words between curly braces with a dollar sign). Some of these usages are erroneous and should be replaced with the unadorned variable name (possibly with minor cosmetic changes to the sentence). What does it mean for a usage to be "erroneous"? It means that when the variable is replaced by its actual value, the sentence would be ungrammatical, nonsensical, or otherwise inappropriate.
 
 For example, take this prompt:
@@ -438,14 +1242,19 @@ Then, rewrite the prompt. Adapt each inapt variable use according to the remedy
 
 Important rule: Your rewritten prompt must always include each variable at least once. If there is a variable for which all usages are inapt, introduce the variable at the beginning in an XML-tagged block, analogous to some of the usages in the examples above."""
 
-    message = await client.chat.completions.create(
+    message = await create_chat_completion(
+        client,
         model=model_name,
         messages=[{'role': "user", "content": remove_floating_variables_prompt_content.replace("{$PROMPT}", prompt_text)}],
         max_tokens=4096,
-        temperature=0
+        temperature=0,
+        timeout=groq_call_timeout("metaprompt"),
     )
     return extract_between_tags("rewritten_prompt", message.choices[0].message.content)[0]
 
+# メタプロンプト生成の停止シーケンス (extract_prompt は最初の <Instructions> ブロックのみ使用する)
+METAPROMPT_STOP_SEQUENCE = "</Instructions>"
+
 # prompt_generator/prompt_generator.py から抽出したメタプロンプト文字列
 METAPROMPT_TEXT = '''Today you will be writing instructions to an eager, helpful, but inexperienced and unworldly AI assistant who needs careful instruction and examples to understand how best to behave. I will explain a task to you. You will write instructions that will direct the assistant on how best to accomplish the task consistently, accurately, and correctly. Here are some examples of tasks and instructions.
 
@@ -1008,69 +1817,202 @@ if variable_string:
 # print("Llama's output on your prompt:\n\n")
 # pretty_print(message)
 
-@app.post("/api/generate-metaprompt", response_model=MetapromptResponse)
-async def generate_metaprompt(request: MetapromptRequest):
-    global groq_client, config
-    
-    if not groq_client:
-        logger.error("Groq クライアントが利用できません。")
-        raise HTTPException(status_code=503, detail="Groq クライアントが利用できません。サーバーが正しく起動していない可能性があります。")
-
+def metaprompt_cache_key(task: str, variables: Optional[List[str]], model_name: str, temperature: float, max_tokens: int) -> str:
+    """
+    メタプロンプト生成結果のキャッシュキーを計算する。
+    タスクと変数名は MetapromptRequest で正規化済みのものを受け取り、生成設定とメタプロンプト本文のハッシュを含める。
+    """
+    return make_cache_key({
+        "task": task,
+        "variables": variables or [],
+        "model_name": model_name,
+        "temperature": temperature,
+        "max_tokens": max_tokens,
+        "metaprompt": hashlib.sha256(METAPROMPT_TEXT.encode("utf-8")).hexdigest(),
+    })
+
+def get_metaprompt_settings() -> tuple[str, float, int]:
+    """ config.json の metaprompt セクションからモデル名・温度・最大トークン数を取得する。 """
     metaprompt_settings = config.get("metaprompt", {})
     model_name = metaprompt_settings.get("model_name", "meta-llama/llama-4-scout-17b-16e-instruct")
     temperature = metaprompt_settings.get("temperature", 0.0)
     max_tokens = metaprompt_settings.get("max_tokens", 4096)
+    return model_name, temperature, max_tokens
+
+def build_metaprompt_messages(task: str, variables: Optional[List[str]]) -> List[Dict[str, str]]:
+    """ タスクと変数からメタプロンプト生成用のメッセージ (user + assistant の書き出し) を組み立てる。 """
+    variable_string = ""
+    if variables:
+        for variable in variables:
+            variable_string += "\n{$" + variable + "}"
+
+    prompt_for_llm = METAPROMPT_TEXT.replace("{{TASK}}", task)
+    assistant_partial = "<Inputs>"
+    if variable_string:
+        assistant_partial += variable_string + "\n</Inputs>\n<Instructions Structure>"
+
+    return [
+        {
+            "role": "user",
+            "content": prompt_for_llm
+        },
+        {
+            "role": "assistant",
+            "content": assistant_partial
+        }
+    ]
 
-    logger.info(f"メタプロンプト生成リクエスト受信。タスク: '{request.task[:50]}...'")
-    logger.debug(f"使用モデル: {model_name}, 温度: {temperature}, 最大トークン: {max_tokens}")
+async def finalize_prompt_template(raw_response_content: str, model_name: str) -> str:
+    """ LLM の出力から <Instructions> を抽出し、浮動変数があれば除去したテンプレートを返す。 """
+    # 生成されたプロンプトテンプレートの抽出
+    extracted_prompt_template = extract_prompt(raw_response_content)
 
-    try:
-        # メタプロンプトの準備
-        task_content = request.task
-        variable_string = ""
-        if request.variables:
-            for variable in request.variables:
-                variable_string += "\n{$" + variable.upper() + "}"
-        
-        prompt_for_llm = METAPROMPT_TEXT.replace("{{TASK}}", task_content)
-        assistant_partial = "<Inputs>"
-        if variable_string:
-            assistant_partial += variable_string + "\n</Inputs>\n<Instructions Structure>"
-
-        messages_for_llm = [
-            {
-                "role": "user",
-                "content": prompt_for_llm
-            },
-            {
-                "role": "assistant",
-                "content": assistant_partial
-            }
-        ]
+    # 浮動変数の除去 (オプション)
+    floating_variables = find_free_floating_variables(extracted_prompt_template)
+    if floating_variables:
+        logger.info(f"浮動変数を検出しました: {floating_variables}。除去を試みます。")
+        extracted_prompt_template = await remove_inapt_floating_variables(extracted_prompt_template, groq_client, model_name)
+        logger.info("浮動変数の除去完了。")
+
+    return extracted_prompt_template
 
-        logger.debug("Groq API (メタプロンプト生成) 呼び出し中...")
-        completion = await groq_client.chat.completions.create(
+async def generate_prompt_template(task: str, variables: Optional[List[str]], model_name: str, temperature: float, max_tokens: int) -> str:
+    """
+    メタプロンプトを使って LLM にプロンプトテンプレートを生成させ、
+    <Instructions> の抽出と浮動変数の除去まで行った結果を返す。
+    extract_prompt は最初の <Instructions> しか使わないため、閉じタグを停止シーケンスにして生成を打ち切る。
+    """
+    logger.debug("Groq API (メタプロンプト生成) 呼び出し中...")
+    completion = await create_chat_completion(
+        groq_client,
+        model=model_name,
+        max_tokens=max_tokens,
+        messages=build_metaprompt_messages(task, variables),
+        temperature=temperature,
+        stop=[METAPROMPT_STOP_SEQUENCE],
+        timeout=groq_call_timeout("metaprompt"),
+    )
+    logger.debug("Groq API (メタプロンプト生成) 呼び出し完了。")
+
+    raw_response_content = completion.choices[0].message.content or ""
+    # 停止シーケンスは出力に含まれないため、抽出できるよう閉じタグを補う
+    if completion.choices[0].finish_reason == "stop" and METAPROMPT_STOP_SEQUENCE not in raw_response_content:
+        raw_response_content += METAPROMPT_STOP_SEQUENCE
+
+    return await finalize_prompt_template(raw_response_content, model_name)
+
+async def stream_metaprompt_events(request: MetapromptRequest) -> AsyncIterator[str]:
+    """
+    メタプロンプト生成をストリーミングし、SSE イベントに変換するジェネレータ。
+    イベント種別: instructions (生成途中の <Instructions> 本文) / prompt (最終結果) / error
+    </Instructions> を受信した時点で上流のストリームを閉じ、残りの生成を打ち切る。
+    """
+    model_name, temperature, max_tokens = get_metaprompt_settings()
+
+    cache_key = None
+    if metaprompt_cache is not None and temperature == 0:
+        cache_key = metaprompt_cache_key(request.task, request.variables, model_name, temperature, max_tokens)
+        cached = await metaprompt_cache.get(cache_key)
+        if cached is not None:
+            logger.info(f"メタプロンプトキャッシュにヒットしました (キー: {cache_key[:12]})。")
+            yield format_sse("prompt", {"prompt": cached["prompt"], "cached": True})
+            return
+
+    try:
+        extractor = TagStreamExtractor("Instructions")
+        finish_reason = None
+        stream = await create_chat_completion(
+            groq_client,
             model=model_name,
             max_tokens=max_tokens,
-            messages=messages_for_llm,
-            temperature=temperature
+            messages=build_metaprompt_messages(request.task, request.variables),
+            temperature=temperature,
+            stop=[METAPROMPT_STOP_SEQUENCE],
+            stream=True,
+            timeout=groq_call_timeout("metaprompt"),
         )
-        logger.debug("Groq API (メタプロンプト生成) 呼び出し完了。")
+        try:
+            async for chunk in stream:
+                if not chunk.choices:
+                    continue
+                finish_reason = chunk.choices[0].finish_reason or finish_reason
+                if not chunk.choices[0].delta.content:
+                    continue
+                partial_instructions = extractor.feed(chunk.choices[0].delta.content)
+                if partial_instructions:
+                    yield format_sse("instructions", {"delta": partial_instructions})
+                if extractor.closed:
+                    logger.debug("</Instructions> を受信したため、メタプロンプト生成のストリームを打ち切ります。")
+                    break
+        finally:
+            await stream.close()
+
+        raw_response_content = extractor.text
+        if not extractor.closed and finish_reason == "stop":
+            raw_response_content += METAPROMPT_STOP_SEQUENCE
+        prompt_template = await finalize_prompt_template(raw_response_content, model_name)
+
+        # 空の結果 (抽出の失敗など) はキャッシュせず、次回は生成し直す
+        if cache_key is not None and prompt_template:
+            await metaprompt_cache.set(cache_key, {"prompt": prompt_template})
+        yield format_sse("prompt", {"prompt": prompt_template, "cached": False})
+
+    except RateLimitError as e:
+        logger.warning(f"Groq API レート制限 (メタプロンプト ストリーミング): {e}")
+        yield format_sse("error", {"detail": "Groq API のレート制限に達しました。しばらくしてから再試行してください。", "status_code": 429})
+    except GroqError as e:
+        logger.error(f"Groq API エラー (メタプロンプト ストリーミング): {e}")
+        yield format_sse("error", {"detail": f"メタプロンプト生成中にGroq APIエラーが発生しました: {e}"})
+    except Exception as e:
+        logger.error(f"メタプロンプト ストリーミング中に予期せぬエラーが発生しました: {type(e).__name__} - {e}")
+        logger.exception("メタプロンプト ストリーミングエラーの詳細:")
+        yield format_sse("error", {"detail": "メタプロンプト生成中に予期せぬエラーが発生しました。"})
+
+async def get_or_generate_prompt_template(request: MetapromptRequest) -> tuple[str, bool]:
+    """
+    キャッシュを確認し、なければ生成してキャッシュに格納する。
+    戻り値は (プロンプトテンプレート, キャッシュヒットかどうか)。
+    """
+    model_name, temperature, max_tokens = get_metaprompt_settings()
+    logger.debug(f"使用モデル: {model_name}, 温度: {temperature}, 最大トークン: {max_tokens}")
+
+    # 温度 0 の生成は決定的とみなせるため、同一リクエストの結果を再利用する
+    cache_key = metaprompt_cache_key(request.task, request.variables, model_name, temperature, max_tokens)
+    use_cache = metaprompt_cache is not None and temperature == 0
+    if use_cache:
+        cached = await metaprompt_cache.get(cache_key)
+        if cached is not None:
+            logger.info(f"メタプロンプトキャッシュにヒットしました (キー: {cache_key[:12]})。")
+            return cached["prompt"], True
+
+    async def generate_and_store() -> str:
+        prompt_template = await generate_prompt_template(request.task, request.variables, model_name, temperature, max_tokens)
+        # 空の結果 (抽出の失敗など) はキャッシュせず、次回は生成し直す
+        if use_cache and prompt_template:
+            await metaprompt_cache.set(cache_key, {"prompt": prompt_template})
+        return prompt_template
+
+    # 同じタスクが同時に送られた場合 (複数ユーザーや再試行) は 1 回の生成結果を共有する
+    prompt_template = await metaprompt_flights.do(cache_key, generate_and_store)
+    return prompt_template, False
 
-        raw_response_content = completion.choices[0].message.content
+@app.post("/api/generate-metaprompt", response_model=MetapromptResponse)
+async def generate_metaprompt(request: MetapromptRequest):
+    global groq_client, config
+    
+    if not groq_client:
+        logger.error("Groq クライアントが利用できません。")
+        raise HTTPException(status_code=503, detail="Groq クライアントが利用できません。サーバーが正しく起動していない可能性があります。")
 
-        # 生成されたプロンプトテンプレートの抽出
-        extracted_prompt_template = extract_prompt(raw_response_content)
-        
-        # 浮動変数の除去 (オプション)
-        floating_variables = find_free_floating_variables(extracted_prompt_template)
-        if floating_variables:
-            logger.info(f"浮動変数を検出しました: {floating_variables}。除去を試みます。")
-            extracted_prompt_template = await remove_inapt_floating_variables(extracted_prompt_template, groq_client, model_name)
-            logger.info("浮動変数の除去完了。")
+    logger.info(f"メタプロンプト生成リクエスト受信。タスク: '{request.task[:50]}...'")
 
+    try:
+        extracted_prompt_template, _ = await get_or_generate_prompt_template(request)
         return MetapromptResponse(prompt=extracted_prompt_template)
 
+    except RateLimitError as e:
+        logger.warning(f"Groq API レート制限 (メタプロンプト生成): {e}")
+        raise HTTPException(status_code=429, detail="Groq API のレート制限に達しました。しばらくしてから再試行してください。")
     except GroqError as e:
         logger.error(f"Groq API エラー (メタプロンプト生成): {e}")
         raise HTTPException(status_code=500, detail=f"メタプロンプト生成中にGroq APIエラーが発生しました: {e}")
@@ -1079,21 +2021,342 @@ async def generate_metaprompt(request: MetapromptRequest):
         logger.exception("メタプロンプト生成エラーの詳細:")
         raise HTTPException(status_code=500, detail=f"メタプロンプト生成中に予期せぬエラーが発生しました。")
 
+async def run_metaprompt_batch_item(index: int, item: MetapromptRequest, semaphore: asyncio.Semaphore) -> MetapromptBatchResult:
+    """ バッチの 1 件を同時実行数の上限内で生成する。失敗はその項目のエラーとして返す。 """
+    async with semaphore:
+        try:
+            prompt_template, cached = await get_or_generate_prompt_template(item)
+            return MetapromptBatchResult(index=index, task=item.task, prompt=prompt_template, cached=cached)
+        except RateLimitError as e:
+            logger.warning(f"Groq API レート制限 (メタプロンプト バッチ #{index}): {e}")
+            return MetapromptBatchResult(index=index, task=item.task, error="Groq API のレート制限に達しました。")
+        except GroqError as e:
+            logger.error(f"Groq API エラー (メタプロンプト バッチ #{index}): {e}")
+            return MetapromptBatchResult(index=index, task=item.task, error=f"Groq APIエラー: {e}")
+        except Exception as e:
+            logger.error(f"メタプロンプト バッチ #{index} の生成中に予期せぬエラーが発生しました: {type(e).__name__} - {e}")
+            logger.exception("メタプロンプト バッチエラーの詳細:")
+            return MetapromptBatchResult(index=index, task=item.task, error="予期せぬエラーが発生しました。")
+
+async def stream_metaprompt_batch(items: List[MetapromptRequest], concurrency: int) -> AsyncIterator[str]:
+    """
+    バッチの各項目を並行に生成し、完了した順に NDJSON の 1 行として返すジェネレータ。
+    クライアントが切断した場合は未完了のタスクをキャンセルする。
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    tasks = [asyncio.create_task(run_metaprompt_batch_item(index, item, semaphore)) for index, item in enumerate(items)]
+    try:
+        for next_result in asyncio.as_completed(tasks):
+            result = await next_result
+            yield result.model_dump_json() + "\n"
+    finally:
+        for task in tasks:
+            task.cancel()
+
+@app.post("/api/generate-metaprompt/batch")
+async def generate_metaprompt_batch(request: MetapromptBatchRequest):
+    """
+    複数タスクのメタプロンプトを一括生成するエンドポイント。
+    metaprompt.batch_concurrency 件まで並行に実行し、完了した順に
+    MetapromptBatchResult を NDJSON (application/x-ndjson) で返す。
+    """
+    if not groq_client:
+        logger.error("Groq クライアントが利用できません。")
+        raise HTTPException(status_code=503, detail="Groq クライアントが利用できません。サーバーが正しく起動していない可能性があります。")
+
+    metaprompt_settings = config.get("metaprompt", {})
+    max_items = metaprompt_settings.get("batch_max_items", 100)
+    concurrency = metaprompt_settings.get("batch_concurrency", 4)
+    if not request.items:
+        raise HTTPException(status_code=400, detail="items を 1 件以上指定してください。")
+    if len(request.items) > max_items:
+        raise HTTPException(status_code=400, detail=f"バッチの項目数が多すぎます。最大 {max_items} 件までです。")
+
+    logger.info(f"メタプロンプト バッチ生成リクエスト受信。件数: {len(request.items)}, 同時実行数: {concurrency}")
+    return StreamingResponse(
+        stream_metaprompt_batch(request.items, concurrency),
+        media_type="application/x-ndjson",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+@app.post("/api/generate-metaprompt/stream")
+async def generate_metaprompt_stream(request: MetapromptRequest):
+    """
+    メタプロンプト生成のストリーミング版。
+    生成途中の <Instructions> を SSE で逐次送り、最後に整形済みのテンプレートを prompt イベントで返す。
+    """
+    if not groq_client:
+        logger.error("Groq クライアントが利用できません。")
+        raise HTTPException(status_code=503, detail="Groq クライアントが利用できません。サーバーが正しく起動していない可能性があります。")
+
+    logger.info(f"メタプロンプト生成 (ストリーミング) リクエスト受信。タスク: '{request.task[:50]}...'")
+    return StreamingResponse(
+        stream_metaprompt_events(request),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
 # --- File Upload Endpoint ---
-from fastapi import Form
+async def stream_upload_to_temp(file: UploadFile, max_size_bytes: int, chunk_size: int) -> tuple[Path, str, int]:
+    """
+    アップロードされたファイルを固定サイズのチャンクで UPLOAD_DIR 内の一時ファイルへ書き出す。
+    書き込みと同時に SHA-256 を計算し、上限を超えた時点で一時ファイルを削除して 413 を返す。
+    戻り値は (一時ファイルのパス, SHA-256, バイト数)。
+
+    UploadFile は Starlette がマルチパートを解析してボディ全体をスプールした後に渡されるため、
+    ここでの上限確認はストアに保存するファイルのサイズの検証であり、受信の打ち切りにはならない。
+    受信中の打ち切りは BodySizeLimitMiddleware が行う (その上限は request_body_limit が
+    file_upload.max_size_mb から求めるため、ここでの上限と揃う)。
+    """
+    temp_path = UPLOAD_DIR / f".upload-{uuid.uuid4().hex}.part"
+    digest = hashlib.sha256()
+    size_bytes = 0
+    try:
+        async with aiofiles.open(temp_path, "wb") as buffer:
+            while True:
+                chunk = await file.read(chunk_size)
+                if not chunk:
+                    break
+                size_bytes += len(chunk)
+                if size_bytes > max_size_bytes:
+                    logger.warning(f"ファイルサイズ超過: {file.filename} ({size_bytes} bytes 以上 > {max_size_bytes} bytes)")
+                    raise HTTPException(
+                        status_code=413,
+                        detail=f"ファイルサイズが大きすぎます。最大 {max_size_bytes // (1024 * 1024)}MB までです。"
+                    )
+                digest.update(chunk)
+                await buffer.write(chunk)
+    except BaseException:
+        temp_path.unlink(missing_ok=True)
+        raise
+    return temp_path, digest.hexdigest(), size_bytes
+
+async def hash_upload(file: UploadFile, max_size_bytes: int, chunk_size: int) -> str:
+    """
+    アップロードされたファイルを書き出さずに読み、SHA-256 を返す (読み終えたら先頭に戻す)。
+    クライアントが送ったハッシュを検証するために使い、上限を超えた場合は 413 を返す。
+    """
+    digest = hashlib.sha256()
+    size_bytes = 0
+    while True:
+        chunk = await file.read(chunk_size)
+        if not chunk:
+            break
+        size_bytes += len(chunk)
+        if size_bytes > max_size_bytes:
+            logger.warning(f"ファイルサイズ超過: {file.filename} ({size_bytes} bytes 以上 > {max_size_bytes} bytes)")
+            raise HTTPException(
+                status_code=413,
+                detail=f"ファイルサイズが大きすぎます。最大 {max_size_bytes // (1024 * 1024)}MB までです。"
+            )
+        digest.update(chunk)
+    await file.seek(0)
+    return digest.hexdigest()
+
+def build_upload_response(filename: str, entry: Dict[str, Any], deduplicated: bool) -> Dict[str, Any]:
+    """ アップロードストアのエントリから /api/upload の応答を組み立てる。 """
+    return {
+        "filename": filename,
+        "saved_path": entry["path"],
+        "groq_file_id": entry["groq_file_id"],
+        "groq_status": groq_status_of(entry),
+        "upload_id": entry["sha256"],
+        "status_url": f"/api/uploads/{entry['sha256']}",
+        "sha256": entry["sha256"],
+        "size_bytes": entry["size_bytes"],
+        "deduplicated": deduplicated,
+        "message": "ファイルが正常にアップロードされました。"
+    }
+
+def build_upload_status(entry: Dict[str, Any]) -> Dict[str, Any]:
+    """ アップロードストアのエントリから Groq へのアップロード状態を組み立てる。 """
+    return {
+        "upload_id": entry["sha256"],
+        "filename": entry["filename"],
+        "groq_status": groq_status_of(entry),
+        "groq_file_id": entry["groq_file_id"],
+        "groq_error": entry.get("groq_error"),
+    }
+
+async def upload_entry_to_groq(entry: Dict[str, Any]) -> str:
+    """
+    ストアのファイルを Groq Files API にアップロードし、file id を返す。
+    GroqUploadQueue のワーカーから呼び出され、失敗時の例外はワーカーが索引に記録する。
+    """
+    filename = entry["filename"]
+    if not groq_client:
+        raise RuntimeError("Groq client が初期化されていません。")
+    try:
+        logger.info(f"Groq API にファイル '{filename}' をアップロードしています...")
+        groq_file_response = await call_groq_with_budget(
+            f"{ENDPOINT_BUDGET_PREFIX}files", 0,
+            lambda: groq_client.files.create(file=(filename, Path(entry["path"])), purpose="assistants", timeout=groq_call_timeout("files")),
+        )
+    except GroqError as ge:
+        logger.error(f"Groq API へのファイルアップロード中に Groq エラーが発生しました ({filename}): {ge}")
+        raise
+    except Exception as e:
+        logger.error(f"Groq API へのファイルアップロード中に予期せぬエラーが発生しました ({filename}): {e}")
+        logger.exception("Groq API ファイルアップロードエラーの詳細:")
+        raise
+    logger.info(f"Groq API へのファイルアップロード成功: {filename}, File ID: {groq_file_response.id}")
+    return groq_file_response.id
+
+async def schedule_groq_upload(entry: Dict[str, Any]) -> None:
+    """
+    Groq へ未アップロードのエントリをバックグラウンドの待ち行列に積む。
+    Groq クライアントが無い場合は skipped として記録する。
+    """
+    if entry["groq_file_id"] or groq_status_of(entry) not in (GROQ_STATUS_SKIPPED, GROQ_STATUS_FAILED):
+        return
+    if not groq_client or groq_upload_queue is None:
+        logger.warning("Groq client が初期化されていないため、Groq API へのファイルアップロードをスキップします。")
+        await upload_store.update(entry["sha256"], groq_status=GROQ_STATUS_SKIPPED)
+        return
+    await groq_upload_queue.submit(entry["sha256"])
+
+async def index_extracted_document(entry: Dict[str, Any], text: str) -> None:
+    """ 抽出が終わった長い文書を BM25 インデックスに登録し、最初のチャットで待たずに検索できるようにする。 """
+    if document_index is None:
+        return
+    min_chars = config.get("attachments", {}).get("retrieval", {}).get("min_chars", 8000)
+    if len(text) > min_chars:
+        await document_index.add_text(entry["sha256"], text)
+        logger.debug(f"文書を検索インデックスに登録しました: {entry['filename']} ({len(text)} 文字)")
+
+async def process_stored_upload(entry: Dict[str, Any]) -> None:
+    """ ストアに入ったファイルのテキスト抽出 (表形式ならサマリー作成) をバックグラウンドで始め、Groq へのアップロードを予約する。 """
+    if table_summarizer is not None and table_summarizer.supports(entry.get("content_type")):
+        table_summarizer.summarize_in_background(entry)
+    elif document_extractor is not None:
+        document_extractor.extract_in_background(entry)
+    await schedule_groq_upload(entry)
+
+async def store_uploaded_file(file: UploadFile, sha256: Optional[str], upload_settings: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    1 ファイルを検証してアップロードストアに保存し、Groq へのアップロードを予約する。
+    検証エラーや保存の失敗は HTTPException として送出する。
+    """
+    max_size_mb = upload_settings.get("max_size_mb", 10)
+    allowed_types = upload_settings.get("allowed_types", [])
+
+    if allowed_types and file.content_type not in allowed_types:
+        logger.warning(f"許可されないファイルタイプ: {file.filename} ({file.content_type})")
+        raise HTTPException(
+            status_code=415,
+            detail=f"許可されていないファイルタイプです。許可されているタイプ: {', '.join(allowed_types)}"
+        )
+
+    max_size_bytes = max_size_mb * 1024 * 1024
+    chunk_size = upload_settings.get("chunk_size_kb", 1024) * 1024
+    claimed_sha256 = sha256.lower() if sha256 else None
+    invalid_sha256 = HTTPException(status_code=400, detail="sha256 がファイルの内容と一致しません。")
+
+    # クライアントが事前にハッシュを計算している場合、登録済みなら本文のハッシュだけを確かめて保存を省略する
+    # (ハッシュを検証せずに返すと、既存のハッシュを知っているだけで他のファイルのエントリを取得できてしまう)
+    if claimed_sha256 and upload_store is not None:
+        entry = upload_store.get(claimed_sha256)
+        if entry is not None:
+            if await hash_upload(file, max_size_bytes, chunk_size) != claimed_sha256:
+                logger.warning(f"クライアントの sha256 がファイルの内容と一致しません: {file.filename} (sha256: {claimed_sha256[:12]})")
+                raise invalid_sha256
+            upload_store.record_hit()
+            logger.info(f"登録済みのファイルです (sha256: {claimed_sha256[:12]})。保存を省略します。")
+            await process_stored_upload(entry)
+            return build_upload_response(file.filename, entry, deduplicated=True)
+
+    temp_path, file_sha256, file_size_bytes = await stream_upload_to_temp(file, max_size_bytes, chunk_size)
+    if claimed_sha256 and claimed_sha256 != file_sha256:
+        temp_path.unlink(missing_ok=True)
+        logger.warning(f"クライアントの sha256 がファイルの内容と一致しません: {file.filename} (sha256: {claimed_sha256[:12]})")
+        raise invalid_sha256
+
+    return await store_temp_file(temp_path, file_sha256, file.filename, file.content_type, file_size_bytes)
+
+async def store_temp_file(temp_path: Path, file_sha256: str, filename: str, content_type: Optional[str], file_size_bytes: int) -> Dict[str, Any]:
+    """
+    一時ファイルに書き出したアップロード (または URL から取得した内容) をストアに取り込み、
+    テキスト抽出と Groq へのアップロードを予約して /api/upload の応答を返す。
+    """
+    try:
+        stored_content_type = content_type
+        if (content_type or "").startswith("image/") and upload_store.get(file_sha256) is None:
+            # 索引のキーは元画像のハッシュのまま (クライアント計算のハッシュで重複判定できるように)、保存するのは縮小後の画像
+            async with aiofiles.open(temp_path, "rb") as f:
+                original = await f.read()
+            processed, stored_content_type = await preprocess_image(original, content_type)
+            if processed is not original:
+                async with aiofiles.open(temp_path, "wb") as f:
+                    await f.write(processed)
+                file_size_bytes = len(processed)
+
+        deduplicated = upload_store.get(file_sha256) is not None
+        entry = await upload_store.put(file_sha256, temp_path, Path(filename).name, stored_content_type, file_size_bytes)
+        if deduplicated:
+            logger.info(f"同じ内容のファイルが登録済みです: {filename} -> {entry['path']} (sha256: {file_sha256[:12]})")
+        else:
+            logger.info(f"ファイルがローカルにアップロードされました: {filename} -> {entry['path']} ({file_size_bytes} bytes, sha256: {file_sha256[:12]})")
+
+        await process_stored_upload(entry)
+
+        return build_upload_response(filename, entry, deduplicated=deduplicated)
+    except Exception as e:
+        temp_path.unlink(missing_ok=True)
+        logger.error(f"ファイルアップロード処理全体でエラーが発生しました ({filename}): {e}")
+        logger.exception("ファイルアップロード処理全体のエラー詳細:")
+        raise HTTPException(status_code=500, detail=f"ファイルアップロード処理中にエラーが発生しました: {e}")
+
+async def store_url(url: str, upload_settings: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    URL の内容を共有の接続プールで取得し、ファイルのアップロードと同じくストアに取り込む。
+    以前に取得した URL は ETag / Last-Modified で再検証し、更新されていなければストアの内容を使う。
+    """
+    if url_fetcher is None:
+        raise HTTPException(status_code=503, detail="URL の取得は無効化されています。")
+    max_size_bytes = upload_settings.get("max_size_mb", 10) * 1024 * 1024
+
+    async def fetch(revalidate: bool):
+        try:
+            return await url_fetcher.fetch(
+                url,
+                max_bytes=max_size_bytes,
+                allowed_types=upload_settings.get("allowed_types", []),
+                is_stored=lambda sha256: upload_store.get(sha256) is not None,
+                revalidate=revalidate,
+            )
+        except UrlFetchError as e:
+            logger.warning(f"URL の取得に失敗しました ({url}): {e.detail}")
+            raise HTTPException(status_code=e.status_code, detail=e.detail)
+
+    fetched = await fetch(revalidate=True)
+    entry = upload_store.get(fetched.sha256) if fetched.not_modified else None
+    if fetched.not_modified and entry is None:
+        # 再検証中にストアのエントリが削除された場合は、条件なしで本文を取得し直す
+        logger.info(f"304 を受けましたがストアにエントリが無いため URL を再取得します: {url}")
+        fetched = await fetch(revalidate=False)
+
+    if fetched.not_modified:
+        upload_store.record_hit()
+        await process_stored_upload(entry)
+        response = build_upload_response(fetched.filename, entry, deduplicated=True)
+    else:
+        response = await store_temp_file(fetched.temp_path, fetched.sha256, fetched.filename, fetched.content_type, fetched.size_bytes)
+    return {**response, "source_url": url, "final_url": fetched.url, "not_modified": fetched.not_modified}
 
 @app.post("/api/upload")
-async def upload_file(file: UploadFile = File(None), url: str = Form(None)):
+async def upload_file(file: UploadFile = File(None), url: str = Form(None), sha256: Optional[str] = Form(None)):
     """
     Handles single file uploads or URL submissions.
-    Saves the file to the UPLOAD_DIR using pathlib and aiofiles.
+    URLs are fetched through a shared connection pool (size-capped, limited redirects,
+    revalidated with ETag/Last-Modified on repeat submissions).
+    Saves the file into the content-addressed upload store (keyed by SHA-256)
+    so identical content is stored and sent to Groq only once.
+    The Groq upload runs in the background; poll status_url for the file id.
     Applies validation for file size and type based on config.json.
     """
     global config
     upload_settings = config.get("file_upload", {})
-    max_size_mb = upload_settings.get("max_size_mb", 10)
-    allowed_types = upload_settings.get("allowed_types", [])
-    
+
     if not file and not url:
         raise HTTPException(status_code=400, detail="ファイルまたはURLを指定してください。")
 
@@ -1101,113 +2364,229 @@ async def upload_file(file: UploadFile = File(None), url: str = Form(None)):
         if not (url.startswith("http://") or url.startswith("https://")):
             logger.warning(f"無効なURL形式です: {url}")
             raise HTTPException(status_code=400, detail="無効なURL形式です。http:// または https:// で始まる必要があります。")
-        
+
         logger.info(f"URLが送信されました: {url}")
-        return {
-            "filename": None,
-            "saved_path": None,
-            "groq_file_id": None,
-            "message": f"URL '{url}' を受信しました。",
-            "url_received": url
-        }
+        return await store_url(url, upload_settings)
 
-    if file:
-        content = await file.read()
-        file_size_bytes = len(content)
-        max_size_bytes = max_size_mb * 1024 * 1024
+    return await store_uploaded_file(file, sha256, upload_settings)
 
-        if file_size_bytes > max_size_bytes:
-            logger.warning(f"ファイルサイズ超過: {file.filename} ({file_size_bytes} bytes > {max_size_bytes} bytes)")
-            raise HTTPException(
-                status_code=413,
-                detail=f"ファイルサイズが大きすぎます。最大 {max_size_mb}MB までです。"
-            )
+@app.post("/api/upload/batch")
+async def upload_files_batch(files: List[UploadFile] = File(...), sha256s: Optional[List[str]] = Form(None)):
+    """
+    Handles many file uploads in a single multipart request.
+    Files are validated and stored concurrently (file_upload.batch_concurrency at a time);
+    the response lists one result per file, in request order, with either the upload
+    details or the error for that file. sha256s may carry precomputed hashes in the same order.
+    """
+    upload_settings = config.get("file_upload", {})
+    max_files = upload_settings.get("batch_max_files", 20)
+    if not files:
+        raise HTTPException(status_code=400, detail="ファイルを指定してください。")
+    if len(files) > max_files:
+        raise HTTPException(status_code=400, detail=f"一度にアップロードできるファイルは最大 {max_files} 件です。")
+    if sha256s and len(sha256s) != len(files):
+        raise HTTPException(status_code=400, detail="sha256s の件数がファイル数と一致しません。")
+
+    semaphore = asyncio.Semaphore(upload_settings.get("batch_concurrency", 4))
+
+    async def store_one(index: int, file: UploadFile) -> Dict[str, Any]:
+        async with semaphore:
+            try:
+                result = await store_uploaded_file(file, sha256s[index] if sha256s else None, upload_settings)
+                return {"index": index, **result}
+            except HTTPException as e:
+                return {"index": index, "filename": file.filename, "status_code": e.status_code, "error": e.detail}
+            except Exception as e:
+                # 1 件の予期せぬ失敗でバッチ全体を 500 にせず、その項目だけを失敗として返す
+                logger.error(f"一括アップロード #{index} ({file.filename}) の保存中に予期せぬエラーが発生しました: {type(e).__name__} - {e}")
+                logger.exception("一括アップロードエラーの詳細:")
+                return {"index": index, "filename": file.filename, "status_code": 500, "error": "ファイルの保存中に予期せぬエラーが発生しました。"}
+
+    results = await asyncio.gather(*(store_one(index, file) for index, file in enumerate(files)))
+    failed = sum(1 for result in results if "error" in result)
+    logger.info(f"一括アップロード完了: {len(results) - failed} 件成功, {failed} 件失敗")
+    return {"results": results, "succeeded": len(results) - failed, "failed": failed}
+
+@app.post("/api/upload/resumable")
+async def create_resumable_upload(request: ResumableUploadRequest):
+    """
+    Starts a resumable chunked upload and returns its upload_id.
+    Send chunks with PUT /api/upload/resumable/{upload_id}?offset=N (chunks may be sent in parallel),
+    query GET /api/upload/resumable/{upload_id} after a dropped connection to see the missing ranges,
+    and complete with POST /api/upload/resumable/{upload_id}/finalize.
+    """
+    allowed_types = config.get("file_upload", {}).get("allowed_types", [])
+    if allowed_types and request.content_type not in allowed_types:
+        logger.warning(f"許可されないファイルタイプ: {request.filename} ({request.content_type})")
+        raise HTTPException(
+            status_code=415,
+            detail=f"許可されていないファイルタイプです。許可されているタイプ: {', '.join(allowed_types)}"
+        )
+    try:
+        state = await resumable_uploads.create(request.filename, request.content_type, request.size_bytes, request.sha256)
+    except ResumableUploadError as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
+    return resumable_uploads.describe(state)
+
+@app.get("/api/upload/resumable/{upload_id}")
+async def get_resumable_upload(upload_id: str):
+    """ 再開可能アップロードの受信済み範囲と未受信範囲を返す。 """
+    try:
+        return resumable_uploads.status(upload_id)
+    except ResumableUploadError as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
 
-        if allowed_types and file.content_type not in allowed_types:
-            logger.warning(f"許可されないファイルタイプ: {file.filename} ({file.content_type})")
-            raise HTTPException(
-                status_code=415,
-                detail=f"許可されていないファイルタイプです。許可されているタイプ: {', '.join(allowed_types)}"
-            )
+@app.put("/api/upload/resumable/{upload_id}")
+async def append_resumable_upload(upload_id: str, offset: int, request: Request):
+    """ リクエストボディ (生のバイト列) を offset の位置に書き込む。 """
+    try:
+        return await resumable_uploads.append(upload_id, offset, request.stream())
+    except ResumableUploadError as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
+
+@app.post("/api/upload/resumable/{upload_id}/finalize")
+async def finalize_resumable_upload(upload_id: str):
+    """
+    全範囲の受信と SHA-256 を検証し、完成したファイルを /api/upload と同じ処理 (画像の前処理を含む) でストアに登録する。
+    応答は /api/upload と同じ形式。同時・再度の finalize には最初の finalize の応答を返す。
+    """
+    async def store(data_path: Path, state: Dict[str, Any], file_sha256: str) -> Dict[str, Any]:
+        logger.info(f"再開可能アップロードの受信が完了しました: {state['filename']} ({state['size_bytes']} bytes, sha256: {file_sha256[:12]})")
+        return await store_temp_file(data_path, file_sha256, state["filename"], state["content_type"], state["size_bytes"])
+
+    try:
+        return await resumable_uploads.finalize(upload_id, store)
+    except ResumableUploadError as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
+
+@app.delete("/api/upload/resumable/{upload_id}")
+async def abort_resumable_upload(upload_id: str):
+    """ 再開可能アップロードを中止し、途中状態を削除する。 """
+    try:
+        resumable_uploads.status(upload_id)
+        await resumable_uploads.discard(upload_id)
+    except ResumableUploadError as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
+    return {"upload_id": upload_id, "message": "アップロードを中止しました。"}
+
+@app.get("/api/uploads/{upload_id}")
+async def get_upload_status(upload_id: str):
+    """ アップロード ID (SHA-256) に対応する Groq へのアップロード状態を返す。 """
+    entry = upload_store.get(upload_id.lower()) if upload_store else None
+    if entry is None:
+        raise HTTPException(status_code=404, detail="指定されたアップロードが見つかりません。")
+    return build_upload_status(entry)
+
+@app.get("/api/uploads/{upload_id}/events")
+async def stream_upload_status(upload_id: str):
+    """
+    Groq へのアップロード状態を Server-Sent Events で通知する。
+    状態が ready / failed / skipped になった時点でストリームを閉じる。
+    """
+    upload_id = upload_id.lower()
+    if not upload_store or upload_store.get(upload_id) is None:
+        raise HTTPException(status_code=404, detail="指定されたアップロードが見つかりません。")
+
+    async def status_events() -> AsyncIterator[str]:
+        last_status = None
+        while True:
+            entry = upload_store.get(upload_id)
+            if entry is None:
+                yield format_sse("error", {"detail": "アップロードされたファイルが削除されました。"})
+                return
+            status = build_upload_status(entry)
+            if status["groq_status"] != last_status:
+                yield format_sse("status", status)
+                last_status = status["groq_status"]
+            if last_status in FINISHED_STATUSES or not groq_upload_queue.is_active(upload_id):
+                return
+            # 状態変化を待つ間も接続が切れないよう定期的にコメント行を送る
+            if not await groq_upload_queue.wait(upload_id, timeout=15):
+                yield ": keep-alive\n\n"
+
+    return StreamingResponse(
+        status_events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
+# --- File Management Utilities (using pathlib) ---
+def remove_old_upload_files(cutoff_time: float) -> Tuple[int, int]:
+    """ cutoff_time より古いアップロードファイル・ディレクトリを削除し、(ファイル数, ディレクトリ数) を返す (同期版)。 """
+    cleaned_files_count = 0
+    cleaned_dirs_count = 0
+    # 索引ファイルと URL キャッシュは残し、コンテンツストアは中のファイル単位で判定する
+    # 再開可能アップロードの途中状態は ResumableUploadManager の有効期限で管理する
+    items = [item for item in UPLOAD_DIR.iterdir() if item not in (UPLOAD_INDEX_FILE, UPLOAD_URL_CACHE_FILE, UPLOAD_STORE_DIR, UPLOAD_RESUMABLE_DIR)]
+    if UPLOAD_STORE_DIR.exists():
+        items += [blob for blob in UPLOAD_STORE_DIR.glob("*/*") if blob.is_file()]
+    for item in items:
         try:
-            file_path = UPLOAD_DIR / file.filename
-            
-            async with aiofiles.open(file_path, 'wb') as buffer:
-                await buffer.write(content)
-            logger.info(f"ファイルがローカルにアップロードされました: {file.filename} -> {file_path}")
-
-            groq_file_id = None
-            if groq_client:
-                try:
-                    logger.info(f"Groq API にファイル '{file.filename}' をアップロードしています...")
-                    with open(file_path, "rb") as f_for_groq:
-                        groq_file_response = groq_client.files.create(file=f_for_groq, purpose="assistants")
-                    
-                    groq_file_id = groq_file_response.id
-                    logger.info(f"Groq API へのファイルアップロード成功: {file.filename}, File ID: {groq_file_id}")
-
-                except GroqError as ge:
-                    logger.error(f"Groq API へのファイルアップロード中に Groq エラーが発生しました ({file.filename}): {ge}")
-                    raise HTTPException(status_code=500, detail=f"Groq API へのファイルアップロードエラー: {ge}")
-                except Exception as e:
-                    logger.error(f"Groq API へのファイルアップロード中に予期せぬエラーが発生しました ({file.filename}): {e}")
-                    logger.exception("Groq API ファイルアップロードエラーの詳細:")
-                    raise HTTPException(status_code=500, detail=f"Groq API へのファイルアップロード中に予期せぬエラー: {e}")
-            else:
-                logger.warning("Groq client が初期化されていないため、Groq API へのファイルアップロードをスキップします。")
-
-            return {
-                "filename": file.filename, 
-                "saved_path": str(file_path),
-                "groq_file_id": groq_file_id,
-                "message": "ファイルが正常にアップロードされました。"
-            }
+            item_stat = item.stat()
+            if item_stat.st_mtime < cutoff_time:
+                if item.is_file():
+                    item.unlink()
+                    logger.debug(f"古いファイルを削除しました: {item}")
+                    cleaned_files_count += 1
+                elif item.is_dir():
+                    import shutil
+                    shutil.rmtree(item)
+                    logger.debug(f"古いディレクトリを削除しました: {item}")
+                    cleaned_dirs_count += 1
+        except FileNotFoundError:
+            logger.warning(f"クリーンアップ中にファイルが見つかりませんでした (おそらく並行して削除された): {item}")
         except Exception as e:
-            logger.error(f"ファイルアップロード処理全体でエラーが発生しました ({file.filename}): {e}")
-            logger.exception("ファイルアップロード処理全体のエラー詳細:")
-            raise HTTPException(status_code=500, detail=f"ファイルアップロード処理中にエラーが発生しました: {e}")
+            logger.error(f"ファイル/ディレクトリ ({item}) のクリーンアップ中にエラー: {e}")
+    return cleaned_files_count, cleaned_dirs_count
 
-# --- File Management Utilities (using pathlib) ---
-def cleanup_old_uploads(days: int = 7):
+async def cleanup_old_uploads(days: int = 7):
     """
     指定された日数より古いアップロードファイルを削除します。
-    この関数は同期的に動作するため、バックグラウンドタスクで実行することを推奨します。
+    ファイルの削除はスレッドで行い、アップロード索引の整理はイベントループ上で索引のロックを取って行います。
     """
-    global config
-    upload_settings = config.get("file_upload", {})
-    
     if not UPLOAD_DIR.exists():
         logger.info(f"アップロードディレクトリ {UPLOAD_DIR} が存在しないため、クリーンアップをスキップします。")
         return
 
     cutoff_time = time.time() - (days * 86400)
-    cleaned_files_count = 0
-    cleaned_dirs_count = 0
 
     logger.info(f"{days}日以上古いファイルのクリーンアップを開始します ({UPLOAD_DIR})...")
     try:
-        for item in UPLOAD_DIR.iterdir():
-            try:
-                item_stat = item.stat()
-                if item_stat.st_mtime < cutoff_time:
-                    if item.is_file():
-                        item.unlink()
-                        logger.debug(f"古いファイルを削除しました: {item}")
-                        cleaned_files_count += 1
-                    elif item.is_dir():
-                        import shutil
-                        shutil.rmtree(item)
-                        logger.debug(f"古いディレクトリを削除しました: {item}")
-                        cleaned_dirs_count += 1
-            except FileNotFoundError:
-                logger.warning(f"クリーンアップ中にファイルが見つかりませんでした (おそらく並行して削除された): {item}")
-            except Exception as e:
-                logger.error(f"ファイル/ディレクトリ ({item}) のクリーンアップ中にエラー: {e}")
+        cleaned_files_count, cleaned_dirs_count = await asyncio.to_thread(remove_old_upload_files, cutoff_time)
+        if resumable_uploads is not None:
+            resumable_uploads.expire_stale()
+        if upload_store is not None:
+            pruned = await upload_store.prune_missing()
+            if attachment_registry is not None:
+                for sha256 in pruned:
+                    attachment_registry.forget(sha256)
+            logger.debug(f"アップロード索引から {len(pruned)} 件のエントリを削除しました。")
         logger.info(f"クリーンアップ完了。削除されたファイル数: {cleaned_files_count}, 削除されたディレクトリ数: {cleaned_dirs_count}")
     except Exception as e:
         logger.error(f"アップロードディレクトリ ({UPLOAD_DIR}) のイテレーション中にエラー: {e}")
 
+# --- Metrics Endpoint ---
+@app.get("/api/metrics")
+async def metrics():
+    """ キャッシュなど内部コンポーネントの統計情報を返す。 """
+    return {
+        "metaprompt_cache": metaprompt_cache.stats() if metaprompt_cache else None,
+        "rate_limits": rate_limiter.stats() if rate_limiter else None,
+        "chat_sessions": chat_sessions.stats() if chat_sessions else None,
+        "upload_store": upload_store.stats() if upload_store else None,
+        "groq_upload_queue": groq_upload_queue.stats() if groq_upload_queue else None,
+        "resumable_uploads": resumable_uploads.stats() if resumable_uploads else None,
+        "image_preprocessing": image_preprocessor.stats() if image_preprocessor else None,
+        "attachments": attachment_registry.stats() if attachment_registry else None,
+        "document_extraction": document_extractor.stats() if document_extractor else None,
+        "table_summary": table_summarizer.stats() if table_summarizer else None,
+        "code_outline": code_outliner.stats() if code_outliner else None,
+        "url_fetch": url_fetcher.stats() if url_fetcher else None,
+        "single_flight": {
+            flights.name: flights.stats() for flights in (model_list_flights, metaprompt_flights, chat_flights)
+        },
+    }
+
 # --- Root Endpoint ---
 @app.get("/")
 async def root():
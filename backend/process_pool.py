@@ -0,0 +1,121 @@
+# d:\Users\onisi\Documents\web-app-dev\backend\process_pool.py
+"""
+CPU 負荷の高い処理 (画像の縮小・テキスト抽出・表の集計など) を実行するプロセスプール。
+
+プールは最初の実行時に作成する。ワーカーが異常終了 (OOM など) するとプール全体が
+BrokenProcessPool になり以降の実行がすべて失敗するため、その場合はプールを破棄して次回に作り直す。
+run_cached は実行結果をアップロードファイルの隣に JSON でキャッシュする (テキスト抽出・表のサマリー・
+ソースコードのアウトラインで共通の失敗時の扱いを持つ)。BackgroundTaskSet はアップロード直後に始める
+これらの処理のタスクを保持する。
+"""
+import json
+import uuid
+import asyncio
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, Optional, Set
+
+import aiofiles
+
+logger = logging.getLogger(__name__)
+
+
+class PoolTaskError(Exception):
+    """ run_cached の処理が失敗した場合に送出される。cached は失敗 (null) をキャッシュしたかどうか。 """
+
+    def __init__(self, cause: BaseException, cached: bool):
+        super().__init__(str(cause))
+        self.cause = cause
+        self.cached = cached
+
+
+class ProcessPoolRunner:
+    """ 遅延作成と異常終了後の作り直しを行う ProcessPoolExecutor のラッパー。 """
+
+    def __init__(self, name: str, workers: int = 1):
+        self.name = name
+        self.workers = workers
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self.restarts = 0
+
+    async def run(self, func: Callable[..., Any], *args: Any) -> Any:
+        """ func(*args) をワーカープロセスで実行して結果を返す。例外はそのまま送出する。 """
+        executor = self._executor
+        if executor is None:
+            executor = self._executor = ProcessPoolExecutor(max_workers=self.workers)
+        try:
+            return await asyncio.get_running_loop().run_in_executor(executor, func, *args)
+        except BrokenProcessPool:
+            # 同時に失敗した他の呼び出しが作り直したプールは破棄しない
+            if self._executor is executor:
+                logger.warning(f"プロセスプール '{self.name}' のワーカーが異常終了しました。次回の実行でプールを作り直します。")
+                self._executor = None
+                self.restarts += 1
+                executor.shutdown(wait=False, cancel_futures=True)
+            raise
+
+    async def run_cached(self, cache_path: Path, label: str, func: Callable[..., Any], *args: Any) -> Any:
+        """
+        func(*args) をワーカープロセスで実行し、結果を JSON で cache_path に書き込んで返す。
+        ワーカーの異常終了やファイルの読み込みエラー (BrokenProcessPool / OSError) は一時的な失敗の可能性があるため、
+        キャッシュせずに PoolTaskError を送出し、次回に再試行させる。それ以外の例外は入力 (ハッシュで固定) が
+        同じ限り毎回失敗するため、null をキャッシュしてから PoolTaskError を送出する。label はログに使う。
+        """
+        try:
+            result = await self.run(func, *args)
+        except (BrokenProcessPool, OSError) as e:
+            logger.warning(f"{label}に失敗しました。次回に再試行します: {type(e).__name__}: {e}")
+            raise PoolTaskError(e, cached=False) from e
+        except Exception as e:
+            logger.warning(f"{label}に失敗しました: {type(e).__name__}: {e}")
+            await write_json_atomic(cache_path, None)
+            raise PoolTaskError(e, cached=True) from e
+        # 処理できなかった場合 (結果が None) もその結果 (null) をキャッシュし、毎回処理し直さないようにする
+        await write_json_atomic(cache_path, result)
+        return result
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {"workers": self.workers, "running": self._executor is not None, "restarts": self.restarts}
+
+
+class BackgroundTaskSet:
+    """ 完了するまで参照を保持し (途中で GC されないように)、失敗をログに残すバックグラウンドタスクの集合。 """
+
+    def __init__(self, label: str):
+        self.label = label
+        self._tasks: Set[asyncio.Task] = set()
+
+    def start(self, coro: Awaitable[Any]) -> None:
+        task = asyncio.ensure_future(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._finish)
+
+    def _finish(self, task: asyncio.Task) -> None:
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"バックグラウンドの{self.label}でエラーが発生しました: {task.exception()}")
+
+    def __len__(self) -> int:
+        return len(self._tasks)
+
+
+async def write_json_atomic(path: Path, value: Any) -> None:
+    """
+    一時ファイルに書いてから置き換え、読み手が書きかけの JSON を読まないようにする。
+    同じファイルへの同時の書き込みが互いの一時ファイルを上書きしないよう、一時ファイル名は書き込みごとに変える。
+    """
+    tmp_path = path.with_name(f"{path.name}.{uuid.uuid4().hex}.tmp")
+    try:
+        async with aiofiles.open(tmp_path, "w", encoding="utf-8") as f:
+            await f.write(json.dumps(value, ensure_ascii=False))
+        tmp_path.replace(path)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
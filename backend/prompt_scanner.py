@@ -0,0 +1,163 @@
+# d:\Users\onisi\Documents\web-app-dev\backend\prompt_scanner.py
+"""
+プロンプトテンプレートの単一パス・スキャナ。
+
+テンプレートを先頭から一度だけ走査し、XML 風タグの開閉と {$VARIABLE} の出現を追跡する。
+main.py の extract_variables / find_free_floating_variables はこの結果を利用する。
+変数名とタグの開閉の扱いは以前の実装に合わせている
+(変数名は "}" 以外の文字列、"<" は常にタグを開き、閉じタグは同名の開きタグをすべて閉じる)。
+ストリーミング応答からタグの中身を逐次取り出す TagStreamExtractor も提供する。
+"""
+import re
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+# 変数 {$NAME} の開始位置。変数の中に入れ子になった "{$" も拾えるよう先読みで名前を取り出す
+VARIABLE_PATTERN = re.compile(r"\{\$(?=([^}]+)\})")
+# 浮動変数の判定対象となる変数名 (大文字・数字・アンダースコアのみ)
+FLOATING_CANDIDATE_PATTERN = re.compile(r"[A-Z0-9_]+")
+
+
+@dataclass(frozen=True)
+class VariableUsage:
+    """ テンプレート中の変数の出現 1 件。 """
+    name: str
+    text: str
+    offset: int
+    enclosing_tags: Tuple[str, ...]
+    # 直前の変数の {$...} の内側から始まる出現 (例: "{$A{$B}" の {$B})
+    nested: bool = False
+
+    @property
+    def is_free_floating(self) -> bool:
+        return not self.enclosing_tags and FLOATING_CANDIDATE_PATTERN.fullmatch(self.name) is not None
+
+
+@dataclass
+class PromptScan:
+    """ scan_prompt の結果。 """
+    text: str
+    variables: List[VariableUsage] = field(default_factory=list)
+
+
+def scan_prompt(text: str) -> PromptScan:
+    """
+    テンプレートを一度だけ走査して変数の出現と、その位置で開いているタグを収集する。
+
+    タグの判定は以前の実装と同じく、"<" を常にタグの開始とみなし、次の ">" までをタグ名とする。
+    そのため "x < 3" のような比較演算子の "<" もタグを開き、後続の変数はタグの内側として扱う。
+    変数より後ろにしか ">" がないタグは、変数の直前までをタグ名として扱う。
+    閉じタグは同名の開きタグをすべて閉じる。対応する閉じタグのない開きタグ
+    (本文中で言及されただけのタグなど) は最後まで開いたまま扱う。
+    """
+    scan = PromptScan(text=text)
+    # 開いているタグ名を開いた順に保持する (dict なので開閉の判定はタグ数によらず O(1))
+    open_tags: Dict[str, None] = {}
+    # 開閉があるまで同じタプルを変数間で共有する
+    enclosing_tags: Optional[Tuple[str, ...]] = ()
+    # 次に "<" を探し始める位置
+    cursor = 0
+    # 開始済みで ">" がまだ変数より前に現れていないタグ: (名前の開始位置, 閉じタグか, ">" の位置)
+    pending: Optional[Tuple[int, bool, int]] = None
+    variables_end = 0
+
+    for match in VARIABLE_PATTERN.finditer(text):
+        offset = match.start()
+
+        # 変数より前で ">" まで確定したタグを反映する
+        while True:
+            if pending is None:
+                tag_start = text.find("<", cursor, offset)
+                if tag_start == -1:
+                    break
+                closing = text.startswith("/", tag_start + 1)
+                name_start = tag_start + (2 if closing else 1)
+                pending = (name_start, closing, text.find(">", name_start))
+            name_start, closing, tag_end = pending
+            if tag_end == -1 or tag_end >= offset:
+                break
+            tag_name = text[name_start:tag_end]
+            if closing:
+                if tag_name in open_tags:
+                    del open_tags[tag_name]
+                    enclosing_tags = None
+            elif tag_name not in open_tags:
+                open_tags[tag_name] = None
+                enclosing_tags = None
+            cursor = tag_end + 1
+            pending = None
+
+        if enclosing_tags is None:
+            enclosing_tags = tuple(open_tags)
+        usage_tags = enclosing_tags
+        if pending is not None:
+            # 変数の直前までをタグ名とした未完了のタグを、この変数に対してだけ適用する
+            name_start, closing, _ = pending
+            partial_name = text[name_start:offset]
+            if closing:
+                if partial_name in open_tags:
+                    usage_tags = tuple(tag for tag in open_tags if tag != partial_name)
+            elif partial_name not in open_tags:
+                usage_tags = enclosing_tags + (partial_name,)
+
+        name = match.group(1)
+        end = match.end(1) + 1
+        scan.variables.append(VariableUsage(
+            name=name,
+            text=text[offset:end],
+            offset=offset,
+            enclosing_tags=usage_tags,
+            nested=offset < variables_end,
+        ))
+        variables_end = max(variables_end, end)
+
+    return scan
+
+
+class TagStreamExtractor:
+    """
+    ストリーミング中のテキストから指定タグの中身を逐次取り出すパーサ。
+
+    feed() には受信したテキスト断片を渡し、新たに確定したタグ内テキストを受け取る。
+    閉じタグの一部かもしれない末尾は次の断片が届くまで保留する。
+    閉じタグを受信すると closed が True になり、以降の入力は無視する。
+    """
+
+    def __init__(self, tag: str):
+        self.open_tag = f"<{tag}>"
+        self.close_tag = f"</{tag}>"
+        self.text = ""
+        self.closed = False
+        self._content_start: Optional[int] = None
+        self._emitted = 0
+
+    def feed(self, delta: str) -> str:
+        if self.closed or not delta:
+            return ""
+        search_from = max(len(self.text) - len(self.open_tag) + 1, 0)
+        self.text += delta
+
+        if self._content_start is None:
+            open_index = self.text.find(self.open_tag, search_from)
+            if open_index == -1:
+                return ""
+            self._content_start = open_index + len(self.open_tag)
+            self._emitted = self._content_start
+
+        close_index = self.text.find(self.close_tag, self._emitted)
+        if close_index != -1:
+            self.closed = True
+            safe_end = close_index
+        else:
+            safe_end = max(len(self.text) - len(self.close_tag) + 1, self._emitted)
+
+        emitted = self.text[self._emitted:safe_end]
+        self._emitted = safe_end
+        return emitted
+
+    @property
+    def content(self) -> str:
+        """ これまでに確定したタグ内テキスト。 """
+        if self._content_start is None:
+            return ""
+        return self.text[self._content_start:self._emitted]
@@ -0,0 +1,223 @@
+# d:\Users\onisi\Documents\web-app-dev\backend\rate_limiter.py
+"""
+Groq API 呼び出しのレート制限スケジューラ。
+
+モデルごとにリクエスト数/分 (RPM) とトークン数/分 (TPM) のトークンバケットを持ち、
+予算を超える呼び出しは FIFO で待たせる。Groq の x-ratelimit-* / retry-after
+レスポンスヘッダを受け取るたびに残量と上限を補正する。
+予約したトークンは応答ヘッダが届くまで「処理中」として数え、Groq の残量からその分を差し引いて反映する
+(Groq がまだ数えていない同時実行中の呼び出しの予約を、ヘッダの残量で打ち消さないため)。
+"""
+import re
+import time
+import asyncio
+import logging
+from dataclasses import dataclass
+from typing import Any, Dict, Mapping, Optional
+
+logger = logging.getLogger(__name__)
+
+# Groq のリセット時間表記 ("2m59.56s", "7.66s", "120ms" など) の 1 単位
+DURATION_PART_PATTERN = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+DURATION_UNIT_SECONDS = {"h": 3600.0, "m": 60.0, "s": 1.0, "ms": 0.001}
+
+
+def parse_reset_duration(value: Optional[str]) -> Optional[float]:
+    """ "1m2.5s" 形式または秒数のみの文字列を秒に変換する。解釈できなければ None。 """
+    if not value:
+        return None
+    value = value.strip()
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = DURATION_PART_PATTERN.findall(value)
+    if not parts:
+        return None
+    return sum(float(amount) * DURATION_UNIT_SECONDS[unit] for amount, unit in parts)
+
+
+def estimate_text_tokens(text: str) -> int:
+    """
+    テキストのトークン数を概算する。
+    ASCII はおよそ 4 文字で 1 トークン、日本語などの非 ASCII 文字は 1 文字 1 トークンとみなす。
+    """
+    if not text:
+        return 0
+    non_ascii = sum(1 for char in text if ord(char) > 127)
+    return (len(text) - non_ascii + 3) // 4 + non_ascii
+
+
+class TokenBucket:
+    """ capacity を上限に、1 分あたり capacity の速度で補充されるバケット。 """
+
+    def __init__(self, capacity: float):
+        self.capacity = float(capacity)
+        self.level = float(capacity)
+        self.updated_at = time.monotonic()
+
+    @property
+    def refill_rate(self) -> float:
+        return self.capacity / 60.0
+
+    def refill(self) -> None:
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated_at) * self.refill_rate)
+        self.updated_at = now
+
+    def wait_time(self, amount: float) -> float:
+        """ amount を消費できるようになるまでの秒数。 """
+        self.refill()
+        amount = min(amount, self.capacity)
+        if self.level >= amount:
+            return 0.0
+        return (amount - self.level) / self.refill_rate
+
+    def consume(self, amount: float) -> None:
+        self.level -= min(amount, self.capacity)
+
+    def resize(self, capacity: float) -> None:
+        self.refill()
+        self.capacity = float(capacity)
+        self.level = min(self.level, self.capacity)
+
+
+class ModelBudget:
+    """ 1 モデル分の RPM / TPM バケットと待ち行列。 """
+
+    def __init__(self, requests_per_minute: int, tokens_per_minute: int):
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.blocked_until = 0.0
+        # 予約済みで、まだ応答ヘッダ (Groq 側の残量) に反映されていないトークン数
+        self.in_flight_tokens = 0.0
+        self.queue_lock = asyncio.Lock()
+        self.queue_depth = 0
+        self.total_requests = 0
+        self.total_wait_seconds = 0.0
+        self.rate_limited_responses = 0
+
+
+@dataclass
+class Reservation:
+    """ acquire() で確保した予算。応答ヘッダを受け取るか呼び出しが終わったら release() する。 """
+    model: str
+    tokens: float
+    waited: float
+    released: bool = False
+
+
+class RateLimitScheduler:
+    """
+    モデルごとの予算に従って Groq 呼び出しを順番待ちさせるスケジューラ。
+    acquire() で予算を確保してから呼び出し、応答ヘッダは予約とともに update_from_headers() に渡す。
+    呼び出しが終わったら (ヘッダを受け取れなかった場合も) release() で予約を処理中から外す。
+    """
+
+    def __init__(self, default_limits: Dict[str, int], model_limits: Optional[Dict[str, Dict[str, int]]] = None):
+        self.default_limits = default_limits
+        self.model_limits = model_limits or {}
+        self._budgets: Dict[str, ModelBudget] = {}
+
+    def _budget(self, model: str) -> ModelBudget:
+        budget = self._budgets.get(model)
+        if budget is None:
+            limits = {**self.default_limits, **self.model_limits.get(model, {})}
+            budget = ModelBudget(limits.get("requests_per_minute", 30), limits.get("tokens_per_minute", 6000))
+            self._budgets[model] = budget
+        return budget
+
+    async def acquire(self, model: str, estimated_tokens: int) -> Reservation:
+        """
+        1 リクエストと estimated_tokens 分の予算を確保する。予算が足りなければ到着順に待つ。
+        戻り値の予約は待機した秒数を持ち、release() するまで処理中のトークンとして数える。
+        """
+        budget = self._budget(model)
+        budget.queue_depth += 1
+        started_at = time.monotonic()
+        try:
+            async with budget.queue_lock:
+                while True:
+                    wait_seconds = max(
+                        budget.blocked_until - time.monotonic(),
+                        budget.requests.wait_time(1),
+                        budget.tokens.wait_time(estimated_tokens),
+                    )
+                    if wait_seconds <= 0:
+                        break
+                    logger.debug(f"レート制限の予算待ち: {model} ({wait_seconds:.2f}秒, 待ち行列: {budget.queue_depth})")
+                    await asyncio.sleep(wait_seconds)
+                budget.requests.consume(1)
+                budget.tokens.consume(estimated_tokens)
+                budget.in_flight_tokens += estimated_tokens
+        finally:
+            budget.queue_depth -= 1
+
+        waited = time.monotonic() - started_at
+        budget.total_requests += 1
+        budget.total_wait_seconds += waited
+        return Reservation(model=model, tokens=float(estimated_tokens), waited=waited)
+
+    def release(self, reservation: Optional[Reservation]) -> None:
+        """ 予約を処理中から外す (Groq 側の残量に反映済み、または呼び出しが終わった)。2 回目以降は何もしない。 """
+        if reservation is None or reservation.released:
+            return
+        reservation.released = True
+        budget = self._budget(reservation.model)
+        budget.in_flight_tokens = max(0.0, budget.in_flight_tokens - reservation.tokens)
+
+    def update_from_headers(self, model: str, headers: Mapping[str, str], status_code: int = 200, reservation: Optional[Reservation] = None) -> None:
+        """
+        Groq のレスポンスヘッダから上限と残量を反映する。残量は見積もりとのずれを補正するため増減どちらにも更新するが、
+        他の処理中の呼び出しの予約分は Groq の残量にまだ含まれていないため差し引く。
+        reservation はこの応答の呼び出しの予約で、Groq が数えたものとして先に処理中から外す。
+        x-ratelimit-limit-tokens は TPM、x-ratelimit-*-requests は日次上限 (RPD) として扱い、
+        日次リクエスト数を使い切った場合はリセットまで呼び出しを止める。
+        """
+        budget = self._budget(model)
+
+        limit_tokens = headers.get("x-ratelimit-limit-tokens")
+        if limit_tokens and limit_tokens.isdigit() and int(limit_tokens) != budget.tokens.capacity:
+            logger.info(f"TPM 上限を更新しました: {model} {budget.tokens.capacity:.0f} -> {limit_tokens}")
+            budget.tokens.resize(int(limit_tokens))
+
+        remaining_tokens = headers.get("x-ratelimit-remaining-tokens")
+        if remaining_tokens and remaining_tokens.isdigit():
+            # 残量は Groq 側の値を正とする (予約した見積もりより実際の消費が少なければ残量は増える)。
+            # ただし処理中の予約はまだ Groq に数えられていないため、その分を残量から差し引く
+            self.release(reservation)
+            budget.tokens.refill()
+            budget.tokens.level = min(budget.tokens.capacity, float(remaining_tokens) - budget.in_flight_tokens)
+
+        if headers.get("x-ratelimit-remaining-requests") == "0":
+            reset_seconds = parse_reset_duration(headers.get("x-ratelimit-reset-requests"))
+            if reset_seconds:
+                budget.blocked_until = max(budget.blocked_until, time.monotonic() + reset_seconds)
+
+        if status_code == 429:
+            budget.rate_limited_responses += 1
+            retry_after = parse_reset_duration(headers.get("retry-after")) or parse_reset_duration(headers.get("x-ratelimit-reset-tokens"))
+            if retry_after:
+                logger.warning(f"Groq API のレート制限に達しました: {model} ({retry_after:.2f}秒後に再開)")
+                budget.blocked_until = max(budget.blocked_until, time.monotonic() + retry_after)
+
+    def stats(self) -> Dict[str, Any]:
+        """ モデルごとの待ち行列の長さと予算の残量を返す。 """
+        now = time.monotonic()
+        stats = {}
+        for model, budget in self._budgets.items():
+            budget.requests.refill()
+            budget.tokens.refill()
+            stats[model] = {
+                "queue_depth": budget.queue_depth,
+                "requests_per_minute": budget.requests.capacity,
+                "requests_available": round(budget.requests.level, 2),
+                "tokens_per_minute": budget.tokens.capacity,
+                "tokens_available": round(budget.tokens.level, 2),
+                "tokens_in_flight": round(budget.in_flight_tokens, 2),
+                "blocked_for_seconds": round(max(budget.blocked_until - now, 0.0), 2),
+                "total_requests": budget.total_requests,
+                "average_wait_seconds": round(budget.total_wait_seconds / budget.total_requests, 3) if budget.total_requests else 0.0,
+                "rate_limited_responses": budget.rate_limited_responses,
+            }
+        return stats
@@ -0,0 +1,144 @@
+# d:\Users\onisi\Documents\web-app-dev\backend\result_cache.py
+"""
+コンテンツアドレス型の結果キャッシュ。
+
+リクエスト内容を正規化した JSON の SHA-256 をキーとし、
+上限付きのインメモリ LRU と、再起動後も残るオプションのディスク層の 2 段構成で値を保持する。
+ディスク層も件数の上限を持ち、超えた分は最も長く使われていないエントリのファイルから削除する。
+値は JSON シリアライズ可能なものに限る。
+"""
+import os
+import json
+import asyncio
+import hashlib
+import logging
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+
+def make_cache_key(payload: Dict[str, Any]) -> str:
+    """ 正規化したペイロードの SHA-256 (16進) をキャッシュキーとして返す。 """
+    canonical = json.dumps(payload, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class ResultCache:
+    """
+    インメモリ LRU + ディスク層の 2 段キャッシュ。
+    disk_dir が None の場合はメモリのみで動作する。
+    """
+
+    def __init__(self, name: str, max_entries: int = 256, disk_dir: Optional[Path] = None, max_disk_entries: int = 4096):
+        self.name = name
+        self.max_entries = max_entries
+        self.disk_dir = disk_dir
+        self.max_disk_entries = max_disk_entries
+        self._entries: "OrderedDict[str, Any]" = OrderedDict()
+        # ディスク層にあるキー (古い順)。起動時にファイルの更新時刻順で復元する
+        self._disk_keys: "OrderedDict[str, None]" = OrderedDict()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.disk_evictions = 0
+        if self.disk_dir is not None:
+            self.disk_dir.mkdir(parents=True, exist_ok=True)
+            self._disk_keys = self._scan_disk()
+            self._evict_disk()
+
+    def _scan_disk(self) -> "OrderedDict[str, None]":
+        files = []
+        for path in self.disk_dir.glob("*/*.json"):
+            try:
+                files.append((path.stat().st_mtime, path.stem))
+            except OSError:
+                continue
+        return OrderedDict((key, None) for _, key in sorted(files))
+
+    def _evict_disk(self) -> None:
+        """ ディスク層の件数が上限を超えていれば、古いエントリのファイルを削除する。 """
+        while len(self._disk_keys) > self.max_disk_entries:
+            key, _ = self._disk_keys.popitem(last=False)
+            try:
+                self._disk_path(key).unlink(missing_ok=True)
+                self.disk_evictions += 1
+            except OSError as e:
+                logger.warning(f"キャッシュ '{self.name}' のディスクエントリを削除できませんでした ({key}): {e}")
+
+    def _disk_path(self, key: str) -> Path:
+        return self.disk_dir / key[:2] / f"{key}.json"
+
+    def _remember(self, key: str, value: Any) -> None:
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _read_disk(self, key: str) -> Optional[Any]:
+        try:
+            with open(self._disk_path(key), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, json.JSONDecodeError) as e:
+            logger.warning(f"キャッシュ '{self.name}' のディスクエントリを読み込めませんでした ({key}): {e}")
+            return None
+
+    def _write_disk(self, key: str, value: Any) -> None:
+        path = self._disk_path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(value, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    async def get(self, key: str) -> Optional[Any]:
+        """ キャッシュされた値を返す。メモリ → ディスクの順に探し、見つからなければ None。 """
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            self.memory_hits += 1
+            return self._entries[key]
+
+        if self.disk_dir is not None:
+            value = await asyncio.to_thread(self._read_disk, key)
+            if value is not None:
+                self.disk_hits += 1
+                if key in self._disk_keys:
+                    self._disk_keys.move_to_end(key)
+                self._remember(key, value)
+                return value
+
+        self.misses += 1
+        return None
+
+    async def set(self, key: str, value: Any) -> None:
+        """ 値をメモリに格納し、ディスク層が有効なら永続化する。 """
+        self._remember(key, value)
+        if self.disk_dir is not None:
+            try:
+                await asyncio.to_thread(self._write_disk, key, value)
+            except OSError as e:
+                logger.warning(f"キャッシュ '{self.name}' のディスク書き込みに失敗しました ({key}): {e}")
+                return
+            self._disk_keys[key] = None
+            self._disk_keys.move_to_end(key)
+            if len(self._disk_keys) > self.max_disk_entries:
+                await asyncio.to_thread(self._evict_disk)
+
+    def stats(self) -> Dict[str, Any]:
+        """ ヒット/ミス数などの統計情報を返す。 """
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0,
+            "disk_enabled": self.disk_dir is not None,
+            "disk_entries": len(self._disk_keys),
+            "max_disk_entries": self.max_disk_entries,
+            "disk_evictions": self.disk_evictions,
+        }
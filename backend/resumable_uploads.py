@@ -0,0 +1,281 @@
+# d:\Users\onisi\Documents\web-app-dev\backend\resumable_uploads.py
+"""
+再開可能なチャンク分割アップロード。
+
+create でファイル全体のサイズを宣言し、append でオフセットを指定してチャンクを書き込み、
+finalize で全範囲の受信と SHA-256 を検証する。途中状態は <root>/<upload_id>/ に
+データファイル (data.part) と受信済み範囲 (state.json) として保存するため、
+接続が切れても受信済みの範囲を問い合わせて続きから送り直せる。
+異なるオフセットのチャンクは並行して書き込める。finalize は書き込み中のチャンクが終わるのを待ってから
+ハッシュを計算し、その間に届いたチャンクは finalize の完了後に判定する (完了していれば 409)。
+finalize の結果は state.json に記録し、同時・再度の finalize には同じ結果を返す
+(完了した途中状態は有効期限が過ぎるまで残る)。
+"""
+import os
+import json
+import time
+import uuid
+import shutil
+import asyncio
+import hashlib
+import logging
+from pathlib import Path
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional
+
+import aiofiles
+
+logger = logging.getLogger(__name__)
+
+STATE_FILE_NAME = "state.json"
+DATA_FILE_NAME = "data.part"
+HASH_READ_SIZE = 1024 * 1024
+
+
+class ResumableUploadError(ValueError):
+    """ 再開可能アップロードの操作が受け付けられない場合に送出される。status_code は HTTP ステータス。 """
+
+    def __init__(self, status_code: int, detail: str):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+
+
+def merge_ranges(ranges: List[List[int]]) -> List[List[int]]:
+    """ [start, end) 範囲のリストを昇順に並べ、重なり・隣接する範囲を結合する。 """
+    merged: List[List[int]] = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+
+def missing_ranges(received: List[List[int]], size_bytes: int) -> List[List[int]]:
+    """ 受信済み範囲 (結合済み) から、未受信の範囲を返す。 """
+    missing = []
+    position = 0
+    for start, end in received:
+        if start > position:
+            missing.append([position, start])
+        position = max(position, end)
+    if position < size_bytes:
+        missing.append([position, size_bytes])
+    return missing
+
+
+def _hash_file(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while True:
+            block = f.read(HASH_READ_SIZE)
+            if not block:
+                break
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class ResumableUploadManager:
+    """ 再開可能アップロードの途中状態をディスク上で管理する。 """
+
+    def __init__(self, root: Path, max_size_bytes: int, max_chunk_bytes: int, ttl_seconds: float):
+        self.root = root
+        self.max_size_bytes = max_size_bytes
+        self.max_chunk_bytes = max_chunk_bytes
+        self.ttl_seconds = ttl_seconds
+        self.root.mkdir(parents=True, exist_ok=True)
+        self._locks: Dict[str, asyncio.Lock] = {}
+        # データファイルへ書き込み中の append の数と、それが 0 になったことを知らせるイベント
+        self._writers: Dict[str, int] = {}
+        self._drained: Dict[str, asyncio.Event] = {}
+        self.completed = 0
+
+    def _upload_dir(self, upload_id: str) -> Path:
+        # upload_id はパスの一部になるため、発行した形式 (16進) 以外は受け付けない
+        if not upload_id or not all(char in "0123456789abcdef" for char in upload_id):
+            raise ResumableUploadError(404, "指定されたアップロードが見つかりません。")
+        return self.root / upload_id
+
+    def _lock(self, upload_id: str) -> asyncio.Lock:
+        return self._locks.setdefault(upload_id, asyncio.Lock())
+
+    def _begin_write(self, upload_id: str) -> None:
+        self._writers[upload_id] = self._writers.get(upload_id, 0) + 1
+        self._drained.setdefault(upload_id, asyncio.Event()).clear()
+
+    def _end_write(self, upload_id: str) -> None:
+        self._writers[upload_id] -= 1
+        if self._writers[upload_id] == 0:
+            del self._writers[upload_id]
+            self._drained.pop(upload_id).set()
+
+    async def _wait_for_writers(self, upload_id: str) -> None:
+        drained = self._drained.get(upload_id)
+        if drained is not None:
+            await drained.wait()
+
+    def _read_state(self, upload_id: str) -> Dict[str, Any]:
+        try:
+            with open(self._upload_dir(upload_id) / STATE_FILE_NAME, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            raise ResumableUploadError(404, "指定されたアップロードが見つかりません。")
+
+    def _write_state(self, state: Dict[str, Any]) -> None:
+        upload_dir = self._upload_dir(state["upload_id"])
+        tmp_path = upload_dir / f"{STATE_FILE_NAME}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(state, f, ensure_ascii=False)
+        os.replace(tmp_path, upload_dir / STATE_FILE_NAME)
+
+    def describe(self, state: Dict[str, Any]) -> Dict[str, Any]:
+        """ クライアントに返す状態 (受信済み・未受信の範囲など)。 """
+        received = state["received"]
+        return {
+            "upload_id": state["upload_id"],
+            "filename": state["filename"],
+            "size_bytes": state["size_bytes"],
+            "bytes_received": sum(end - start for start, end in received),
+            "received": received,
+            "missing": missing_ranges(received, state["size_bytes"]),
+            "max_chunk_bytes": self.max_chunk_bytes,
+            "finalized": state.get("result") is not None,
+        }
+
+    def expire_stale(self) -> int:
+        """ 有効期限を過ぎた途中状態を削除し、その件数を返す。 """
+        cutoff = time.time() - self.ttl_seconds
+        expired = 0
+        for upload_dir in self.root.iterdir():
+            try:
+                if upload_dir.is_dir() and upload_dir.stat().st_mtime < cutoff:
+                    shutil.rmtree(upload_dir)
+                    self._locks.pop(upload_dir.name, None)
+                    expired += 1
+            except FileNotFoundError:
+                continue
+        # discard で削除済みのアップロードのロックもここで片付ける
+        for upload_id in list(self._locks):
+            if not self._locks[upload_id].locked() and not (self.root / upload_id).exists():
+                del self._locks[upload_id]
+        if expired:
+            logger.info(f"期限切れの再開可能アップロード {expired} 件を削除しました。")
+        return expired
+
+    async def create(self, filename: str, content_type: Optional[str], size_bytes: int, sha256: Optional[str]) -> Dict[str, Any]:
+        """ 新しいアップロードを開始し、データファイルを宣言されたサイズで確保する。 """
+        if size_bytes <= 0:
+            raise ResumableUploadError(400, "size_bytes は 1 以上である必要があります。")
+        if size_bytes > self.max_size_bytes:
+            raise ResumableUploadError(413, f"ファイルサイズが大きすぎます。最大 {self.max_size_bytes // (1024 * 1024)}MB までです。")
+
+        await asyncio.to_thread(self.expire_stale)
+        upload_id = uuid.uuid4().hex
+        upload_dir = self._upload_dir(upload_id)
+        upload_dir.mkdir()
+        with open(upload_dir / DATA_FILE_NAME, "wb") as f:
+            f.truncate(size_bytes)
+
+        state = {
+            "upload_id": upload_id,
+            "filename": Path(filename).name,
+            "content_type": content_type,
+            "size_bytes": size_bytes,
+            "sha256": sha256.lower() if sha256 else None,
+            "received": [],
+            "created_at": time.time(),
+        }
+        self._write_state(state)
+        logger.info(f"再開可能アップロードを開始しました: {state['filename']} ({size_bytes} bytes, id: {upload_id})")
+        return state
+
+    def status(self, upload_id: str) -> Dict[str, Any]:
+        return self.describe(self._read_state(upload_id))
+
+    async def append(self, upload_id: str, offset: int, chunks: AsyncIterator[bytes]) -> Dict[str, Any]:
+        """
+        offset からチャンクを書き込み、受信済み範囲に加える。
+        書き込みは並行して行い、開始時の完了確認と状態ファイルの更新だけをアップロードごとに直列化する。
+        開始時の確認をロックの下で行うため、finalize の実行中に届いたチャンクは finalize の完了を待つ。
+        """
+        async with self._lock(upload_id):
+            state = self._read_state(upload_id)
+            if state.get("result") is not None:
+                raise ResumableUploadError(409, "このアップロードは完了しています。")
+            size_bytes = state["size_bytes"]
+            if offset < 0 or offset >= size_bytes:
+                raise ResumableUploadError(416, f"offset は 0 以上 {size_bytes} 未満である必要があります。")
+            self._begin_write(upload_id)
+
+        written = 0
+        try:
+            async with aiofiles.open(self._upload_dir(upload_id) / DATA_FILE_NAME, "r+b") as data_file:
+                await data_file.seek(offset)
+                async for chunk in chunks:
+                    written += len(chunk)
+                    if written > self.max_chunk_bytes:
+                        raise ResumableUploadError(413, f"チャンクが大きすぎます。最大 {self.max_chunk_bytes} bytes までです。")
+                    if offset + written > size_bytes:
+                        raise ResumableUploadError(416, "チャンクが宣言されたファイルサイズを超えています。")
+                    await data_file.write(chunk)
+        except FileNotFoundError:
+            # 状態を読んだ後に破棄 (discard) または有効期限切れで削除された
+            raise ResumableUploadError(404, "指定されたアップロードが見つかりません。")
+        finally:
+            self._end_write(upload_id)
+        if written == 0:
+            raise ResumableUploadError(400, "チャンクが空です。")
+
+        async with self._lock(upload_id):
+            state = self._read_state(upload_id)
+            state["received"] = merge_ranges(state["received"] + [[offset, offset + written]])
+            try:
+                await asyncio.to_thread(self._write_state, state)
+            except FileNotFoundError:
+                raise ResumableUploadError(404, "指定されたアップロードが見つかりません。")
+        return self.describe(state)
+
+    async def finalize(self, upload_id: str, store: Callable[[Path, Dict[str, Any], str], Awaitable[Dict[str, Any]]]) -> Dict[str, Any]:
+        """
+        全範囲を受信済みか確認し、SHA-256 を検証して store(データファイルのパス, 状態, SHA-256) に渡す。
+        store はデータファイルを取り込んで (移動して) 応答を返す。その応答を記録し、
+        同時・再度の finalize では store を呼ばずに同じ応答を返す。
+        ハッシュの計算前に、書き込み中のチャンクが終わるのを待つ。
+        """
+        async with self._lock(upload_id):
+            state = self._read_state(upload_id)
+            if state.get("result") is not None:
+                return state["result"]
+            # 受信済みの範囲への再送がデータファイルを書き換えている最中かもしれない
+            await self._wait_for_writers(upload_id)
+            missing = missing_ranges(state["received"], state["size_bytes"])
+            if missing:
+                raise ResumableUploadError(409, f"未受信の範囲があります: {missing[:5]}")
+
+            data_path = self._upload_dir(upload_id) / DATA_FILE_NAME
+            sha256 = await asyncio.to_thread(_hash_file, data_path)
+            if state["sha256"] and state["sha256"] != sha256:
+                # 壊れたデータで再送を続けても完成しないため、途中状態は破棄する
+                await self.discard(upload_id)
+                raise ResumableUploadError(422, "SHA-256 が一致しません。アップロードをやり直してください。")
+            try:
+                result = await store(data_path, state, sha256)
+            except BaseException:
+                # データファイルは取り込みの失敗時に削除されているため、途中状態も残さない
+                await self.discard(upload_id)
+                raise
+            state["result"] = result
+            await asyncio.to_thread(self._write_state, state)
+            self.completed += 1
+            return result
+
+    async def discard(self, upload_id: str) -> None:
+        upload_dir = self._upload_dir(upload_id)
+        # 同じアップロードのロックを待っている処理がいるかもしれないため、ロックは expire_stale で削除する
+        await asyncio.to_thread(shutil.rmtree, upload_dir, True)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "in_progress": sum(1 for upload_dir in self.root.iterdir() if (upload_dir / DATA_FILE_NAME).exists()),
+            "completed": self.completed,
+        }
@@ -0,0 +1,63 @@
+# d:\Users\onisi\Documents\web-app-dev\backend\single_flight.py
+"""
+同一キーの処理の同時実行を 1 回にまとめる single-flight。
+
+実行中の処理と同じキーで呼び出された場合は新たに上流を呼ばず、
+実行中のタスクの結果 (または例外) を共有する。
+"""
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, TypeVar
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class SingleFlight:
+    """
+    キーごとに実行中のタスクを 1 つだけ保持する。
+    待機側がキャンセルされても共有タスクは止めない (他の待機者が結果を必要とするため)。
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._inflight: Dict[str, asyncio.Task] = {}
+        self._fan_in: Dict[str, int] = {}
+        self.executions = 0
+        self.coalesced = 0
+        self.max_fan_in = 0
+
+    def _finish(self, key: str, task: asyncio.Task) -> None:
+        # 待機者が全員キャンセルされた場合でも例外が未取得の警告にならないようにする
+        if not task.cancelled():
+            task.exception()
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+            fan_in = self._fan_in.pop(key, 1)
+            self.max_fan_in = max(self.max_fan_in, fan_in)
+            if fan_in > 1:
+                logger.debug(f"single-flight '{self.name}': {fan_in} 件の同一リクエストを 1 回の呼び出しにまとめました。")
+
+    async def do(self, key: str, factory: Callable[[], Awaitable[T]]) -> T:
+        """ key の処理が実行中なら相乗りし、なければ factory() を実行してその結果を返す。 """
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(factory())
+            self._inflight[key] = task
+            self._fan_in[key] = 1
+            self.executions += 1
+            task.add_done_callback(lambda done, key=key: self._finish(key, done))
+        else:
+            self._fan_in[key] += 1
+            self.coalesced += 1
+        return await asyncio.shield(task)
+
+    def stats(self) -> Dict[str, Any]:
+        """ 上流呼び出し回数と相乗り (fan-in) の統計を返す。 """
+        return {
+            "in_flight": len(self._inflight),
+            "executions": self.executions,
+            "coalesced": self.coalesced,
+            "max_fan_in": self.max_fan_in,
+        }
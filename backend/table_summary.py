@@ -0,0 +1,478 @@
+# d:\Users\onisi\Documents\web-app-dev\backend\table_summary.py
+"""
+CSV / JSON などの表形式ファイルのサマリー作成。
+
+大きな表をそのままプロンプトに載せる代わりに、スキーマ・列ごとの統計 (件数・欠損・最小/最大/平均/標準偏差)・
+値の種類数・よく出る値・サンプル行をまとめたサマリーを作る。
+ファイルは chunk_rows 行ずつ列単位に集計するため、ファイルの大きさに関わらずメモリ使用量は一定に保たれる。
+数値列の変換と集計は NumPy があればベクトル化して行い (任意の依存関係)、無い場合は標準ライブラリで同じ結果を計算する。
+処理はプロセスプールで行い、結果はアップロードファイルの隣 (<ファイル>.summary.json) にキャッシュする。
+"""
+import io
+import re
+import csv
+import json
+import math
+import random
+import codecs
+import logging
+from collections import Counter
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import aiofiles
+
+from process_pool import BackgroundTaskSet, PoolTaskError, ProcessPoolRunner
+from single_flight import SingleFlight
+
+try:
+    import numpy as np
+except ImportError:  # 無い場合は標準ライブラリで集計する
+    np = None
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_SUFFIX = ".summary.json"
+CSV_CONTENT_TYPES = {"text/csv", "text/tab-separated-values"}
+JSON_CONTENT_TYPES = {"application/json", "application/x-ndjson", "application/jsonl"}
+TABLE_CONTENT_TYPES = CSV_CONTENT_TYPES | JSON_CONTENT_TYPES
+# 欠損値として扱う文字列 (小文字で比較)
+NULL_STRINGS = {"", "na", "n/a", "null", "none", "nan", "-"}
+BOOLEAN_STRINGS = {"true", "false"}
+SNIFF_BYTES = 64 * 1024
+READ_CHUNK_CHARS = 256 * 1024
+# 1 つの JSON 値 (配列の要素、JSON Lines の 1 行、トップレベルのオブジェクト) の上限
+MAX_JSON_VALUE_CHARS = 16 * 1024 * 1024
+MAX_CELL_CHARS = 200
+WHITESPACE_PATTERN = re.compile(r"\s*")
+ARRAY_SEPARATOR_PATTERN = re.compile(r"[\s,]*")
+
+
+def _detect_encoding(head: bytes) -> str:
+    """ 先頭のバイト列から文字コードを判定する (BOM 付き UTF-8 / UTF-8 / cp932)。 """
+    if head.startswith(codecs.BOM_UTF8):
+        return "utf-8-sig"
+    try:
+        # 末尾で文字が途切れていてもエラーにならないよう、インクリメンタルデコーダで判定する
+        codecs.getincrementaldecoder("utf-8")().decode(head, final=False)
+        return "utf-8"
+    except UnicodeDecodeError:
+        return "cp932"
+
+
+def _open_text(path: Path) -> io.TextIOWrapper:
+    with open(path, "rb") as f:
+        head = f.read(SNIFF_BYTES)
+    return open(path, "r", encoding=_detect_encoding(head), errors="replace", newline="")
+
+
+def _iter_csv_records(path: Path, content_type: str) -> Iterator[Dict[str, Any]]:
+    """ 1 行目をヘッダーとして、各行を {列名: 値} で返す。 """
+    with _open_text(path) as f:
+        if content_type == "text/tab-separated-values":
+            delimiter = "\t"
+        else:
+            try:
+                delimiter = csv.Sniffer().sniff(f.read(SNIFF_BYTES), delimiters=",\t;|").delimiter
+            except csv.Error:
+                delimiter = ","
+            f.seek(0)
+        reader = csv.reader(f, delimiter=delimiter)
+        header = next(reader, None)
+        if header is None:
+            return
+        columns = [name.strip() or f"column_{index + 1}" for index, name in enumerate(header)]
+        for row in reader:
+            if not row:
+                continue
+            if len(row) > len(columns):
+                columns.extend(f"column_{index + 1}" for index in range(len(columns), len(row)))
+            yield dict(zip(columns, row))
+
+
+def _iter_json_values(f: io.TextIOBase) -> Iterator[Any]:
+    """
+    トップレベルの配列の要素、または JSON Lines の各行を 1 つずつ返す。
+    READ_CHUNK_CHARS ずつ読みながら raw_decode するため、ファイル全体を読み込まない。
+    1 つの値 (トップレベルのオブジェクトを含む) はメモリ上で decode するため、
+    MAX_JSON_VALUE_CHARS を超える値は ValueError にする。
+    """
+    decoder = json.JSONDecoder()
+    buffer = f.read(READ_CHUNK_CHARS).lstrip()
+    in_array = buffer.startswith("[")
+    separator = ARRAY_SEPARATOR_PATTERN if in_array else WHITESPACE_PATTERN
+    position = 1 if in_array else 0
+    eof = not buffer
+
+    while True:
+        position = separator.match(buffer, position).end()
+        if in_array and buffer.startswith("]", position):
+            return
+        needs_more = position == len(buffer)
+        if not needs_more:
+            try:
+                value, end = decoder.raw_decode(buffer, position)
+                # 末尾まで使った値は READ_CHUNK_CHARS の境界で途切れた数値の可能性があるため、読み足してから確定する
+                needs_more = end == len(buffer) and not eof
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                needs_more = True
+            if not needs_more:
+                yield value
+                position = end
+                continue
+        if eof:
+            return
+        pending = len(buffer) - position
+        if pending > MAX_JSON_VALUE_CHARS:
+            raise ValueError(f"JSON の値が大きすぎます (1 つの値は {MAX_JSON_VALUE_CHARS} 文字まで)。トップレベルの配列か JSON Lines にしてください。")
+        # 途切れた値は先頭から decode し直すため、読み足す量を未処理の長さに合わせて増やし、全体の計算量を線形に保つ
+        chunk = f.read(min(max(READ_CHUNK_CHARS, pending), MAX_JSON_VALUE_CHARS + 1 - pending))
+        eof = not chunk
+        buffer = buffer[position:] + chunk
+        position = 0
+
+
+def _flatten(value: Any, prefix: str = "") -> Dict[str, Any]:
+    """ 入れ子のオブジェクトを "親.子" の列名で平坦化する。配列は JSON 文字列、真偽値は "true"/"false" にする。 """
+    if not isinstance(value, dict):
+        return {prefix or "value": _scalar(value)}
+    flat: Dict[str, Any] = {}
+    for key, item in value.items():
+        name = f"{prefix}.{key}" if prefix else str(key)
+        if isinstance(item, dict) and item:
+            flat.update(_flatten(item, name))
+        else:
+            flat[name] = _scalar(item)
+    return flat
+
+
+def _scalar(value: Any) -> Any:
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, (list, dict)):
+        return json.dumps(value, ensure_ascii=False)
+    return value
+
+
+def _iter_json_records(path: Path) -> Iterator[Dict[str, Any]]:
+    with _open_text(path) as f:
+        for value in _iter_json_values(f):
+            yield _flatten(value)
+
+
+def iter_table_records(path: Path, content_type: str) -> Iterator[Dict[str, Any]]:
+    if content_type in CSV_CONTENT_TYPES:
+        return _iter_csv_records(path, content_type)
+    return _iter_json_records(path)
+
+
+def _is_null(value: Any) -> bool:
+    return value is None or (isinstance(value, str) and value.strip().lower() in NULL_STRINGS)
+
+
+def _parse_numbers(values: List[Any]) -> Tuple[List[float], int]:
+    """ 標準ライブラリ版の数値変換。戻り値は (有限の数値, 数値として解釈できた件数)。 """
+    numbers = []
+    parsed = 0
+    for value in values:
+        try:
+            number = float(value)
+        except (TypeError, ValueError):
+            continue
+        parsed += 1
+        if math.isfinite(number):
+            numbers.append(number)
+    return numbers, parsed
+
+
+class ColumnStats:
+    """ 1 列分の集計。数値の平均・分散はバッチごとの値を Chan らの方法で合成する。 """
+
+    def __init__(self, name: str, distinct_limit: int):
+        self.name = name
+        self.distinct_limit = distinct_limit
+        self.count = 0
+        self.numeric_count = 0
+        self.integral = True
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.finite_count = 0
+        self.minimum: Optional[float] = None
+        self.maximum: Optional[float] = None
+        self.max_length = 0
+        self.values: Counter = Counter()
+        self.distinct_overflow = False
+
+    def _merge_numbers(self, count: int, mean: float, m2: float, minimum: float, maximum: float) -> None:
+        total = self.finite_count + count
+        delta = mean - self.mean
+        self.mean += delta * count / total
+        self.m2 += m2 + delta * delta * self.finite_count * count / total
+        self.finite_count = total
+        self.minimum = minimum if self.minimum is None else min(self.minimum, minimum)
+        self.maximum = maximum if self.maximum is None else max(self.maximum, maximum)
+
+    def _update_numbers(self, values: List[Any]) -> None:
+        if np is not None:
+            try:
+                array = np.asarray(values, dtype=np.float64)
+            except (TypeError, ValueError):
+                array = None
+            if array is not None:
+                self.numeric_count += len(values)
+                array = array[np.isfinite(array)]
+                if array.size:
+                    self.integral = self.integral and bool(np.all(array == np.floor(array)))
+                    mean = float(array.mean())
+                    self._merge_numbers(int(array.size), mean, float(((array - mean) ** 2).sum()), float(array.min()), float(array.max()))
+                return
+        numbers, parsed = _parse_numbers(values)
+        self.numeric_count += parsed
+        if numbers:
+            self.integral = self.integral and all(number.is_integer() for number in numbers)
+            mean = sum(numbers) / len(numbers)
+            self._merge_numbers(len(numbers), mean, sum((number - mean) ** 2 for number in numbers), min(numbers), max(numbers))
+
+    def update(self, values: List[Any]) -> None:
+        """ 1 バッチ分の値 (欠損値は除外済み) を集計に加える。 """
+        if not values:
+            return
+        self.count += len(values)
+        self._update_numbers(values)
+        texts = [value if isinstance(value, str) else str(value) for value in values]
+        self.max_length = max(self.max_length, max(len(text) for text in texts))
+        self.values.update(texts)
+        if len(self.values) > self.distinct_limit:
+            # 種類数が多すぎる列は上位だけを残し、以降の種類数・頻度は概算になる
+            self.distinct_overflow = True
+            self.values = Counter(dict(self.values.most_common(self.distinct_limit // 2)))
+
+    def inferred_type(self) -> str:
+        if self.count == 0:
+            return "empty"
+        if self.numeric_count == self.count:
+            return "integer" if self.integral else "float"
+        if not self.distinct_overflow and {value.lower() for value in self.values} <= BOOLEAN_STRINGS:
+            return "boolean"
+        return "mixed" if self.numeric_count else "string"
+
+    def to_dict(self, rows: int, top_values: int) -> Dict[str, Any]:
+        column_type = self.inferred_type()
+        summary: Dict[str, Any] = {
+            "name": self.name,
+            "type": column_type,
+            "count": self.count,
+            "nulls": rows - self.count,
+            "distinct": self.distinct_limit if self.distinct_overflow else len(self.values),
+            "distinct_exact": not self.distinct_overflow,
+        }
+        if column_type in ("integer", "float", "mixed") and self.finite_count:
+            summary.update({
+                "min": self.minimum,
+                "max": self.maximum,
+                "mean": self.mean,
+                "std": math.sqrt(self.m2 / (self.finite_count - 1)) if self.finite_count > 1 else 0.0,
+            })
+        if column_type in ("string", "mixed", "boolean"):
+            summary["max_length"] = self.max_length
+        summary["top"] = [[_clip(value), count] for value, count in self.values.most_common(top_values) if count > 1]
+        return summary
+
+
+def _clip(value: Any) -> Any:
+    if isinstance(value, str) and len(value) > MAX_CELL_CHARS:
+        return value[:MAX_CELL_CHARS] + "…"
+    return value
+
+
+def _clip_record(record: Dict[str, Any]) -> Dict[str, Any]:
+    return {key: _clip(value) for key, value in record.items()}
+
+
+def summarize_table(path_str: str, content_type: str, chunk_rows: int = 5000, sample_rows: int = 5, distinct_limit: int = 10000, top_values: int = 5) -> Optional[Dict[str, Any]]:
+    """
+    プロセスプールで実行されるサマリー作成処理。
+    JSON が配列や JSON Lines ではなく 1 つのオブジェクトだった場合など、表として扱えない場合は None を返す。
+    """
+    path = Path(path_str)
+    columns: Dict[str, ColumnStats] = {}
+    batch: List[Dict[str, Any]] = []
+    head: List[Dict[str, Any]] = []
+    reservoir: List[Tuple[int, Dict[str, Any]]] = []
+    sampler = random.Random(0)  # 同じファイルからは同じサンプルを作る
+    rows = 0
+
+    def flush() -> None:
+        # 列の順序は最初に現れた順に保つ
+        names: Dict[str, None] = {}
+        for record in batch:
+            names.update(dict.fromkeys(record))
+        for name in names:
+            if name not in columns:
+                columns[name] = ColumnStats(name, distinct_limit)
+            columns[name].update([record[name] for record in batch if name in record and not _is_null(record[name])])
+        batch.clear()
+
+    for record in iter_table_records(path, content_type):
+        if len(head) < sample_rows:
+            head.append(_clip_record(record))
+        elif len(reservoir) < sample_rows:
+            reservoir.append((rows, _clip_record(record)))
+        else:
+            slot = sampler.randrange(rows - sample_rows + 1)
+            if slot < sample_rows:
+                reservoir[slot] = (rows, _clip_record(record))
+        batch.append(record)
+        rows += 1
+        if len(batch) >= chunk_rows:
+            flush()
+    flush()
+
+    if content_type in JSON_CONTENT_TYPES and rows < 2:
+        # 1 つのオブジェクトだけの JSON は表ではなく文書として扱う
+        return None
+    return {
+        "format": "csv" if content_type in CSV_CONTENT_TYPES else "json",
+        "rows": rows,
+        "columns": [column.to_dict(rows, top_values) for column in columns.values()],
+        "head": head,
+        "sample": [{"row": row, "values": record} for row, record in sorted(reservoir, key=lambda item: item[0])],
+        "vectorized": np is not None,
+    }
+
+
+def read_table_rows(path_str: str, content_type: str, start: int, end: int) -> List[Dict[str, Any]]:
+    """ [start, end) 行目 (0 始まり、ヘッダーを除く) を読み込む。範囲の手前の行は読み飛ばすだけで保持しない。 """
+    rows = []
+    for index, record in enumerate(iter_table_records(Path(path_str), content_type)):
+        if index >= end:
+            break
+        if index >= start:
+            rows.append(_clip_record(record))
+    return rows
+
+
+def _format_number(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() and abs(value) < 1e15 else f"{value:.6g}"
+
+
+def render_summary(summary: Dict[str, Any], filename: str) -> str:
+    """ サマリーをプロンプトに載せるテキストにする。 """
+    lines = [
+        f"[添付ファイル: {filename} (表形式データのサマリー: {summary['rows']} 行 × {len(summary['columns'])} 列)]",
+        "全データは含まれていません。特定の行が必要な場合は行番号の範囲を指定して取得できます。",
+        "",
+        "列:",
+    ]
+    for column in summary["columns"]:
+        distinct = f"{column['distinct']}" if column["distinct_exact"] else f"{column['distinct']} 以上"
+        details = [column["type"], f"欠損 {column['nulls']}", f"種類数 {distinct}"]
+        if "mean" in column:
+            details.append(
+                f"最小 {_format_number(column['min'])} / 最大 {_format_number(column['max'])} / "
+                f"平均 {column['mean']:.6g} / 標準偏差 {column['std']:.6g}"
+            )
+        if column["top"]:
+            details.append("頻出 " + ", ".join(f"{value} ({count})" for value, count in column["top"]))
+        lines.append(f"- {column['name']}: " + "; ".join(details))
+    lines.append("")
+    lines.append("先頭の行:")
+    lines.extend(json.dumps(record, ensure_ascii=False) for record in summary["head"])
+    if summary["sample"]:
+        lines.append("")
+        lines.append("サンプル行 (行番号は 0 始まり):")
+        lines.extend(f"{item['row']}: {json.dumps(item['values'], ensure_ascii=False)}" for item in summary["sample"])
+    return "\n".join(lines)
+
+
+def render_rows(rows: List[Dict[str, Any]], start: int, total_rows: Optional[int], filename: str) -> str:
+    """ 取得した行をプロンプトに載せるテキストにする (1 行 1 JSON オブジェクト)。 """
+    end = start + len(rows)
+    total = f"、全 {total_rows} 行" if total_rows is not None else ""
+    header = f"[添付ファイル: {filename} の {start}〜{end - 1} 行目 ({len(rows)} 行{total})]" if rows else f"[添付ファイル: {filename}: {start} 行目以降に行がありません{total}]"
+    return "\n".join([header] + [f"{start + offset}: {json.dumps(record, ensure_ascii=False)}" for offset, record in enumerate(rows)])
+
+
+class TableSummarizer:
+    """ 表形式ファイルのサマリー作成と行の取得をプロセスプールで実行し、サマリーをファイルの隣にキャッシュする。 """
+
+    def __init__(self, workers: int = 1, chunk_rows: int = 5000, sample_rows: int = 5, distinct_limit: int = 10000, top_values: int = 5, max_fetch_rows: int = 200):
+        self.workers = workers
+        self.chunk_rows = chunk_rows
+        self.sample_rows = sample_rows
+        self.distinct_limit = distinct_limit
+        self.top_values = top_values
+        self.max_fetch_rows = max_fetch_rows
+        self._pool = ProcessPoolRunner("table_summary", workers)
+        self._flights = SingleFlight("table_summary")
+        self._background = BackgroundTaskSet("サマリー作成")
+        self.summarized = 0
+        self.cache_hits = 0
+        self.failures = 0
+        self.row_fetches = 0
+        if np is None:
+            logger.warning("NumPy がインストールされていないため、表形式データの集計は標準ライブラリで行います。")
+
+    @staticmethod
+    def cache_path(entry: Dict[str, Any]) -> Path:
+        path = Path(entry["path"])
+        return path.with_name(path.name + SUMMARY_SUFFIX)
+
+    @staticmethod
+    def supports(content_type: Optional[str]) -> bool:
+        return content_type in TABLE_CONTENT_TYPES
+
+    async def summarize(self, entry: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """ エントリのサマリーを返す。表として扱えない場合や集計に失敗した場合は None。 """
+        if not self.supports(entry.get("content_type")):
+            return None
+        cache_path = self.cache_path(entry)
+        if cache_path.exists():
+            self.cache_hits += 1
+            async with aiofiles.open(cache_path, "r", encoding="utf-8") as f:
+                return json.loads(await f.read())
+        return await self._flights.do(entry["sha256"], lambda: self._summarize_to_cache(entry, cache_path))
+
+    async def _summarize_to_cache(self, entry: Dict[str, Any], cache_path: Path) -> Optional[Dict[str, Any]]:
+        # 壊れた JSON / CSV や文字コードの誤りなどは null をキャッシュし、毎回集計し直さないようにする
+        label = f"表形式データのサマリー作成 ({entry['filename']}, {entry['content_type']})"
+        try:
+            summary = await self._pool.run_cached(
+                cache_path, label, summarize_table, entry["path"], entry["content_type"],
+                self.chunk_rows, self.sample_rows, self.distinct_limit, self.top_values,
+            )
+        except PoolTaskError:
+            self.failures += 1
+            return None
+        if summary is not None:
+            self.summarized += 1
+            logger.info(f"表形式データのサマリーを作成しました: {entry['filename']} ({summary['rows']} 行 × {len(summary['columns'])} 列)")
+        return summary
+
+    def summarize_in_background(self, entry: Dict[str, Any]) -> None:
+        """ アップロード直後にサマリー作成を始めておき、最初のチャットで待たずに済むようにする。 """
+        if self.supports(entry.get("content_type")) and not self.cache_path(entry).exists():
+            self._background.start(self.summarize(entry))
+
+    async def rows(self, entry: Dict[str, Any], start: int, end: int) -> List[Dict[str, Any]]:
+        """ [start, end) 行目を返す。1 回に取得する行数は max_fetch_rows までに制限する。 """
+        start = max(0, start)
+        end = min(max(start, end), start + self.max_fetch_rows)
+        self.row_fetches += 1
+        return await self._pool.run(read_table_rows, entry["path"], entry["content_type"], start, end)
+
+    def shutdown(self) -> None:
+        self._pool.shutdown()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "vectorized": np is not None,
+            "summarized": self.summarized,
+            "cache_hits": self.cache_hits,
+            "row_fetches": self.row_fetches,
+            "failures": self.failures,
+            "single_flight": self._flights.stats(),
+            "pool": self._pool.stats(),
+        }
@@ -0,0 +1,10 @@
+# d:\Users\onisi\Documents\web-app-dev\backend\tests\conftest.py
+"""
+backend のテスト共通設定。backend ディレクトリのモジュールを直接 import できるようにする。
+
+    python -m pytest -q backend/tests
+"""
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
@@ -0,0 +1,131 @@
+# d:\Users\onisi\Documents\web-app-dev\backend\tests\test_bm25_index.py
+""" BM25 インデックスのチャンク分割・検索と、長い添付ファイルの抜粋展開のテスト。 """
+import asyncio
+
+import pytest
+
+from attachments import AttachmentRegistry
+from bm25_index import BM25Index, prepare_document, split_into_chunks, tokenize
+from upload_store import UploadStore
+
+FILLER = "The committee reviewed the quarterly budget and approved the minutes."
+
+
+def make_index(**options):
+    return BM25Index(**{"chunk_chars": 80, "overlap_chars": 10, **options})
+
+
+def add(index, doc_id, *paragraphs):
+    index.add(doc_id, prepare_document("\n\n".join(paragraphs), index.chunk_chars, index.overlap_chars))
+
+
+def test_long_paragraph_is_split_with_overlap():
+    chunks = split_into_chunks("a" * 25, chunk_chars=10, overlap_chars=2)
+    assert [len(chunk) for chunk in chunks] == [10, 10, 9]
+
+
+@pytest.mark.parametrize("overlap_chars", [10, 15])
+def test_overlap_not_smaller_than_chunk_still_terminates(overlap_chars):
+    chunks = split_into_chunks("abcdefghijkl", chunk_chars=10, overlap_chars=overlap_chars)
+    assert chunks == ["abcdefghij", "bcdefghijk", "cdefghijkl"]
+
+
+@pytest.mark.parametrize("chunk_chars, overlap_chars", [(0, 0), (10, 10), (10, -1)])
+def test_index_rejects_invalid_chunk_settings(chunk_chars, overlap_chars):
+    with pytest.raises(ValueError):
+        BM25Index(chunk_chars=chunk_chars, overlap_chars=overlap_chars)
+
+
+def test_japanese_is_tokenized_into_bigrams():
+    assert tokenize("東京都 Tokyo") == ["東京", "京都", "tokyo"]
+    assert tokenize("犬") == ["犬"]
+
+
+def test_relevant_chunk_is_ranked_first():
+    index = make_index()
+    add(index, "doc", FILLER, "Kangaroos carry their young in a pouch.", FILLER + " Again.")
+    hits = index.search("where do kangaroos carry young")
+    assert hits and "Kangaroos" in hits[0].text
+    assert hits[0].score > max((hit.score for hit in hits[1:]), default=0.0)
+
+
+def test_japanese_query_matches_japanese_text():
+    index = make_index(chunk_chars=20, overlap_chars=2)
+    add(index, "doc", "今日の会議では予算について議論した。", "東京都の人口は約一千四百万人である。")
+    hits = index.search("東京の人口は?")
+    assert hits and hits[0].text.startswith("東京都")
+
+
+def test_search_is_limited_to_doc_ids():
+    index = make_index()
+    add(index, "first", "Kangaroos live in Australia.")
+    add(index, "second", "Kangaroos can jump far.")
+    assert {hit.doc_id for hit in index.search("kangaroos")} == {"first", "second"}
+    assert [hit.doc_id for hit in index.search("kangaroos", doc_ids=["second"])] == ["second"]
+
+
+def test_removed_document_is_no_longer_returned():
+    index = make_index()
+    add(index, "first", "Kangaroos live in Australia.")
+    add(index, "second", "Kangaroos can jump far.")
+    index.remove("first")
+    assert [hit.doc_id for hit in index.search("kangaroos")] == ["second"]
+    assert "first" not in index and index.stats()["documents"] == 1
+
+
+def test_least_recently_used_document_is_evicted():
+    index = make_index(max_documents=2)
+    add(index, "first", "Kangaroos live in Australia.")
+    add(index, "second", "Kangaroos can jump far.")
+    index.search("kangaroos", doc_ids=["first"])
+    add(index, "third", "Kangaroos eat grass.")
+    assert "first" in index and "second" not in index and "third" in index
+    assert index.stats()["evicted"] == 1
+
+
+def make_registry(tmp_path, text, top_k=2):
+    store = UploadStore(tmp_path / "store", tmp_path / "index.json", flush_delay=60)
+    registry = AttachmentRegistry(
+        store,
+        max_text_chars=len(text) + 1,
+        retriever=make_index(),
+        retrieval_min_chars=500,
+        retrieval_top_k=top_k,
+    )
+    return store, registry
+
+
+def test_long_attachment_expands_to_top_k_chunks(tmp_path):
+    paragraphs = [f"{FILLER} Section {number}." for number in range(40)]
+    paragraphs[25] = "Kangaroos carry their young in a pouch."
+    text = "\n\n".join(paragraphs)
+    store, registry = make_registry(tmp_path, text)
+
+    async def scenario():
+        entry = await registry.register_bytes("ab" + "0" * 62, text.encode(), "notes.txt", "text/plain")
+        part = await registry.expand_part(entry["sha256"], query="kangaroo pouch")
+        await store.close()
+        return part
+
+    part = asyncio.run(scenario())
+    assert "Kangaroos carry their young" in part["text"]
+    assert part["text"].count("[...]") <= 1
+    assert len(part["text"]) < len(text) // 4
+    assert registry.retrievals == 1
+
+
+def test_forgotten_attachment_is_dropped_from_index(tmp_path):
+    text = "\n\n".join(["Kangaroos carry their young in a pouch."] + [FILLER] * 20)
+    store, registry = make_registry(tmp_path, text)
+
+    async def scenario():
+        entry = await registry.register_bytes("ab" + "0" * 62, text.encode(), "notes.txt", "text/plain")
+        await registry.expand_part(entry["sha256"], query="kangaroo")
+        await store.close()
+        return entry["sha256"]
+
+    sha256 = asyncio.run(scenario())
+    assert sha256 in registry.retriever
+    registry.forget(sha256)
+    assert sha256 not in registry.retriever
+    assert registry.retriever.search("kangaroo") == []
@@ -0,0 +1,75 @@
+# d:\Users\onisi\Documents\web-app-dev\backend\tests\test_body_size_limit.py
+""" BodySizeLimitMiddleware と、設定から求めるルートごとの上限のテスト。 """
+from fastapi import FastAPI, Request
+from fastapi.testclient import TestClient
+
+import main
+from body_size_limit import BodySizeLimitMiddleware
+
+LIMIT_BYTES = 1000
+
+
+def make_client():
+    app = FastAPI()
+    app.add_middleware(BodySizeLimitMiddleware, limit_for_path=lambda path: None if path == "/free" else LIMIT_BYTES)
+    received = []
+
+    @app.post("/echo")
+    async def echo(request: Request):
+        size = 0
+        async for chunk in request.stream():
+            size += len(chunk)
+        received.append(size)
+        return {"size": size}
+
+    @app.post("/free")
+    async def free(request: Request):
+        return {"size": len(await request.body())}
+
+    return TestClient(app), received
+
+
+def chunks(count, size=256):
+    for _ in range(count):
+        yield b"x" * size
+
+
+def test_body_within_limit_is_passed_through():
+    client, received = make_client()
+    response = client.post("/echo", content=b"x" * LIMIT_BYTES)
+    assert response.status_code == 200
+    assert received == [LIMIT_BYTES]
+
+
+def test_content_length_over_limit_is_rejected_before_the_app():
+    client, received = make_client()
+    response = client.post("/echo", content=b"x" * (LIMIT_BYTES + 1))
+    assert response.status_code == 413
+    assert received == []
+
+
+def test_chunked_body_is_cut_off_once_over_limit():
+    client, received = make_client()
+    response = client.post("/echo", content=chunks(8))
+    assert response.status_code == 413
+    assert received == []
+
+
+def test_unlimited_path():
+    client, _ = make_client()
+    assert client.post("/free", content=b"x" * (LIMIT_BYTES * 10)).json() == {"size": LIMIT_BYTES * 10}
+
+
+def test_route_limits_follow_upload_and_chat_settings(monkeypatch):
+    monkeypatch.setattr(main, "config", {
+        "request_limits": {"default_max_body_mb": 1, "multipart_overhead_mb": 1},
+        "file_upload": {"max_size_mb": 50, "batch_max_files": 3, "resumable": {"max_chunk_mb": 16}},
+        "main_chat": {"max_image_mb": 3, "max_images_per_request": 2},
+    })
+    mb = 1024 * 1024
+    assert main.request_body_limit("/api/upload") == 51 * mb
+    assert main.request_body_limit("/api/upload/batch") == 151 * mb
+    assert main.request_body_limit("/api/upload/resumable/abc") == 17 * mb
+    assert main.request_body_limit("/api/chat") == 9 * mb
+    assert main.request_body_limit("/api/uploads/abc") == 1 * mb
+    assert main.request_body_limit("/api/generate-metaprompt") == 1 * mb
@@ -0,0 +1,42 @@
+# d:\Users\onisi\Documents\web-app-dev\backend\tests\test_chat_routes.py
+""" /api/chat (JSON) と /api/chat/multipart のスキーマと検証のテスト。 """
+import json
+
+from fastapi.testclient import TestClient
+
+import main
+
+VALID_REQUEST = {"messages": [{"role": "user", "content": "hi"}]}
+
+
+def test_json_route_is_typed_in_openapi():
+    schema = main.app.openapi()
+    body = schema["paths"]["/api/chat"]["post"]["requestBody"]["content"]["application/json"]["schema"]
+    assert body["$ref"].endswith("/ChatRequest")
+    assert "/api/chat/multipart" in schema["paths"]
+
+
+def test_invalid_json_body_is_422():
+    response = TestClient(main.app).post("/api/chat", json={"messages": "not a list"})
+    assert response.status_code == 422
+
+
+def test_invalid_multipart_request_field_is_422():
+    response = TestClient(main.app).post("/api/chat/multipart", data={"request": json.dumps({"messages": 1})})
+    assert response.status_code == 422
+
+
+def test_multipart_without_request_field_is_422():
+    response = TestClient(main.app).post("/api/chat/multipart", files={"image-1": ("a.png", b"x", "image/png")})
+    assert response.status_code == 422
+
+
+def test_valid_requests_reach_the_handler(monkeypatch):
+    monkeypatch.setattr(main, "groq_client", None)
+    client = TestClient(main.app)
+    assert client.post("/api/chat", json=VALID_REQUEST).status_code == 503
+    assert client.post("/api/chat/multipart", data={"request": json.dumps(VALID_REQUEST)}).status_code == 503
+
+
+def test_multipart_route_shares_the_chat_body_limit():
+    assert main.request_body_limit("/api/chat/multipart") == main.request_body_limit("/api/chat")
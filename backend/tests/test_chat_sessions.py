@@ -0,0 +1,60 @@
+# d:\Users\onisi\Documents\web-app-dev\backend\tests\test_chat_sessions.py
+""" ChatSessionStore のチェーンハッシュ・競合・履歴の切り詰めと、/api/chat の再同期応答のテスト。 """
+from fastapi.testclient import TestClient
+
+import main
+from chat_sessions import EMPTY_HISTORY_HASH, ChatSessionStore, chain_history_hash
+
+USER = {"role": "user", "content": "こんにちは"}
+ASSISTANT = {"role": "assistant", "content": "hello"}
+
+
+def test_hash_chains_turn_by_turn():
+    store = ChatSessionStore()
+    first = store.commit("s", None, [USER, ASSISTANT])
+    second = store.commit("s", first, [USER, ASSISTANT])
+    assert first == chain_history_hash(EMPTY_HISTORY_HASH, [USER, ASSISTANT])
+    # 2 ターン分を一度に連結した場合と同じハッシュになる
+    assert second == chain_history_hash(EMPTY_HISTORY_HASH, [USER, ASSISTANT, USER, ASSISTANT])
+    assert store.get("s").history_hash == second
+
+
+def test_stale_base_hash_is_rejected():
+    store = ChatSessionStore()
+    first = store.commit("s", None, [USER, ASSISTANT])
+    assert store.commit("s", first, [USER, ASSISTANT]) is not None
+    # 並行するターンが先に確定したため、古いハッシュからのターンは確定しない
+    assert store.commit("s", first, [USER, ASSISTANT]) is None
+    assert store.commit("missing", first, [USER]) is None
+    assert store.stats()["conflicts"] == 2
+
+
+def test_history_is_truncated_but_hash_covers_all_turns():
+    store = ChatSessionStore(max_messages=3)
+    history_hash = store.commit("s", None, [USER, ASSISTANT])
+    history_hash = store.commit("s", history_hash, [{"role": "user", "content": "2"}, {"role": "assistant", "content": "3"}])
+    session = store.get("s")
+    assert [message["content"] for message in session.messages] == ["hello", "2", "3"]
+    assert history_hash == session.history_hash
+
+
+def test_least_recently_used_session_is_evicted():
+    store = ChatSessionStore(max_sessions=2)
+    for session_id in ("a", "b", "c"):
+        store.commit(session_id, None, [USER])
+    assert store.get("a") is None
+    assert store.get("c") is not None
+
+
+def test_mismatched_history_hash_asks_client_to_resync(monkeypatch):
+    store = ChatSessionStore()
+    store.commit("s", None, [USER, ASSISTANT])
+    monkeypatch.setattr(main, "chat_sessions", store)
+    monkeypatch.setattr(main, "groq_client", object())
+    response = TestClient(main.app).post("/api/chat", json={
+        "messages": [USER],
+        "session_id": "s",
+        "history_hash": "0" * 64,
+    })
+    assert response.status_code == 409
+    assert response.json()["resync"] is True
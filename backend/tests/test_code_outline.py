@@ -0,0 +1,40 @@
+# d:\Users\onisi\Documents\web-app-dev\backend\tests\test_code_outline.py
+""" CodeOutliner のサイドカーキャッシュのテスト。 """
+import asyncio
+from concurrent.futures import Executor
+from concurrent.futures.process import BrokenProcessPool
+
+from code_outline import CodeOutliner
+
+
+class _BrokenExecutor(Executor):
+    def submit(self, fn, *args, **kwargs):
+        raise BrokenProcessPool("worker died")
+
+
+def make_entry(tmp_path):
+    path = tmp_path / "module.py"
+    path.write_text("def greet(name):\n    return f'hello {name}'\n", encoding="utf-8")
+    return {"path": str(path), "sha256": "0" * 64, "filename": "module.py", "content_type": "text/x-python"}
+
+
+def test_outline_is_cached(tmp_path):
+    outliner = CodeOutliner()
+    entry = make_entry(tmp_path)
+    try:
+        outline = asyncio.run(outliner.outline(entry))
+    finally:
+        outliner.shutdown()
+    assert [symbol["name"] for symbol in outline["symbols"]] == ["greet"]
+    assert outliner.cache_path(entry).exists()
+
+
+def test_broken_pool_is_not_cached_and_is_recreated(tmp_path):
+    outliner = CodeOutliner()
+    outliner._pool._executor = _BrokenExecutor()
+    entry = make_entry(tmp_path)
+    assert asyncio.run(outliner.outline(entry)) is None
+    assert not outliner.cache_path(entry).exists()
+    assert outliner._pool.stats()["running"] is False
+    assert outliner._pool.restarts == 1
+    assert outliner.failures == 1
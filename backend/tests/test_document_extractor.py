@@ -0,0 +1,72 @@
+# d:\Users\onisi\Documents\web-app-dev\backend\tests\test_document_extractor.py
+""" DocumentExtractor のテスト。 """
+import asyncio
+import json
+import os
+
+from document_extractor import DocumentExtractor
+
+
+def make_entry(tmp_path, text="こんにちは\n\nhello world"):
+    path = tmp_path / "note.txt"
+    path.write_text(text, encoding="utf-8")
+    return {"path": str(path), "sha256": "0" * 64, "filename": "note.txt", "content_type": "text/plain", "size_bytes": path.stat().st_size}
+
+
+def test_text_is_extracted_and_cached(tmp_path):
+    extractor = DocumentExtractor(workers=1)
+    entry = make_entry(tmp_path)
+    try:
+        assert asyncio.run(extractor.extract(entry)) == "こんにちは\n\nhello world"
+    finally:
+        extractor.shutdown()
+    assert extractor.cache_path(entry).exists()
+
+
+def test_crashed_worker_does_not_break_later_extractions(tmp_path, monkeypatch):
+    extractor = DocumentExtractor(workers=1)
+    entry = make_entry(tmp_path)
+    original_run = extractor._pool.run
+    calls = []
+
+    async def crash_once(func, *args):
+        calls.append(func)
+        if len(calls) == 1:
+            # 実際のプールを壊してから失敗させる (ワーカーの異常終了と同じ状態)
+            await original_run(os._exit, 1)
+        return await original_run(func, *args)
+
+    monkeypatch.setattr(extractor._pool, "run", crash_once)
+
+    async def run():
+        assert await extractor.extract(entry) is None
+        return await extractor.extract(entry)
+
+    try:
+        assert asyncio.run(run()) == "こんにちは\n\nhello world"
+    finally:
+        extractor.shutdown()
+    assert extractor.failures == 1
+    assert extractor._pool.restarts == 1
+
+
+def test_corrupt_document_is_cached_as_null(tmp_path, monkeypatch):
+    extractor = DocumentExtractor(workers=1)
+    path = tmp_path / "broken.pdf"
+    path.write_bytes(b"%PDF-1.7 not really a pdf")
+    entry = {"path": str(path), "sha256": "1" * 64, "filename": "broken.pdf", "content_type": "application/pdf", "size_bytes": path.stat().st_size}
+    calls = []
+
+    async def run_inline(func, *args):
+        calls.append(func)
+        return func(*args)
+
+    monkeypatch.setattr(extractor._pool, "run", run_inline)
+
+    async def run():
+        return await extractor.extract(entry), await extractor.extract(entry)
+
+    assert asyncio.run(run()) == (None, None)
+    assert json.loads(extractor.cache_path(entry).read_text(encoding="utf-8")) is None
+    assert len(calls) == 1
+    assert extractor.failures == 1
@@ -0,0 +1,93 @@
+# d:\Users\onisi\Documents\web-app-dev\backend\tests\test_groq_upload_queue.py
+""" GroqUploadQueue の状態遷移・失敗後の再投入・再起動時の積み直しのテスト。 """
+import asyncio
+
+from groq_upload_queue import GROQ_STATUS_FAILED, GROQ_STATUS_PENDING, GROQ_STATUS_READY, GroqUploadQueue, groq_status_of
+from upload_store import UploadStore
+
+SHA256 = "ab" + "0" * 62
+
+
+async def make_store(tmp_path):
+    store = UploadStore(tmp_path / "store", tmp_path / "index.json", flush_delay=60)
+    temp_path = tmp_path / "upload.part"
+    temp_path.write_bytes(b"data")
+    await store.put(SHA256, temp_path, "a.txt", "text/plain", 4)
+    return store
+
+
+def test_failed_upload_can_be_resubmitted(tmp_path):
+    attempts = []
+
+    async def upload(entry):
+        attempts.append(entry["sha256"])
+        if len(attempts) == 1:
+            raise RuntimeError("groq unavailable")
+        return "file_1"
+
+    async def run():
+        store = await make_store(tmp_path)
+        queue = GroqUploadQueue(store, upload, workers=1)
+        queue.start()
+        await queue.submit(SHA256)
+        await queue.submit(SHA256)  # 待ち行列にある間の重複は無視される
+        assert await queue.wait(SHA256, timeout=1)
+        failed_entry = dict(store.get(SHA256))
+        await queue.submit(SHA256)
+        assert await queue.wait(SHA256, timeout=1)
+        await queue.stop()
+        return store, queue, failed_entry
+
+    store, queue, failed_entry = asyncio.run(run())
+    assert attempts == [SHA256, SHA256]
+    assert (groq_status_of(failed_entry), failed_entry["groq_error"]) == (GROQ_STATUS_FAILED, "groq unavailable")
+    entry = store.get(SHA256)
+    assert (groq_status_of(entry), entry["groq_file_id"], entry["groq_error"]) == (GROQ_STATUS_READY, "file_1", None)
+    assert (queue.failed, queue.completed) == (1, 1)
+
+
+def test_unexpected_worker_error_does_not_stop_the_worker(tmp_path):
+    async def upload(entry):
+        return "file_1"
+
+    async def run():
+        store = await make_store(tmp_path)
+        queue = GroqUploadQueue(store, upload, workers=1)
+        queue.start()
+        await queue.submit("cd" + "0" * 62)  # 索引に無いエントリは警告して読み飛ばす
+        original_process = queue._process
+
+        async def broken_process(sha256):
+            queue._process = original_process
+            raise RuntimeError("bug")
+
+        queue._process = broken_process
+        await queue.submit(SHA256)
+        assert await queue.wait(SHA256, timeout=1)
+        await queue.submit(SHA256)
+        assert await queue.wait(SHA256, timeout=1)
+        await queue.stop()
+        return store
+
+    store = asyncio.run(run())
+    assert groq_status_of(store.get(SHA256)) == GROQ_STATUS_READY
+
+
+def test_unfinished_uploads_are_resumed(tmp_path):
+    uploaded = []
+
+    async def upload(entry):
+        uploaded.append(entry["sha256"])
+        return "file_1"
+
+    async def run():
+        store = await make_store(tmp_path)
+        await store.update(SHA256, groq_status=GROQ_STATUS_PENDING)
+        queue = GroqUploadQueue(store, upload)
+        queue.start()
+        assert await queue.resume_unfinished() == 1
+        assert await queue.wait(SHA256, timeout=1)
+        await queue.stop()
+
+    asyncio.run(run())
+    assert uploaded == [SHA256]
@@ -0,0 +1,117 @@
+# d:\Users\onisi\Documents\web-app-dev\backend\tests\test_history_compactor.py
+""" チャット履歴の圧縮と、build_chat_params での展開前の圧縮のテスト。 """
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+import main
+from history_compactor import HistoryTooLargeError, OMITTED_IMAGE_TEXT, compact_history, estimate_message_tokens
+from rate_limiter import estimate_text_tokens
+
+IMAGE_TOKENS = 1000
+SETTINGS = {"default_context_window": 2000, "context_safety_margin_tokens": 0, "estimated_tokens_per_image": IMAGE_TOKENS}
+
+
+def make_history():
+    return [
+        {"role": "system", "content": "sys"},
+        {"role": "user", "content": [{"type": "text", "text": "see"}, {"type": "image_url", "image_url": {"url": "data:"}}]},
+        {"role": "assistant", "content": "<think>" + "x" * 400 + "</think>answer"},
+        {"role": "user", "content": "next"},
+    ]
+
+
+def total_tokens(messages):
+    return sum(estimate_message_tokens(message, IMAGE_TOKENS) for message in messages)
+
+
+def test_within_budget_is_unchanged():
+    messages = make_history()
+    result = compact_history(messages, total_tokens(messages), IMAGE_TOKENS)
+    assert result.messages is messages
+    assert not result.compacted
+
+
+def test_images_are_dropped_before_reasoning():
+    messages = make_history()
+    # 省略の注記の分だけ余裕を持たせる
+    result = compact_history(messages, total_tokens(messages) - IMAGE_TOKENS + 20, IMAGE_TOKENS)
+    assert (result.images_dropped, result.reasoning_dropped, result.messages_dropped) == (1, 0, 0)
+    assert result.messages[1]["content"][-1] == {"type": "text", "text": OMITTED_IMAGE_TEXT}
+    # 元のリストは変更しない
+    assert messages[1]["content"][1]["type"] == "image_url"
+
+    result = compact_history(messages, total_tokens(messages) - IMAGE_TOKENS - 50, IMAGE_TOKENS)
+    assert (result.images_dropped, result.reasoning_dropped, result.messages_dropped) == (1, 1, 0)
+    assert result.messages[2]["content"] == "answer"
+
+
+def test_old_messages_are_dropped_last():
+    messages = make_history()
+    result = compact_history(messages, 30, IMAGE_TOKENS)
+    # 履歴が assistant から始まらないよう、user と直後の assistant をまとめて削る
+    assert [message["role"] for message in result.messages] == ["system", "user"]
+    assert result.messages_dropped == 2
+
+
+def test_too_large_latest_message_raises():
+    messages = [{"role": "user", "content": "x" * 400}]
+    with pytest.raises(HistoryTooLargeError) as excinfo:
+        compact_history(messages, 50, IMAGE_TOKENS)
+    assert excinfo.value.budget_tokens == 50
+
+
+def test_japanese_text_counts_one_token_per_character():
+    assert estimate_text_tokens("こんにちは") == 5
+    assert estimate_text_tokens("hello world!") == 3
+    assert estimate_text_tokens("日本語 text") == 3 + 2
+
+
+def test_attachment_estimates_are_used_before_expansion():
+    estimates = {"img": (IMAGE_TOKENS, True), "doc": (300, False)}
+    messages = [
+        {"role": "user", "content": [{"type": "attachment", "attachment_id": "img"}, {"type": "attachment", "attachment_id": "doc"}]},
+        {"role": "assistant", "content": "ok"},
+        {"role": "user", "content": "next"},
+    ]
+    result = compact_history(messages, 400, IMAGE_TOKENS, lambda part: estimates[part["attachment_id"]])
+    assert result.images_dropped == 1
+    assert [part.get("attachment_id") for part in result.messages[0]["content"]] == ["doc", None]
+
+
+class FakeRegistry:
+    """ 固定の見積もりを返し、展開した添付 ID を記録する添付レジストリ。 """
+
+    def __init__(self):
+        self.expanded = []
+
+    def estimate_part(self, part, image_tokens):
+        return 5000, False
+
+    async def expand_messages(self, messages, query=None):
+        for message in messages:
+            if isinstance(message.get("content"), list):
+                self.expanded.extend(part["attachment_id"] for part in message["content"] if part.get("type") == "attachment")
+        return messages
+
+
+def test_dropped_attachments_are_not_expanded(monkeypatch):
+    registry = FakeRegistry()
+    monkeypatch.setattr(main, "attachment_registry", registry)
+    request = main.ChatRequest(messages=[
+        {"role": "user", "content": [{"type": "attachment", "attachment_id": "old"}]},
+        {"role": "assistant", "content": "ok"},
+        {"role": "user", "content": "next"},
+    ], max_completion_tokens=100)
+    params = asyncio.run(main.build_chat_params(request, SETTINGS))
+    assert registry.expanded == []
+    assert [message["role"] for message in params["messages"]] == ["system", "user"]
+
+
+def test_history_too_large_is_400(monkeypatch):
+    monkeypatch.setattr(main, "attachment_registry", None)
+    request = main.ChatRequest(messages=[{"role": "user", "content": "あ" * 3000}], max_completion_tokens=100)
+    with pytest.raises(HTTPException) as excinfo:
+        asyncio.run(main.build_chat_params(request, SETTINGS))
+    assert excinfo.value.status_code == 400
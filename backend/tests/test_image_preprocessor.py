@@ -0,0 +1,40 @@
+# d:\Users\onisi\Documents\web-app-dev\backend\tests\test_image_preprocessor.py
+""" ImagePreprocessor のテスト。 """
+import asyncio
+import io
+
+from PIL import Image
+
+from image_preprocessor import ImagePreprocessor
+
+
+def jpeg_with_exif(size=(64, 48)) -> bytes:
+    exif = Image.Exif()
+    exif[0x010F] = "PhoneMaker"
+    exif[0x8825] = {1: "N", 2: (35.0, 39.0, 0.0)}
+    output = io.BytesIO()
+    Image.new("RGB", size, (120, 30, 200)).save(output, format="JPEG", quality=10, exif=exif.tobytes())
+    return output.getvalue()
+
+
+def test_small_image_is_still_stripped_of_metadata():
+    preprocessor = ImagePreprocessor(jpeg_quality=95)
+    original = jpeg_with_exif()
+    try:
+        data, content_type = asyncio.run(preprocessor.process(original, "image/jpeg"))
+    finally:
+        preprocessor.shutdown()
+    assert content_type == "image/jpeg"
+    with Image.open(io.BytesIO(data)) as image:
+        assert "exif" not in image.info
+        assert not image.getexif()
+
+
+def test_large_image_is_downscaled():
+    preprocessor = ImagePreprocessor(max_dimension=32)
+    try:
+        data, _ = asyncio.run(preprocessor.process(jpeg_with_exif((640, 480)), "image/jpeg"))
+    finally:
+        preprocessor.shutdown()
+    with Image.open(io.BytesIO(data)) as image:
+        assert max(image.size) == 32
@@ -0,0 +1,27 @@
+# d:\Users\onisi\Documents\web-app-dev\backend\tests\test_metaprompt_request.py
+""" MetapromptRequest の正規化とキャッシュキー・メタプロンプトの一貫性、バッチの件数制限のテスト。 """
+from fastapi.testclient import TestClient
+
+import main
+
+
+def key_and_messages(task, variables):
+    request = main.MetapromptRequest(task=task, variables=variables)
+    key = main.metaprompt_cache_key(request.task, request.variables, "model", 0.0, 1024)
+    return key, main.build_metaprompt_messages(request.task, request.variables)
+
+
+def test_requests_sharing_a_cache_key_build_the_same_prompt():
+    first_key, first_messages = key_and_messages("Summarize\r\n", [" doc"])
+    second_key, second_messages = key_and_messages("Summarize", ["DOC"])
+    assert first_key == second_key
+    assert first_messages == second_messages
+    assert "{$DOC}" in first_messages[1]["content"]
+
+
+def test_oversized_batch_is_a_validation_error(monkeypatch):
+    monkeypatch.setattr(main, "groq_client", object())
+    monkeypatch.setattr(main, "config", {"metaprompt": {"batch_max_items": 2}})
+    items = [{"task": f"task {index}"} for index in range(3)]
+    response = TestClient(main.app).post("/api/generate-metaprompt/batch", json={"items": items})
+    assert response.status_code == 400
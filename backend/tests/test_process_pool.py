@@ -0,0 +1,79 @@
+# d:\Users\onisi\Documents\web-app-dev\backend\tests\test_process_pool.py
+""" ProcessPoolRunner のテスト。 """
+import asyncio
+import json
+import os
+from concurrent.futures.process import BrokenProcessPool
+
+import pytest
+
+from process_pool import PoolTaskError, ProcessPoolRunner, write_json_atomic
+
+
+def square(value):
+    return value * value
+
+
+def crash(value):
+    os._exit(1)
+
+
+def parse(value):
+    return int(value)
+
+
+def test_broken_pool_is_recreated():
+    runner = ProcessPoolRunner("test")
+
+    async def run():
+        with pytest.raises(BrokenProcessPool):
+            await runner.run(crash, 1)
+        return await runner.run(square, 3)
+
+    try:
+        assert asyncio.run(run()) == 9
+    finally:
+        runner.shutdown()
+    assert runner.stats()["restarts"] == 1
+
+
+def test_run_cached_caches_results_and_deterministic_failures(tmp_path):
+    runner = ProcessPoolRunner("test")
+
+    async def run():
+        value = await runner.run_cached(tmp_path / "ok.json", "テスト", parse, "3")
+        with pytest.raises(PoolTaskError) as excinfo:
+            await runner.run_cached(tmp_path / "bad.json", "テスト", parse, "x")
+        return value, excinfo.value.cached
+
+    try:
+        value, cached = asyncio.run(run())
+    finally:
+        runner.shutdown()
+    assert value == 3 and json.loads((tmp_path / "ok.json").read_text(encoding="utf-8")) == 3
+    assert cached and json.loads((tmp_path / "bad.json").read_text(encoding="utf-8")) is None
+
+
+def test_run_cached_does_not_cache_a_crashed_worker(tmp_path):
+    runner = ProcessPoolRunner("test")
+
+    async def run():
+        with pytest.raises(PoolTaskError) as excinfo:
+            await runner.run_cached(tmp_path / "crash.json", "テスト", crash, 1)
+        return excinfo.value
+
+    try:
+        error = asyncio.run(run())
+    finally:
+        runner.shutdown()
+    assert not error.cached and isinstance(error.cause, BrokenProcessPool)
+    assert not (tmp_path / "crash.json").exists()
+
+
+def test_concurrent_cache_writes_do_not_clobber_each_other(tmp_path):
+    async def run():
+        await asyncio.gather(*(write_json_atomic(tmp_path / "value.json", {"index": index}) for index in range(20)))
+
+    asyncio.run(run())
+    assert json.loads((tmp_path / "value.json").read_text(encoding="utf-8"))["index"] in range(20)
+    assert [path.name for path in tmp_path.iterdir()] == ["value.json"]
@@ -0,0 +1,130 @@
+# d:\Users\onisi\Documents\web-app-dev\backend\tests\test_prompt_scanner.py
+"""
+プロンプトテンプレートの抽出関数のテスト。
+
+以前の正規表現による実装を比較対象として残し、タグの入れ子・繰り返し・閉じられていないタグ、
+比較演算子などのタグではない "<"、"{" を含む変数名などで結果が変わらないことを確認する。
+find_free_floating_variables だけは意図して挙動を変えており、同じ変数の 2 回目以降の出現も報告する。
+"""
+import re
+
+import pytest
+
+from main import extract_between_tags, extract_variables, find_free_floating_variables
+from prompt_scanner import TagStreamExtractor, scan_prompt
+
+
+def legacy_extract_between_tags(tag, string, strip=False):
+    ext_list = re.findall(f"<{tag}>(.+?)</{tag}>", string, re.DOTALL)
+    if strip:
+        ext_list = [e.strip() for e in ext_list]
+    return ext_list
+
+
+def legacy_extract_variables(prompt_text):
+    return set(re.findall(r'\{\$([^}]+)\}', prompt_text))
+
+
+def legacy_first_free_floating_variables(prompt_text):
+    """ 変数ごとの最初の出現だけを判定する旧実装 (タグは集合で管理し、閉じタグで同名のタグをすべて閉じる)。 """
+    free_floating_variables = []
+    for variable in re.findall(r'\{\$[A-Z0-9_]+\}', prompt_text):
+        preceding_text = prompt_text[:prompt_text.index(variable)]
+        open_tags = set()
+        i = 0
+        while i < len(preceding_text):
+            if preceding_text[i] == '<':
+                if i + 1 < len(preceding_text) and preceding_text[i + 1] == '/':
+                    closing_tag = preceding_text[i + 2:].split('>', 1)[0]
+                    open_tags.discard(closing_tag)
+                    i += len(closing_tag) + 3
+                else:
+                    opening_tag = preceding_text[i + 1:].split('>', 1)[0]
+                    open_tags.add(opening_tag)
+                    i += len(opening_tag) + 2
+            else:
+                i += 1
+        if not open_tags:
+            free_floating_variables.append(variable)
+    return free_floating_variables
+
+
+TEMPLATES = [
+    "<Instructions>\nUse {$DOC}.\n</Instructions>",
+    "<a>1</a> and <a>2</a>",
+    "<a>outer <a>inner</a> tail</a>",
+    "<a> mentions <a>real</a> here",
+    "<a></a><a>x</a>",
+    "<Instructions>first</Instructions> then <Instructions>second</Instructions>",
+    "{$A{B} and {$C} and {$lower}",
+    "Intro {$X}\n<doc>{$Y}</doc>\nOutro {$Z}",
+    "<a><a>{$X}</a>{$Y}</a>{$Z}",
+    "<a>{$X} <b>{$Y}</b></a> {$Z}",
+    "<unclosed> {$X}",
+    "{$X} <doc>{$X}</doc> {$X}",
+    "if x < 3 then {$Y}",
+    "score <= 5 {$Q}",
+    "<a>{$X}</a> a<b {$Z}",
+    "<a {$X} b> {$Y}",
+    "<a>{$X}</a {$Y}",
+    "{$A{$B} and {$B}",
+]
+
+
+@pytest.mark.parametrize("template", TEMPLATES)
+def test_extract_between_tags_matches_legacy(template):
+    for tag in ("a", "Instructions", "doc"):
+        assert extract_between_tags(tag, template) == legacy_extract_between_tags(tag, template)
+        assert extract_between_tags(tag, template, strip=True) == legacy_extract_between_tags(tag, template, strip=True)
+
+
+@pytest.mark.parametrize("template", TEMPLATES)
+def test_extract_variables_matches_legacy(template):
+    assert extract_variables(template) == legacy_extract_variables(template)
+
+
+@pytest.mark.parametrize("template", TEMPLATES)
+def test_first_free_floating_usage_matches_legacy(template):
+    first_usages = {}
+    for usage in scan_prompt(template).variables:
+        first_usages.setdefault(usage.text, usage)
+    first_free = [text for text, usage in first_usages.items() if usage.is_free_floating]
+    assert first_free == list(dict.fromkeys(legacy_first_free_floating_variables(template)))
+
+
+def test_nested_tags_pair_with_first_closer():
+    assert extract_between_tags("a", "<a>outer <a>inner</a> tail</a>") == ["outer <a>inner"]
+    assert extract_between_tags("a", "<a>1</a> and <a>2</a>") == ["1", "2"]
+
+
+def test_variable_names_may_contain_open_brace():
+    assert extract_variables("{$A{B} {$C}") == {"A{B", "C"}
+
+
+def test_closing_tag_closes_all_openers_of_same_name():
+    assert find_free_floating_variables("<a><a>{$X}</a>{$Y}</a>{$Z}") == ["{$Y}", "{$Z}"]
+
+
+def test_every_free_floating_occurrence_is_reported():
+    assert find_free_floating_variables("{$X} <doc>{$X}</doc> {$X}") == ["{$X}", "{$X}"]
+
+
+def test_unclosed_tag_stays_open():
+    assert find_free_floating_variables("<unclosed> {$X}") == []
+
+
+@pytest.mark.parametrize("template", ["if x < 3 then {$Y}", "score <= 5 {$Q}", "<a>{$X}</a> a<b {$Z}"])
+def test_stray_angle_bracket_opens_a_tag(template):
+    assert find_free_floating_variables(template) == []
+
+
+def test_enclosing_tags_keep_first_open_order():
+    scan = scan_prompt("<a><b><a>{$X}</a>{$Y}<a></b>{$Z}")
+    assert [usage.enclosing_tags for usage in scan.variables] == [("a", "b"), ("b",), ("a",)]
+
+
+def test_tag_stream_extractor_handles_split_tags():
+    extractor = TagStreamExtractor("Instructions")
+    pieces = ["pre <Instr", "uctions>hel", "lo</Instr", "uctions> ignored"]
+    assert "".join(extractor.feed(piece) for piece in pieces) == "hello"
+    assert extractor.closed and extractor.content == "hello"
@@ -0,0 +1,59 @@
+# d:\Users\onisi\Documents\web-app-dev\backend\tests\test_rate_limiter.py
+""" RateLimitScheduler のテスト。 """
+import asyncio
+import time
+
+import pytest
+
+from rate_limiter import RateLimitScheduler, estimate_text_tokens, parse_reset_duration
+
+MODEL = "test-model"
+
+
+def make_scheduler(tokens_per_minute=6000):
+    return RateLimitScheduler({"requests_per_minute": 30, "tokens_per_minute": tokens_per_minute})
+
+
+def test_headers_do_not_erase_in_flight_reservations():
+    scheduler = make_scheduler()
+
+    async def run():
+        return await scheduler.acquire(MODEL, 1000), await scheduler.acquire(MODEL, 1500)
+
+    first, second = asyncio.run(run())
+    # first の応答: Groq は first だけを数えており、second (処理中) の予約はまだ含まれていない
+    scheduler.update_from_headers(MODEL, {"x-ratelimit-remaining-tokens": "5000"}, 200, first)
+    stats = scheduler.stats()[MODEL]
+    assert stats["tokens_in_flight"] == 1500
+    assert stats["tokens_available"] == pytest.approx(3500, abs=1)
+
+    scheduler.update_from_headers(MODEL, {"x-ratelimit-remaining-tokens": "3600"}, 200, second)
+    assert scheduler.stats()[MODEL]["tokens_in_flight"] == 0
+    assert scheduler.stats()[MODEL]["tokens_available"] == pytest.approx(3600, abs=1)
+
+
+def test_release_is_idempotent():
+    scheduler = make_scheduler()
+    reservation = asyncio.run(scheduler.acquire(MODEL, 1000))
+    scheduler.release(reservation)
+    scheduler.release(reservation)
+    assert scheduler.stats()[MODEL]["tokens_in_flight"] == 0
+
+
+def test_rate_limited_response_blocks_until_retry_after():
+    scheduler = make_scheduler()
+    scheduler.update_from_headers(MODEL, {"retry-after": "2"}, 429)
+    assert 1.5 < scheduler.stats()[MODEL]["blocked_for_seconds"] <= 2
+    assert scheduler._budget(MODEL).blocked_until > time.monotonic()
+
+
+def test_parse_reset_duration():
+    assert parse_reset_duration("2m59.5s") == pytest.approx(179.5)
+    assert parse_reset_duration("120ms") == pytest.approx(0.12)
+    assert parse_reset_duration("7") == 7.0
+    assert parse_reset_duration("soon") is None
+
+
+def test_estimate_text_tokens_counts_japanese_per_character():
+    assert estimate_text_tokens("abcdefgh") == 2
+    assert estimate_text_tokens("こんにちは") == 5
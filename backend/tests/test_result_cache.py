@@ -0,0 +1,38 @@
+# d:\Users\onisi\Documents\web-app-dev\backend\tests\test_result_cache.py
+""" ResultCache のディスク層の上限と削除のテスト。 """
+import asyncio
+
+from result_cache import ResultCache, make_cache_key
+
+
+def keys(count):
+    return [make_cache_key({"index": index}) for index in range(count)]
+
+
+def test_disk_tier_evicts_least_recently_used(tmp_path):
+    first, second, third = keys(3)
+
+    async def run():
+        cache = ResultCache("test", max_entries=1, disk_dir=tmp_path, max_disk_entries=2)
+        await cache.set(first, {"value": 1})
+        await cache.set(second, {"value": 2})
+        assert await cache.get(first) == {"value": 1}  # ディスクから読んだ first が最新になる
+        await cache.set(third, {"value": 3})
+        return cache
+
+    cache = asyncio.run(run())
+    assert sorted(path.stem for path in tmp_path.glob("*/*.json")) == sorted([first, third])
+    assert cache.stats()["disk_entries"] == 2
+    assert cache.stats()["disk_evictions"] == 1
+
+
+def test_disk_tier_limit_applies_to_existing_files(tmp_path):
+    async def fill():
+        cache = ResultCache("test", disk_dir=tmp_path, max_disk_entries=10)
+        for key in keys(5):
+            await cache.set(key, {"key": key})
+
+    asyncio.run(fill())
+    cache = ResultCache("test", disk_dir=tmp_path, max_disk_entries=3)
+    assert len(list(tmp_path.glob("*/*.json"))) == 3
+    assert cache.stats()["disk_entries"] == 3
@@ -0,0 +1,124 @@
+# d:\Users\onisi\Documents\web-app-dev\backend\tests\test_resumable_uploads.py
+""" ResumableUploadManager の finalize と、破棄後・finalize 中の append のテスト。 """
+import asyncio
+import hashlib
+import shutil
+
+import pytest
+
+from resumable_uploads import ResumableUploadError, ResumableUploadManager
+
+DATA = b"0123456789" * 100
+
+
+async def chunks(data):
+    yield data
+
+
+def test_concurrent_finalize_stores_once(tmp_path):
+    manager = ResumableUploadManager(tmp_path, max_size_bytes=1024 * 1024, max_chunk_bytes=1024 * 1024, ttl_seconds=3600)
+    stored = []
+
+    async def store(data_path, state, sha256):
+        await asyncio.sleep(0.01)
+        stored.append(data_path.read_bytes())
+        data_path.unlink()
+        return {"sha256": sha256, "filename": state["filename"]}
+
+    async def run():
+        state = await manager.create("data.bin", "application/octet-stream", len(DATA), hashlib.sha256(DATA).hexdigest())
+        await manager.append(state["upload_id"], 0, chunks(DATA))
+        results = await asyncio.gather(*(manager.finalize(state["upload_id"], store) for _ in range(3)))
+        with pytest.raises(ResumableUploadError) as excinfo:
+            await manager.append(state["upload_id"], 0, chunks(b"x"))
+        return state, results, excinfo.value.status_code
+
+    state, results, append_status = asyncio.run(run())
+    assert stored == [DATA]
+    assert results == [{"sha256": hashlib.sha256(DATA).hexdigest(), "filename": "data.bin"}] * 3
+    assert append_status == 409
+    assert manager.status(state["upload_id"])["finalized"]
+    assert manager.stats() == {"in_progress": 0, "completed": 1}
+
+
+def test_failed_store_discards_upload(tmp_path):
+    manager = ResumableUploadManager(tmp_path, max_size_bytes=1024 * 1024, max_chunk_bytes=1024 * 1024, ttl_seconds=3600)
+
+    async def store(data_path, state, sha256):
+        raise RuntimeError("store failed")
+
+    async def run():
+        state = await manager.create("data.bin", None, len(DATA), None)
+        await manager.append(state["upload_id"], 0, chunks(DATA))
+        with pytest.raises(RuntimeError):
+            await manager.finalize(state["upload_id"], store)
+        return state
+
+    state = asyncio.run(run())
+    with pytest.raises(ResumableUploadError) as excinfo:
+        manager.status(state["upload_id"])
+    assert excinfo.value.status_code == 404
+
+
+def test_append_after_discard_is_404(tmp_path):
+    manager = ResumableUploadManager(tmp_path, max_size_bytes=1024 * 1024, max_chunk_bytes=1024 * 1024, ttl_seconds=3600)
+
+    async def run():
+        state = await manager.create("data.bin", None, len(DATA), None)
+        read_state = manager._read_state
+
+        def read_then_discard(upload_id):
+            # 状態を読んだ直後に別のリクエストが破棄した場合を再現する
+            state = read_state(upload_id)
+            shutil.rmtree(manager._upload_dir(upload_id))
+            return state
+
+        manager._read_state = read_then_discard
+        with pytest.raises(ResumableUploadError) as excinfo:
+            await manager.append(state["upload_id"], 0, chunks(DATA))
+        return excinfo.value.status_code
+
+    assert asyncio.run(run()) == 404
+
+
+def test_finalize_waits_for_chunk_in_flight(tmp_path):
+    manager = ResumableUploadManager(tmp_path, max_size_bytes=1024 * 1024, max_chunk_bytes=1024 * 1024, ttl_seconds=3600)
+    stored = []
+
+    async def store(data_path, state, sha256):
+        stored.append((data_path.read_bytes(), sha256))
+        data_path.unlink()
+        return {"sha256": sha256}
+
+    async def run():
+        state = await manager.create("data.bin", None, len(DATA), hashlib.sha256(DATA).hexdigest())
+        upload_id = state["upload_id"]
+        await manager.append(upload_id, 0, chunks(DATA))
+
+        release = asyncio.Event()
+
+        async def slow_retry():
+            # 受信済みの範囲の再送が、finalize の開始時点でまだ書き込み中
+            yield DATA[:10]
+            await release.wait()
+            yield DATA[10:20]
+
+        retry = asyncio.create_task(manager.append(upload_id, 0, slow_retry()))
+        await asyncio.sleep(0.01)
+        finalize = asyncio.create_task(manager.finalize(upload_id, store))
+        await asyncio.sleep(0.01)
+        finalize_waited = not finalize.done()
+        late = asyncio.create_task(manager.append(upload_id, 0, chunks(b"x")))
+        await asyncio.sleep(0.01)
+        release.set()
+        await retry
+        result = await finalize
+        with pytest.raises(ResumableUploadError) as excinfo:
+            await late
+        return finalize_waited, result, excinfo.value.status_code
+
+    finalize_waited, result, late_status = asyncio.run(run())
+    assert finalize_waited
+    assert stored == [(DATA, hashlib.sha256(DATA).hexdigest())]
+    assert result == {"sha256": hashlib.sha256(DATA).hexdigest()}
+    assert late_status == 409
@@ -0,0 +1,66 @@
+# d:\Users\onisi\Documents\web-app-dev\backend\tests\test_single_flight.py
+""" SingleFlight の同時呼び出しのまとめ方と fan-in の集計のテスト。 """
+import asyncio
+
+import pytest
+
+from single_flight import SingleFlight
+
+
+def test_concurrent_calls_share_one_execution():
+    flights = SingleFlight("test")
+    calls = []
+
+    async def factory(value):
+        calls.append(value)
+        await asyncio.sleep(0.01)
+        return value
+
+    async def run():
+        same = [flights.do("key", lambda: factory("key")) for _ in range(5)]
+        return await asyncio.gather(*same, flights.do("other", lambda: factory("other")))
+
+    assert asyncio.run(run()) == ["key"] * 5 + ["other"]
+    assert calls == ["key", "other"]
+    stats = flights.stats()
+    assert (stats["executions"], stats["coalesced"], stats["max_fan_in"], stats["in_flight"]) == (2, 4, 5, 0)
+
+
+def test_exception_is_shared_and_key_is_released():
+    flights = SingleFlight("test")
+
+    async def failing():
+        await asyncio.sleep(0.01)
+        raise ValueError("upstream failed")
+
+    async def succeeding():
+        return "ok"
+
+    async def run():
+        results = await asyncio.gather(flights.do("key", failing), flights.do("key", failing), return_exceptions=True)
+        assert all(isinstance(result, ValueError) for result in results)
+        # 完了後は同じキーでも新しく実行する
+        return await flights.do("key", succeeding)
+
+    assert asyncio.run(run()) == "ok"
+    assert flights.stats()["executions"] == 2
+
+
+def test_cancelled_waiter_does_not_cancel_shared_task():
+    flights = SingleFlight("test")
+
+    async def factory():
+        await asyncio.sleep(0.02)
+        return "done"
+
+    async def run():
+        first = asyncio.ensure_future(flights.do("key", factory))
+        second = asyncio.ensure_future(flights.do("key", factory))
+        await asyncio.sleep(0)
+        first.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        return await second
+
+    assert asyncio.run(run()) == "done"
+    assert flights.stats()["max_fan_in"] == 2
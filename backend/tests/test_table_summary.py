@@ -0,0 +1,90 @@
+# d:\Users\onisi\Documents\web-app-dev\backend\tests\test_table_summary.py
+""" TableSummarizer のサイドカーキャッシュと、JSON の逐次読み込みのテスト。 """
+import asyncio
+import io
+import json
+from concurrent.futures.process import BrokenProcessPool
+
+import pytest
+
+import table_summary
+from table_summary import TableSummarizer
+
+
+def make_entry(tmp_path, content: bytes, filename: str = "data.csv", content_type: str = "text/csv"):
+    path = tmp_path / filename
+    path.write_bytes(content)
+    return {"path": str(path), "sha256": "0" * 64, "filename": filename, "content_type": content_type}
+
+
+def test_summary_is_cached(tmp_path):
+    summarizer = TableSummarizer()
+    entry = make_entry(tmp_path, b"a,b\n1,x\n2,y\n")
+    try:
+        summary = asyncio.run(summarizer.summarize(entry))
+    finally:
+        summarizer.shutdown()
+    assert summary["rows"] == 2
+    assert summarizer.cache_path(entry).exists()
+
+
+def test_transient_failure_is_not_cached(tmp_path, monkeypatch):
+    summarizer = TableSummarizer()
+    entry = make_entry(tmp_path, b"a,b\n1,x\n")
+
+    async def broken_pool(func, *args):
+        raise BrokenProcessPool("worker died")
+
+    monkeypatch.setattr(summarizer._pool, "run", broken_pool)
+    assert asyncio.run(summarizer.summarize(entry)) is None
+    assert not summarizer.cache_path(entry).exists()
+    assert summarizer.failures == 1
+
+
+def test_parse_error_is_cached_as_null(tmp_path, monkeypatch):
+    summarizer = TableSummarizer()
+    entry = make_entry(tmp_path, b'{"a": [1, 2', "data.json", "application/json")
+
+    async def run_inline(func, *args):
+        return func(*args)
+
+    monkeypatch.setattr(summarizer._pool, "run", run_inline)
+    assert asyncio.run(summarizer.summarize(entry)) is None
+    assert json.loads(summarizer.cache_path(entry).read_text(encoding="utf-8")) is None
+    assert summarizer.failures == 1
+
+
+class _CountingReader(io.StringIO):
+    def __init__(self, text):
+        super().__init__(text)
+        self.reads = 0
+
+    def read(self, size=-1):
+        self.reads += 1
+        return super().read(size)
+
+
+def test_json_array_and_lines_are_read_value_by_value(monkeypatch):
+    monkeypatch.setattr(table_summary, "READ_CHUNK_CHARS", 16)
+    array = json.dumps([{"a": index} for index in range(50)])
+    lines = "\n".join(json.dumps({"a": index}) for index in range(50))
+    assert list(table_summary._iter_json_values(io.StringIO(array))) == [{"a": index} for index in range(50)]
+    assert list(table_summary._iter_json_values(io.StringIO(lines))) == [{"a": index} for index in range(50)]
+
+
+def test_large_top_level_value_is_read_in_growing_chunks(monkeypatch):
+    monkeypatch.setattr(table_summary, "READ_CHUNK_CHARS", 16)
+    value = {f"key_{index}": index for index in range(2000)}
+    reader = _CountingReader(json.dumps(value))
+    assert list(table_summary._iter_json_values(reader)) == [value]
+    # 16 文字ずつ読み足すと数千回になるが、倍々に読み足すため数十回で済む
+    assert reader.reads < 20
+
+
+def test_oversized_json_value_is_rejected(monkeypatch):
+    monkeypatch.setattr(table_summary, "READ_CHUNK_CHARS", 16)
+    monkeypatch.setattr(table_summary, "MAX_JSON_VALUE_CHARS", 1000)
+    reader = io.StringIO(json.dumps({f"key_{index}": index for index in range(2000)}))
+    with pytest.raises(ValueError, match="JSON の値が大きすぎます"):
+        list(table_summary._iter_json_values(reader))
+    assert reader.tell() <= 1001 + 16
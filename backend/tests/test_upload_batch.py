@@ -0,0 +1,23 @@
+# d:\Users\onisi\Documents\web-app-dev\backend\tests\test_upload_batch.py
+""" 一括アップロードの項目ごとのエラー応答のテスト。 """
+from fastapi import HTTPException
+from fastapi.testclient import TestClient
+
+import main
+
+
+def test_unexpected_error_fails_only_that_item(monkeypatch):
+    async def fake_store(file, sha256, upload_settings):
+        if file.filename == "bad.txt":
+            raise OSError("disk full")
+        if file.filename == "large.txt":
+            raise HTTPException(status_code=413, detail="too large")
+        return {"filename": file.filename, "upload_id": "0" * 64}
+
+    monkeypatch.setattr(main, "store_uploaded_file", fake_store)
+    files = [("files", (name, b"x", "text/plain")) for name in ("ok.txt", "bad.txt", "large.txt")]
+    response = TestClient(main.app).post("/api/upload/batch", files=files)
+    assert response.status_code == 200
+    body = response.json()
+    assert (body["succeeded"], body["failed"]) == (1, 2)
+    assert [result.get("status_code") for result in body["results"]] == [None, 500, 413]
@@ -0,0 +1,64 @@
+# d:\Users\onisi\Documents\web-app-dev\backend\tests\test_upload_store.py
+""" UploadStore の索引の書き込みのまとめ方と、欠けたエントリの整理のテスト。 """
+import asyncio
+import json
+
+from upload_store import UploadStore
+
+SHA256 = "ab" + "0" * 62
+
+
+def make_store(tmp_path, flush_delay=0.05):
+    return UploadStore(tmp_path / "store", tmp_path / "index.json", flush_delay)
+
+
+async def put_file(store, tmp_path, sha256=SHA256):
+    temp_path = tmp_path / f"{sha256}.part"
+    temp_path.write_bytes(b"data")
+    return await store.put(sha256, temp_path, "a.txt", "text/plain", 4)
+
+
+def test_changes_are_written_once_after_delay(tmp_path):
+    store = make_store(tmp_path)
+
+    async def scenario():
+        await put_file(store, tmp_path)
+        await store.update(SHA256, groq_status="queued")
+        await store.update(SHA256, groq_status="uploaded", groq_file_id="file_1")
+        assert not store.index_path.exists()
+        await asyncio.sleep(0.2)
+
+    asyncio.run(scenario())
+    assert store.index_writes == 1
+    index = json.loads(store.index_path.read_text(encoding="utf-8"))
+    assert index[SHA256]["groq_file_id"] == "file_1"
+
+
+def test_close_writes_pending_changes(tmp_path):
+    store = make_store(tmp_path, flush_delay=60)
+
+    async def scenario():
+        await put_file(store, tmp_path)
+        await store.close()
+
+    asyncio.run(scenario())
+    assert store.index_writes == 1
+    assert SHA256 in json.loads(store.index_path.read_text(encoding="utf-8"))
+    assert make_store(tmp_path).get(SHA256) is not None
+
+
+def test_prune_missing_removes_deleted_blobs(tmp_path):
+    store = make_store(tmp_path, flush_delay=60)
+
+    async def scenario():
+        entry = await put_file(store, tmp_path)
+        await put_file(store, tmp_path, "cd" + "0" * 62)
+        await store.close()
+        (tmp_path / "store" / "ab" / f"{SHA256}.txt").unlink()
+        assert entry["path"].endswith(f"{SHA256}.txt")
+        pruned = await store.prune_missing()
+        await store.close()
+        return pruned
+
+    assert asyncio.run(scenario()) == [SHA256]
+    assert list(json.loads(store.index_path.read_text(encoding="utf-8"))) == ["cd" + "0" * 62]
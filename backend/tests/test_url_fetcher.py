@@ -0,0 +1,216 @@
+# d:\Users\onisi\Documents\web-app-dev\backend\tests\test_url_fetcher.py
+"""
+UrlFetcher のテスト。ループバックで起動した http.server を取得先にする
+(内部ネットワークの拒否を確認するテスト以外は allow_private_networks=True で接続する)。
+"""
+import asyncio
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List
+
+import pytest
+
+import url_fetcher
+from url_fetcher import UrlFetcher, UrlFetchError
+
+DOC_BODY = "<html><body><p>こんにちは</p></body></html>".encode()
+LAST_MODIFIED = "Wed, 01 Jan 2025 00:00:00 GMT"
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    requests: List[Dict[str, str]] = []
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status: int, body: bytes = b"", headers: Dict[str, str] = {}):
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        _Handler.requests.append({"path": self.path, **{name.lower(): value for name, value in self.headers.items()}})
+        if self.path == "/etag":
+            if self.headers.get("If-None-Match") == '"v1"':
+                return self._send(304, headers={"ETag": '"v1"'})
+            return self._send(200, DOC_BODY, {"Content-Type": "text/html; charset=utf-8", "ETag": '"v1"'})
+        if self.path == "/modified":
+            if self.headers.get("If-Modified-Since") == LAST_MODIFIED:
+                return self._send(304)
+            return self._send(200, b"a,b\n1,2\n", {"Content-Type": "text/csv", "Last-Modified": LAST_MODIFIED})
+        if self.path.startswith("/redirect/"):
+            remaining = int(self.path.rsplit("/", 1)[-1])
+            return self._send(302, headers={"Location": "/etag" if remaining == 0 else f"/redirect/{remaining - 1}"})
+        if self.path.startswith("/to/"):
+            return self._send(302, headers={"Location": self.path[len("/to/"):]})
+        if self.path == "/chunked":
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            try:
+                for _ in range(64):
+                    chunk = b"x" * 4096
+                    self.wfile.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+                self.wfile.write(b"0\r\n\r\n")
+            except OSError:
+                pass
+            return
+        if self.path == "/zip":
+            return self._send(200, b"PK" + b"\0" * 4096, {"Content-Type": "application/zip"})
+        return self._send(404, b"not found")
+
+
+@pytest.fixture(scope="module")
+def server():
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{httpd.server_address[1]}"
+    httpd.shutdown()
+    httpd.server_close()
+
+
+@pytest.fixture(autouse=True)
+def clear_requests():
+    _Handler.requests.clear()
+
+
+def run_fetcher(tmp_path, action, **options):
+    """ UrlFetcher を作って action(fetcher) を実行し、接続プールを閉じる。 """
+    async def run():
+        fetcher = UrlFetcher(tmp_path, tmp_path / "url_cache.json", **{"allow_private_networks": True, **options})
+        try:
+            return await action(fetcher)
+        finally:
+            await fetcher.close()
+
+    return asyncio.run(run())
+
+
+def fetch(fetcher, url, max_bytes=1024 * 1024, allowed_types=(), is_stored=lambda sha256: True, **kwargs):
+    return fetcher.fetch(url, max_bytes=max_bytes, allowed_types=list(allowed_types), is_stored=is_stored, **kwargs)
+
+
+def temp_files(tmp_path):
+    return sorted(path.name for path in tmp_path.glob(".url-*"))
+
+
+def test_follows_redirects_up_to_limit(server, tmp_path):
+    fetched = run_fetcher(tmp_path, lambda fetcher: fetch(fetcher, f"{server}/redirect/1"), max_redirects=2)
+    assert fetched.url == f"{server}/etag"
+    assert fetched.temp_path.read_bytes() == DOC_BODY
+
+
+def test_too_many_redirects_is_502(server, tmp_path):
+    with pytest.raises(UrlFetchError) as excinfo:
+        run_fetcher(tmp_path, lambda fetcher: fetch(fetcher, f"{server}/redirect/2"), max_redirects=2)
+    assert excinfo.value.status_code == 502
+    assert [request["path"] for request in _Handler.requests] == ["/redirect/2", "/redirect/1", "/redirect/0"]
+
+
+def test_streaming_body_over_limit_is_413_and_removes_temp_file(server, tmp_path):
+    with pytest.raises(UrlFetchError) as excinfo:
+        run_fetcher(tmp_path, lambda fetcher: fetch(fetcher, f"{server}/chunked", max_bytes=64 * 1024), chunk_size=4096)
+    assert excinfo.value.status_code == 413
+    assert temp_files(tmp_path) == []
+
+
+def test_disallowed_type_is_415_before_reading_body(server, tmp_path):
+    with pytest.raises(UrlFetchError) as excinfo:
+        run_fetcher(tmp_path, lambda fetcher: fetch(fetcher, f"{server}/zip", allowed_types=["text/plain"]))
+    assert excinfo.value.status_code == 415
+    assert temp_files(tmp_path) == []
+
+
+def test_etag_revalidation_reuses_stored_content(server, tmp_path):
+    async def action(fetcher):
+        return await fetch(fetcher, f"{server}/etag"), await fetch(fetcher, f"{server}/etag")
+
+    first, second = run_fetcher(tmp_path, action)
+    assert not first.not_modified
+    assert second.not_modified and second.temp_path is None
+    assert second.sha256 == first.sha256 and second.filename == first.filename
+    assert _Handler.requests[-1]["if-none-match"] == '"v1"'
+
+
+def test_last_modified_revalidation(server, tmp_path):
+    async def action(fetcher):
+        return await fetch(fetcher, f"{server}/modified"), await fetch(fetcher, f"{server}/modified")
+
+    first, second = run_fetcher(tmp_path, action)
+    assert not first.not_modified and second.not_modified
+    assert _Handler.requests[-1]["if-modified-since"] == LAST_MODIFIED
+
+
+def test_unconditional_request_when_not_stored_or_not_revalidating(server, tmp_path):
+    async def action(fetcher):
+        await fetch(fetcher, f"{server}/etag")
+        missing = await fetch(fetcher, f"{server}/etag", is_stored=lambda sha256: False)
+        forced = await fetch(fetcher, f"{server}/etag", revalidate=False)
+        return missing, forced
+
+    missing, forced = run_fetcher(tmp_path, action)
+    assert not missing.not_modified and not forced.not_modified
+    assert all("if-none-match" not in request for request in _Handler.requests)
+
+
+def test_private_address_is_rejected(server, tmp_path):
+    with pytest.raises(UrlFetchError) as excinfo:
+        run_fetcher(tmp_path, lambda fetcher: fetch(fetcher, f"{server}/etag"), allow_private_networks=False)
+    assert excinfo.value.status_code == 400
+    assert _Handler.requests == []
+
+
+@pytest.mark.parametrize("url", ["http://localhost:1/", "http://169.254.169.254/latest/meta-data/", "http://[::1]:1/"])
+def test_private_targets_are_refused_by_the_real_client(tmp_path, url):
+    # 名前解決とアドレスの確認は実際の接続プールのネットワーク層で行われる (httpx の差し替えが効いていること)
+    with pytest.raises(UrlFetchError) as excinfo:
+        run_fetcher(tmp_path, lambda fetcher: fetch(fetcher, url), allow_private_networks=False)
+    assert excinfo.value.status_code == 400
+
+
+def test_private_redirect_hop_is_rejected(server, tmp_path, monkeypatch):
+    # 127.0.0.1 (最初の接続先) だけを公開アドレスとみなし、リダイレクト先の 127.0.0.2 を拒否させる
+    monkeypatch.setattr(url_fetcher, "is_blocked_address", lambda address: address != "127.0.0.1")
+    port = server.rsplit(":", 1)[-1]
+    with pytest.raises(UrlFetchError) as excinfo:
+        run_fetcher(tmp_path, lambda fetcher: fetch(fetcher, f"{server}/to/http://127.0.0.2:{port}/etag"), allow_private_networks=False)
+    assert excinfo.value.status_code == 400
+    assert [request["path"] for request in _Handler.requests] == [f"/to/http://127.0.0.2:{port}/etag"]
+
+
+def test_connects_to_vetted_address(server, tmp_path, monkeypatch):
+    # 確認時の名前解決の結果に接続し、httpx 側で名前解決し直さないこと (DNS rebinding 対策)
+    resolved: List[str] = []
+
+    async def resolve_addresses(host, port):
+        resolved.append(host)
+        return ["127.0.0.1"]
+
+    monkeypatch.setattr(url_fetcher, "resolve_addresses", resolve_addresses)
+    monkeypatch.setattr(url_fetcher, "is_blocked_address", lambda address: False)
+    port = server.rsplit(":", 1)[-1]
+    fetched = run_fetcher(tmp_path, lambda fetcher: fetch(fetcher, f"http://pinned.invalid:{port}/etag"), allow_private_networks=False)
+    assert fetched.temp_path.read_bytes() == DOC_BODY
+    assert resolved == ["pinned.invalid"]
+    assert _Handler.requests[-1]["host"] == f"pinned.invalid:{port}"
+
+
+def test_cache_writes_are_batched_and_flushed_on_close(server, tmp_path):
+    async def action(fetcher):
+        await fetch(fetcher, f"{server}/etag")
+        await fetch(fetcher, f"{server}/etag")
+        await fetch(fetcher, f"{server}/modified")
+        assert not (tmp_path / "url_cache.json").exists()
+        return fetcher
+
+    fetcher = run_fetcher(tmp_path, action, cache_flush_delay=60)
+    assert fetcher.stats()["cache_writes"] == 1
+    # 書き込んだ記録は次に起動した UrlFetcher の再検証に使われる
+    second = run_fetcher(tmp_path, lambda fetcher: fetch(fetcher, f"{server}/etag"))
+    assert second.not_modified
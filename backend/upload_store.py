@@ -0,0 +1,162 @@
+# d:\Users\onisi\Documents\web-app-dev\backend\upload_store.py
+"""
+SHA-256 をキーとするコンテンツアドレス型のアップロードストア。
+
+ファイル本体は <root>/<sha256 の先頭2文字>/<sha256><拡張子> に保存し、
+ハッシュからローカルパス・元のファイル名・Groq の file id などを引ける索引を JSON で永続化する。
+同じ内容のファイルは 1 度だけ保存され、Groq へのアップロードも 1 度で済む。
+索引は変更のたびに書き込まず、flush_delay 秒以内の変更をまとめて 1 回で書き込む
+(アップロード 1 件で登録・Groq の状態更新が数回起きるため)。終了時は close() で書き残しを保存する。
+"""
+import os
+import json
+import time
+import asyncio
+import logging
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class UploadStore:
+    """ コンテンツアドレス型のファイル保存先と、その索引。 """
+
+    def __init__(self, root: Path, index_path: Path, flush_delay: float = 1.0):
+        self.root = root
+        self.index_path = index_path
+        self.flush_delay = flush_delay
+        self.root.mkdir(parents=True, exist_ok=True)
+        self._index: Dict[str, Dict[str, Any]] = self._load_index()
+        self._lock = asyncio.Lock()
+        # 書き込み中の索引より古いスナップショットが後から書かれないよう、書き込みは 1 つずつ行う
+        self._write_lock = asyncio.Lock()
+        self._dirty = False
+        self._flush_task: Optional[asyncio.Task] = None
+        self.deduplicated = 0
+        self.index_writes = 0
+
+    def _load_index(self) -> Dict[str, Dict[str, Any]]:
+        try:
+            with open(self.index_path, "r", encoding="utf-8") as f:
+                index = json.load(f)
+            logger.info(f"アップロード索引を読み込みました: {len(index)} 件 ({self.index_path})")
+            return index
+        except FileNotFoundError:
+            return {}
+        except (OSError, json.JSONDecodeError) as e:
+            logger.error(f"アップロード索引を読み込めませんでした。空の索引で開始します ({self.index_path}): {e}")
+            return {}
+
+    def _write_index(self, snapshot: Dict[str, Dict[str, Any]]) -> None:
+        tmp_path = self.index_path.with_suffix(".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(snapshot, f, ensure_ascii=False, separators=(",", ":"))
+        os.replace(tmp_path, self.index_path)
+
+    def _persist(self) -> None:
+        """ 索引の変更を記録し、flush_delay 秒後の書き込みを予約する (_lock を保持した状態で呼ぶ)。 """
+        self._dirty = True
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.ensure_future(self._flush_later())
+
+    async def _flush_later(self) -> None:
+        await asyncio.sleep(self.flush_delay)
+        try:
+            await self.flush()
+        except OSError as e:
+            logger.error(f"アップロード索引を書き込めませんでした ({self.index_path}): {e}")
+
+    async def flush(self) -> None:
+        """ 未保存の変更があれば索引を書き込む。 """
+        async with self._write_lock:
+            async with self._lock:
+                if not self._dirty:
+                    return
+                snapshot = {sha256: dict(entry) for sha256, entry in self._index.items()}
+                self._dirty = False
+            try:
+                await asyncio.to_thread(self._write_index, snapshot)
+            except OSError:
+                self._dirty = True
+                raise
+            self.index_writes += 1
+
+    async def close(self) -> None:
+        """ 予約済みの書き込みを取り消し、未保存の変更をすぐに書き込む。 """
+        if self._flush_task is not None and not self._flush_task.done():
+            self._flush_task.cancel()
+        self._flush_task = None
+        await self.flush()
+
+    def blob_path(self, sha256: str, filename: str) -> Path:
+        return self.root / sha256[:2] / f"{sha256}{Path(filename).suffix.lower()}"
+
+    def get(self, sha256: str) -> Optional[Dict[str, Any]]:
+        """ 索引に登録済みで、ファイルが実在するエントリを返す。 """
+        entry = self._index.get(sha256)
+        if entry is None or not Path(entry["path"]).exists():
+            return None
+        return entry
+
+    def entries(self) -> List[Tuple[str, Dict[str, Any]]]:
+        return list(self._index.items())
+
+    async def put(self, sha256: str, temp_path: Path, filename: str, content_type: Optional[str], size_bytes: int) -> Dict[str, Any]:
+        """
+        一時ファイルをストアに取り込み、索引エントリを返す。
+        同じ内容が既に登録済みの場合は一時ファイルを削除して既存のエントリを返す。
+        """
+        async with self._lock:
+            existing = self.get(sha256)
+            if existing is not None:
+                temp_path.unlink(missing_ok=True)
+                self.deduplicated += 1
+                return existing
+
+            path = self.blob_path(sha256, filename)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            os.replace(temp_path, path)
+            entry = {
+                "sha256": sha256,
+                "path": str(path),
+                "filename": filename,
+                "content_type": content_type,
+                "size_bytes": size_bytes,
+                "groq_file_id": None,
+                "created_at": time.time(),
+            }
+            self._index[sha256] = entry
+            self._persist()
+            return entry
+
+    async def update(self, sha256: str, **fields: Any) -> None:
+        """ エントリの項目 (groq_file_id など) を更新して永続化する。 """
+        async with self._lock:
+            entry = self._index.get(sha256)
+            if entry is None:
+                return
+            entry.update(fields)
+            self._persist()
+
+    def record_hit(self) -> None:
+        self.deduplicated += 1
+
+    async def prune_missing(self) -> List[str]:
+        """ ファイルが削除されたエントリを索引から取り除き、取り除いたエントリの SHA-256 を返す。 """
+        async with self._lock:
+            missing = [sha256 for sha256, entry in self._index.items() if not Path(entry["path"]).exists()]
+            for sha256 in missing:
+                del self._index[sha256]
+            if missing:
+                self._persist()
+        return missing
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "entries": len(self._index),
+            "total_bytes": sum(entry.get("size_bytes", 0) for entry in self._index.values()),
+            "deduplicated": self.deduplicated,
+            "index_writes": self.index_writes,
+            "index_dirty": self._dirty,
+        }
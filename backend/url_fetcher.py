@@ -0,0 +1,438 @@
+# d:\Users\onisi\Documents\web-app-dev\backend\url_fetcher.py
+"""
+/api/upload に URL で指定された文書の取得。
+
+全ての取得で 1 つの httpx.AsyncClient (接続プール) を共有する。
+リダイレクトは 1 回ずつ手動で辿り、回数の上限を確認する。
+接続先の確認は TCP 接続を張る層 (_VettedNetworkBackend) で行い、名前解決して確認したアドレスへそのまま接続する
+(確認後に httpx が名前解決し直すと DNS rebinding で内部アドレスへ接続されてしまうため)。
+本文は一時ファイルへストリーミングしながら SHA-256 を計算し、max_bytes を超えた時点で打ち切る。
+ETag / Last-Modified を返した URL は取得結果 (ストアの SHA-256) を記録し、
+次回は条件付きリクエストで再検証して、304 なら本文を再取得せずにストアの内容を使う。
+記録の書き込みは cache_flush_delay 秒ごとにまとめて行う (取得のたびに全件を書き直さない)。
+"""
+import os
+import re
+import json
+import time
+import uuid
+import socket
+import asyncio
+import hashlib
+import logging
+import contextlib
+import mimetypes
+import ipaddress
+from collections import OrderedDict
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, AsyncIterator, Callable, Dict, Iterable, Iterator, List, Optional
+from urllib.parse import unquote
+
+import aiofiles
+import httpcore
+import httpx
+
+logger = logging.getLogger(__name__)
+
+CONTENT_DISPOSITION_FILENAME_PATTERN = re.compile(r"""filename\*?\s*=\s*(?:UTF-8'')?["']?([^"';]+)""", re.I)
+GENERIC_CONTENT_TYPES = {"application/octet-stream", "binary/octet-stream"}
+
+
+class UrlFetchError(Exception):
+    """ URL の取得に失敗した場合に送出される。status_code はクライアントに返す HTTP ステータス。 """
+
+    def __init__(self, status_code: int, detail: str):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+
+
+async def resolve_addresses(host: str, port: int) -> List[str]:
+    """ host の TCP 接続先アドレスを (getaddrinfo の順に重複なく) 返す。 """
+    infos = await asyncio.get_running_loop().getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    return list(dict.fromkeys(info[4][0] for info in infos))
+
+
+def is_blocked_address(address: str) -> bool:
+    """ ループバック・プライベート・リンクローカルなど、インターネット上のアドレスでなければ真。 """
+    return not ipaddress.ip_address(address.split("%")[0]).is_global
+
+
+class _VettedNetworkBackend(httpcore.AsyncNetworkBackend):
+    """
+    接続時にホスト名を解決し、内部ネットワークのアドレスを拒否したうえで、確認したアドレスへ接続する。
+    TLS の SNI と Host ヘッダーは httpcore が元のホスト名で送るため、証明書の検証は変わらない。
+    """
+
+    def __init__(self, backend: httpcore.AsyncNetworkBackend, allow_private_networks: bool):
+        self._backend = backend
+        self._allow_private_networks = allow_private_networks
+
+    async def connect_tcp(
+        self,
+        host: str,
+        port: int,
+        timeout: Optional[float] = None,
+        local_address: Optional[str] = None,
+        socket_options: Optional[Iterable[Any]] = None,
+    ) -> httpcore.AsyncNetworkStream:
+        try:
+            addresses = await resolve_addresses(host, port)
+        except socket.gaierror:
+            raise UrlFetchError(502, f"ホスト名を解決できません: {host}")
+        if not self._allow_private_networks and any(is_blocked_address(address) for address in addresses):
+            logger.warning(f"内部ネットワークへの URL 取得を拒否しました: {host} ({', '.join(addresses)})")
+            raise UrlFetchError(400, "内部ネットワークのアドレスには接続できません。")
+        last_error: Optional[Exception] = None
+        for address in addresses:
+            try:
+                return await self._backend.connect_tcp(address, port, timeout=timeout, local_address=local_address, socket_options=socket_options)
+            except httpcore.ConnectError as e:
+                last_error = e
+        raise last_error or httpcore.ConnectError(f"接続先のアドレスがありません: {host}")
+
+    async def connect_unix_socket(self, path: str, timeout: Optional[float] = None, socket_options: Optional[Iterable[Any]] = None) -> httpcore.AsyncNetworkStream:
+        raise httpcore.ConnectError("UNIX ソケットへの接続は許可されていません。")
+
+    async def sleep(self, seconds: float) -> None:
+        await self._backend.sleep(seconds)
+
+
+# httpcore の例外と対応する httpx の例外 (より具体的な例外を先に並べる)
+HTTPCORE_EXCEPTIONS = (
+    (httpcore.ConnectTimeout, httpx.ConnectTimeout),
+    (httpcore.ReadTimeout, httpx.ReadTimeout),
+    (httpcore.WriteTimeout, httpx.WriteTimeout),
+    (httpcore.PoolTimeout, httpx.PoolTimeout),
+    (httpcore.TimeoutException, httpx.TimeoutException),
+    (httpcore.ConnectError, httpx.ConnectError),
+    (httpcore.ReadError, httpx.ReadError),
+    (httpcore.WriteError, httpx.WriteError),
+    (httpcore.NetworkError, httpx.NetworkError),
+    (httpcore.UnsupportedProtocol, httpx.UnsupportedProtocol),
+    (httpcore.LocalProtocolError, httpx.LocalProtocolError),
+    (httpcore.RemoteProtocolError, httpx.RemoteProtocolError),
+    (httpcore.ProtocolError, httpx.ProtocolError),
+)
+
+
+@contextlib.contextmanager
+def _httpx_errors() -> Iterator[None]:
+    """ httpcore の例外を対応する httpx の例外に変換する (UrlFetchError などはそのまま送出する)。 """
+    try:
+        yield
+    except Exception as e:
+        for httpcore_error, httpx_error in HTTPCORE_EXCEPTIONS:
+            if isinstance(e, httpcore_error):
+                raise httpx_error(str(e)) from e
+        raise
+
+
+class _ResponseStream(httpx.AsyncByteStream):
+    """ httpcore のレスポンス本文を httpx の本文として読ませる。 """
+
+    def __init__(self, stream: Any):
+        self._stream = stream
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        with _httpx_errors():
+            async for part in self._stream:
+                yield part
+
+    async def aclose(self) -> None:
+        await self._stream.aclose()
+
+
+class _VettedTransport(httpx.AsyncBaseTransport):
+    """
+    ネットワーク層に _VettedNetworkBackend を指定して作った httpcore の接続プールで送信するトランスポート。
+    httpx.AsyncHTTPTransport は network_backend を受け取らないため、プールは自前で作る。
+    """
+
+    def __init__(self, allow_private_networks: bool, limits: httpx.Limits):
+        self._pool = httpcore.AsyncConnectionPool(
+            ssl_context=httpx.create_ssl_context(),
+            max_connections=limits.max_connections,
+            max_keepalive_connections=limits.max_keepalive_connections,
+            keepalive_expiry=limits.keepalive_expiry,
+            network_backend=_VettedNetworkBackend(httpcore.AnyIOBackend(), allow_private_networks),
+        )
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        core_request = httpcore.Request(
+            method=request.method,
+            url=httpcore.URL(
+                scheme=request.url.raw_scheme,
+                host=request.url.raw_host,
+                port=request.url.port,
+                target=request.url.raw_path,
+            ),
+            headers=request.headers.raw,
+            content=request.stream,
+            extensions=request.extensions,
+        )
+        with _httpx_errors():
+            core_response = await self._pool.handle_async_request(core_request)
+        return httpx.Response(
+            status_code=core_response.status,
+            headers=core_response.headers,
+            stream=_ResponseStream(core_response.stream),
+            extensions=core_response.extensions,
+        )
+
+    async def aclose(self) -> None:
+        await self._pool.aclose()
+
+
+@dataclass
+class FetchedUrl:
+    """
+    取得結果。not_modified の場合は本文を取得しておらず temp_path は None
+    (sha256 のエントリがアップロードストアにある)。
+    """
+    url: str
+    sha256: str
+    filename: str
+    content_type: Optional[str]
+    size_bytes: int
+    temp_path: Optional[Path]
+    not_modified: bool
+
+
+class UrlFetcher:
+    """ 共有の接続プールで URL を取得し、ETag / Last-Modified による再検証用の情報を保持する。 """
+
+    def __init__(
+        self,
+        temp_dir: Path,
+        cache_path: Path,
+        max_redirects: int = 5,
+        timeout_seconds: float = 30.0,
+        connect_timeout_seconds: float = 10.0,
+        max_connections: int = 20,
+        max_keepalive_connections: int = 10,
+        allow_private_networks: bool = False,
+        cache_entries: int = 1000,
+        cache_flush_delay: float = 1.0,
+        chunk_size: int = 1024 * 1024,
+        user_agent: str = "web-app-dev-url-fetcher/1.0",
+    ):
+        self.temp_dir = temp_dir
+        self.cache_path = cache_path
+        self.max_redirects = max_redirects
+        self.cache_entries = cache_entries
+        self.cache_flush_delay = cache_flush_delay
+        self.chunk_size = chunk_size
+        self._client = httpx.AsyncClient(
+            transport=_VettedTransport(
+                allow_private_networks,
+                limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_keepalive_connections),
+            ),
+            timeout=httpx.Timeout(timeout_seconds, connect=connect_timeout_seconds),
+            follow_redirects=False,
+            headers={"User-Agent": user_agent},
+        )
+        self._cache: "OrderedDict[str, Dict[str, Any]]" = self._load_cache()
+        # 書き込み中の記録より古いスナップショットが後から書かれないよう、書き込みは 1 つずつ行う
+        self._write_lock = asyncio.Lock()
+        self._dirty = False
+        self._flush_task: Optional[asyncio.Task] = None
+        self.cache_writes = 0
+        self.fetched = 0
+        self.revalidated = 0
+        self.failures = 0
+        self.bytes_fetched = 0
+
+    def _load_cache(self) -> "OrderedDict[str, Dict[str, Any]]":
+        try:
+            with open(self.cache_path, "r", encoding="utf-8") as f:
+                return OrderedDict(json.load(f))
+        except FileNotFoundError:
+            return OrderedDict()
+        except (OSError, json.JSONDecodeError) as e:
+            logger.error(f"URL キャッシュを読み込めませんでした。空のキャッシュで開始します ({self.cache_path}): {e}")
+            return OrderedDict()
+
+    def _write_cache(self, snapshot: Dict[str, Dict[str, Any]]) -> None:
+        tmp_path = self.cache_path.with_suffix(".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(snapshot, f, ensure_ascii=False, separators=(",", ":"))
+        os.replace(tmp_path, self.cache_path)
+
+    def _remember(self, url: str, record: Dict[str, Any]) -> None:
+        """ 記録を更新し、cache_flush_delay 秒後の書き込みを予約する。 """
+        self._cache[url] = record
+        self._cache.move_to_end(url)
+        while len(self._cache) > self.cache_entries:
+            self._cache.popitem(last=False)
+        self._dirty = True
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.ensure_future(self._flush_later())
+
+    async def _flush_later(self) -> None:
+        await asyncio.sleep(self.cache_flush_delay)
+        try:
+            await self.flush()
+        except OSError as e:
+            logger.error(f"URL キャッシュを書き込めませんでした ({self.cache_path}): {e}")
+
+    async def flush(self) -> None:
+        """ 未保存の変更があれば記録を書き込む。 """
+        async with self._write_lock:
+            if not self._dirty:
+                return
+            snapshot = dict(self._cache)
+            self._dirty = False
+            try:
+                await asyncio.to_thread(self._write_cache, snapshot)
+            except OSError:
+                self._dirty = True
+                raise
+            self.cache_writes += 1
+
+    @staticmethod
+    def _check_scheme(url: httpx.URL) -> None:
+        if url.scheme not in ("http", "https"):
+            raise UrlFetchError(400, "無効なURL形式です。http:// または https:// で始まる必要があります。")
+
+    async def _send(self, request: httpx.Request) -> httpx.Response:
+        """ リダイレクトを max_redirects 回まで辿り、最終的なレスポンス (本文は未読) を返す。 """
+        for _ in range(self.max_redirects + 1):
+            self._check_scheme(request.url)
+            response = await self._client.send(request, stream=True)
+            if not response.is_redirect or response.next_request is None:
+                return response
+            request = response.next_request
+            await response.aclose()
+        raise UrlFetchError(502, f"リダイレクトが多すぎます (最大 {self.max_redirects} 回)。")
+
+    @staticmethod
+    def _filename(response: httpx.Response, content_type: Optional[str]) -> str:
+        match = CONTENT_DISPOSITION_FILENAME_PATTERN.search(response.headers.get("content-disposition", ""))
+        if match:
+            filename = Path(unquote(match.group(1).strip())).name
+        else:
+            filename = unquote(response.url.path.rstrip("/").rsplit("/", 1)[-1]) or response.url.host
+        if not Path(filename).suffix and content_type:
+            filename += mimetypes.guess_extension(content_type) or ""
+        return filename
+
+    @staticmethod
+    def _content_type(response: httpx.Response) -> Optional[str]:
+        content_type = response.headers.get("content-type", "").split(";")[0].strip().lower()
+        if not content_type or content_type in GENERIC_CONTENT_TYPES:
+            content_type = mimetypes.guess_type(response.url.path)[0] or content_type
+        return content_type or None
+
+    async def fetch(self, url: str, max_bytes: int, allowed_types: List[str], is_stored: Callable[[str], bool], revalidate: bool = True) -> FetchedUrl:
+        """
+        URL を取得する。is_stored(sha256) が真の記録があれば条件付きリクエストで再検証する
+        (revalidate=False の場合は記録があっても本文を取得し直す)。
+        取得先のエラーや上限超過は UrlFetchError として送出する。
+        """
+        cached = self._cache.get(url) if revalidate else None
+        if cached is not None and not is_stored(cached["sha256"]):
+            cached = None
+        headers = {}
+        if cached is not None:
+            if cached.get("etag"):
+                headers["If-None-Match"] = cached["etag"]
+            if cached.get("last_modified"):
+                headers["If-Modified-Since"] = cached["last_modified"]
+
+        try:
+            response = await self._send(self._client.build_request("GET", url, headers=headers))
+        except UrlFetchError:
+            self.failures += 1
+            raise
+        except httpx.InvalidURL as e:
+            raise UrlFetchError(400, f"無効なURLです: {e}")
+        except httpx.TimeoutException:
+            self.failures += 1
+            raise UrlFetchError(504, f"URL の取得がタイムアウトしました: {url}")
+        except httpx.HTTPError as e:
+            self.failures += 1
+            raise UrlFetchError(502, f"URL を取得できませんでした: {type(e).__name__}: {e}")
+
+        try:
+            if response.status_code == 304 and cached is not None:
+                self.revalidated += 1
+                self._remember(url, {**cached, "fetched_at": time.time()})
+                logger.info(f"URL の内容は更新されていません (304): {url}")
+                return FetchedUrl(url, cached["sha256"], cached["filename"], cached["content_type"], cached["size_bytes"], None, True)
+            if response.status_code >= 400:
+                self.failures += 1
+                raise UrlFetchError(502, f"取得先が HTTP {response.status_code} を返しました: {url}")
+            return await self._download(url, response, max_bytes, allowed_types)
+        finally:
+            await response.aclose()
+
+    async def _download(self, url: str, response: httpx.Response, max_bytes: int, allowed_types: List[str]) -> FetchedUrl:
+        content_type = self._content_type(response)
+        if allowed_types and content_type not in allowed_types:
+            logger.warning(f"許可されないファイルタイプの URL です: {url} ({content_type})")
+            raise UrlFetchError(415, f"許可されていないファイルタイプです ({content_type})。許可されているタイプ: {', '.join(allowed_types)}")
+        too_large = f"URL の内容が大きすぎます。最大 {max_bytes // (1024 * 1024)}MB までです。"
+        content_length = response.headers.get("content-length", "")
+        if content_length.isdigit() and int(content_length) > max_bytes:
+            raise UrlFetchError(413, too_large)
+
+        temp_path = self.temp_dir / f".url-{uuid.uuid4().hex}.part"
+        digest = hashlib.sha256()
+        size_bytes = 0
+        try:
+            async with aiofiles.open(temp_path, "wb") as f:
+                async for chunk in response.aiter_bytes(self.chunk_size):
+                    size_bytes += len(chunk)
+                    if size_bytes > max_bytes:
+                        logger.warning(f"URL の内容がサイズ上限を超えたため取得を打ち切りました: {url} (> {max_bytes} bytes)")
+                        raise UrlFetchError(413, too_large)
+                    digest.update(chunk)
+                    await f.write(chunk)
+        except httpx.HTTPError as e:
+            temp_path.unlink(missing_ok=True)
+            self.failures += 1
+            raise UrlFetchError(502, f"URL の取得中に接続が切れました: {type(e).__name__}: {e}")
+        except BaseException:
+            temp_path.unlink(missing_ok=True)
+            raise
+
+        self.fetched += 1
+        self.bytes_fetched += size_bytes
+        fetched = FetchedUrl(str(response.url), digest.hexdigest(), self._filename(response, content_type), content_type, size_bytes, temp_path, False)
+        etag = response.headers.get("etag")
+        last_modified = response.headers.get("last-modified")
+        if etag or last_modified:
+            self._remember(url, {
+                "sha256": fetched.sha256,
+                "filename": fetched.filename,
+                "content_type": fetched.content_type,
+                "size_bytes": fetched.size_bytes,
+                "etag": etag,
+                "last_modified": last_modified,
+                "fetched_at": time.time(),
+            })
+        logger.info(f"URL を取得しました: {url} -> {fetched.filename} ({size_bytes} bytes, {content_type})")
+        return fetched
+
+    async def close(self) -> None:
+        """ 予約済みの書き込みを取り消して未保存の記録をすぐに書き込み、接続プールを閉じる。 """
+        if self._flush_task is not None and not self._flush_task.done():
+            self._flush_task.cancel()
+        self._flush_task = None
+        try:
+            await self.flush()
+        except OSError as e:
+            logger.error(f"URL キャッシュを書き込めませんでした ({self.cache_path}): {e}")
+        await self._client.aclose()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "fetched": self.fetched,
+            "revalidated": self.revalidated,
+            "failures": self.failures,
+            "bytes_fetched": self.bytes_fetched,
+            "cached_urls": len(self._cache),
+            "cache_writes": self.cache_writes,
+        }
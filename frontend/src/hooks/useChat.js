@@ -9,19 +9,89 @@ const initialMessages = [
   { id: uuidv4(), role: 'assistant', content: '本日はどのようなお手伝いをさせていただけますか？' }
 ]; // チャットの初期メッセージ
 
-// --- ヘルパー関数 (Base64エンコード) ---
+// --- ヘルパー関数 ---
 /**
- * FileオブジェクトをBase64エンコードされた文字列として非同期で読み込みます。
- * @param {File} file - 読み込むFileオブジェクト
- * @returns {Promise<string>} Base64エンコードされたファイル内容 (data URL形式)
+ * ファイル内容の SHA-256 を16進文字列で計算します。
+ * crypto.subtle が使えない環境 (非セキュアコンテキストなど) では null を返します。
+ * @param {File} file - 対象のFileオブジェクト
+ * @returns {Promise<string|null>} SHA-256 ハッシュ (16進小文字)
  */
-const encodeFileToBase64 = (file) => {
-  return new Promise((resolve, reject) => {
-    const reader = new FileReader();
-    reader.onload = (e) => resolve(e.target.result); // result は data:image/jpeg;base64,... のような形式
-    reader.onerror = (err) => reject(err);
-    reader.readAsDataURL(file);
+const computeFileSha256 = async (file) => {
+  if (!window.crypto?.subtle) return null;
+  try {
+    const digest = await window.crypto.subtle.digest('SHA-256', await file.arrayBuffer());
+    return Array.from(new Uint8Array(digest), (byte) => byte.toString(16).padStart(2, '0')).join('');
+  } catch (hashError) {
+    console.warn(`Failed to hash ${file.name}:`, hashError);
+    return null;
+  }
+};
+
+/**
+ * テキストファイルを /api/upload/batch に 1 リクエストでまとめてアップロードします。
+ * @param {Array<File>} files - アップロードするFileオブジェクトの配列
+ * @returns {Promise<Array<object>>} ファイルごとの結果 (files と同じ順序。失敗したファイルは error を含む)
+ */
+const uploadTextFiles = async (files) => {
+  if (files.length === 0) return [];
+  const formData = new FormData();
+  // 内容のハッシュを送ると、登録済みのファイルはサーバー側で保存が省略される
+  const hashes = await Promise.all(files.map(computeFileSha256));
+  files.forEach(file => formData.append('files', file));
+  if (hashes.every(Boolean)) {
+    hashes.forEach(hash => formData.append('sha256s', hash));
+  }
+  const uploadResponse = await fetch(`${BACKEND_URL}/api/upload/batch`, {
+    method: 'POST',
+    body: formData,
   });
+  if (!uploadResponse.ok) {
+    const errorData = await uploadResponse.json().catch(() => ({ detail: `ファイルアップロードエラー: ${uploadResponse.status}` }));
+    throw new Error(errorData.detail || 'ファイルのアップロードに失敗しました。');
+  }
+  const { results } = await uploadResponse.json();
+  return results;
+};
+
+/**
+ * text/event-stream 形式のレスポンスを読み込み、イベントごとにコールバックを呼び出します。
+ * @param {Response} response - fetch のレスポンス
+ * @param {(event: string, data: object) => void} onEvent - イベント受信時のコールバック
+ * @returns {Promise<void>}
+ */
+const readEventStream = async (response, onEvent) => {
+  const reader = response.body.getReader();
+  const decoder = new TextDecoder();
+  let buffer = '';
+
+  const dispatch = (rawEvent) => {
+    let eventName = 'message';
+    const dataLines = [];
+    rawEvent.split('\n').forEach(line => {
+      if (line.startsWith('event:')) {
+        eventName = line.slice(6).trim();
+      } else if (line.startsWith('data:')) {
+        dataLines.push(line.slice(5).trimStart());
+      }
+    });
+    if (dataLines.length > 0) {
+      onEvent(eventName, JSON.parse(dataLines.join('\n')));
+    }
+  };
+
+  while (true) {
+    const { done, value } = await reader.read();
+    if (done) break;
+    buffer += decoder.decode(value, { stream: true });
+    let separatorIndex;
+    while ((separatorIndex = buffer.indexOf('\n\n')) !== -1) {
+      dispatch(buffer.slice(0, separatorIndex));
+      buffer = buffer.slice(separatorIndex + 2);
+    }
+  }
+  if (buffer.trim()) {
+    dispatch(buffer);
+  }
 };
 
 // --- メインフック ---
@@ -35,6 +105,8 @@ const useChat = () => {
   const [availableModels, setAvailableModels] = useState([]); // 利用可能なモデルIDリスト
   const [selectedModel, setSelectedModel] = useState(''); // 選択中のモデルID
   const [isModelsLoading, setIsModelsLoading] = useState(true); // モデルリスト取得中のローディング状態
+  const sessionIdRef = useRef(uuidv4()); // サーバー側チャットセッションID
+  const historyHashRef = useRef(null); // サーバーが保持している履歴のハッシュ (null の場合は履歴全体を送信)
 
   // --- Effect ---
   // 自動スクロール無効化
@@ -83,7 +155,7 @@ const useChat = () => {
    * テキスト入力とアップロードされたファイル情報からユーザー表示用コンテンツ文字列を構築します。
    * API送信用のメッセージは prepareApiMessages で別途構築されます。
    * @param {string} textInput - 現在のテキスト入力値
-   * @param {Array<{filename: string, type: 'text' | 'image', saved_path?: string, groq_file_id?: string, base64_content?: string}>} processedFileInfos - 処理されたファイル情報
+   * @param {Array<{filename: string, type: 'text' | 'image', upload_id?: string, saved_path?: string, groq_file_id?: string, file?: File, part?: string}>} processedFileInfos - 処理されたファイル情報
    * @returns {string} ユーザー表示用コンテンツ文字列
    */
   const buildUserDisplayContent = (textInput, processedFileInfos) => {
@@ -131,7 +203,7 @@ const useChat = () => {
    * @param {Array<object>} allMessages - 全てのメッセージ履歴
    * @param {object|null} currentUserTextMessage - 今回のユーザーテキストメッセージオブジェクト
    * @param {string} textInput - ユーザーのテキスト入力
-   * @param {Array<{filename: string, type: 'text' | 'image', saved_path?: string, groq_file_id?: string, base64_content?: string}>} processedFileInfos - 処理されたファイル情報
+   * @param {Array<{filename: string, type: 'text' | 'image', upload_id?: string, saved_path?: string, groq_file_id?: string, file?: File, part?: string}>} processedFileInfos - 処理されたファイル情報
    * @returns {Array<object>} API送信用に整形されたメッセージ配列
    */
   const prepareApiMessages = (allMessages, currentUserTextMessage, textInput, processedFileInfos) => {
@@ -161,11 +233,14 @@ const useChat = () => {
     }
 
     processedFileInfos.forEach(info => {
-        if (info.type === 'image' && info.base64_content) {
+        if (info.type === 'image' && info.part) {
             currentMessageContent.push({
                 type: "image_url",
-                image_url: { "url": info.base64_content } // base64_content は data URL 形式
+                image_url: { "part": info.part } // 同じリクエストの multipart パート名で画像を参照
             });
+        } else if (info.type === 'text' && info.upload_id) {
+            // アップロード済みファイルは添付 ID で参照し、サーバーが上流へ送る直前に内容へ展開する
+            currentMessageContent.push({ type: "attachment", attachment_id: info.upload_id });
         } else if (info.type === 'text' && info.groq_file_id) {
             // テキストファイルの場合、Groq File ID をテキストとして含めるか、
             // バックエンドでファイル内容を取得して結合するかはバックエンドの実装による。
@@ -247,8 +322,11 @@ const useChat = () => {
     try {
       const processedFileInfos = [];
 
-      // 1. ファイルの前処理 (テキストはアップロード、画像はBase64エンコード)
+      // 1. ファイルの前処理 (テキストはまとめてアップロード、画像はBase64エンコード)
       if (validFilesToProcess.length > 0) {
+        const textFiles = validFilesToProcess.filter(fileData => !fileData.file?.type?.startsWith('image/') && fileData.type === 'text');
+        const uploadResultsPromise = uploadTextFiles(textFiles.map(fileData => fileData.file));
+
         const fileProcessingPromises = validFilesToProcess.map(async (fileData) => {
           if (fileData.file?.type?.startsWith('image/')) {
             // 画像ファイルの場合
@@ -256,29 +334,17 @@ const useChat = () => {
               setError(`画像ファイル '${fileData.file.name}' が大きすぎます (最大4MB)。`);
               return null;
             }
-            try {
-              const base64_content = await encodeFileToBase64(fileData.file);
-              return { filename: fileData.file.name, type: 'image', base64_content };
-            } catch (encodeError) {
-              console.error(`Error encoding image ${fileData.file.name}:`, encodeError);
-              setError(`画像 '${fileData.file.name}' の処理中にエラーが発生しました。`);
-              return null;
-            }
+            // 画像はバイナリのまま multipart で送信し、base64 化はサーバー側で行う
+            return { filename: fileData.file.name, type: 'image', file: fileData.file };
           } else if (fileData.type === 'text') {
-            // テキストファイルの場合 (従来通りバックエンドにアップロード)
-            const formData = new FormData();
-            formData.append('file', fileData.file);
+            // テキストファイルの場合 (一括アップロードの結果からこのファイルの分を取り出す)
             try {
-              const uploadResponse = await fetch(`${BACKEND_URL}/api/upload`, {
-                method: 'POST',
-                body: formData,
-              });
-              if (!uploadResponse.ok) {
-                const errorData = await uploadResponse.json().catch(() => ({ detail: `ファイルアップロードエラー: ${uploadResponse.status}` }));
-                throw new Error(errorData.detail || `ファイル '${fileData.file.name}' のアップロードに失敗しました。`);
+              const uploadResults = await uploadResultsPromise;
+              const result = uploadResults[textFiles.indexOf(fileData)];
+              if (result.error) {
+                throw new Error(result.error);
               }
-              const result = await uploadResponse.json();
-              return { filename: result.filename, type: 'text', saved_path: result.saved_path, groq_file_id: result.groq_file_id };
+              return { filename: result.filename, type: 'text', upload_id: result.upload_id, saved_path: result.saved_path, groq_file_id: result.groq_file_id };
             } catch (uploadError) {
               console.error(`Error uploading ${fileData.file.name}:`, uploadError);
               setError(`ファイル '${fileData.file.name}' のアップロード中にエラー: ${uploadError.message}`);
@@ -291,6 +357,9 @@ const useChat = () => {
         const results = await Promise.all(fileProcessingPromises);
         results.forEach(result => {
           if (result) {
+            if (result.type === 'image') {
+              result.part = `image-${processedFileInfos.filter(info => info.type === 'image').length}`; // multipart のパート名
+            }
             processedFileInfos.push(result);
           }
         });
@@ -327,22 +396,46 @@ const useChat = () => {
       }
 
       // 5. API呼び出し & 応答処理
-      const requestBody = {
-        messages: messagesForApi,
-        purpose: 'main_chat',
-        model_name: selectedModel,
+      // サーバーが履歴を保持している場合は今回のメッセージのみ送信する
+      const postChat = (historyHash) => {
+        const requestBody = {
+          messages: historyHash ? messagesForApi.slice(-1) : messagesForApi,
+          purpose: 'main_chat',
+          model_name: selectedModel,
+          session_id: sessionIdRef.current,
+          history_hash: historyHash,
+        };
+
+        if (process.env.NODE_ENV === 'development') {
+          console.log("Sending to API:", JSON.stringify(requestBody, null, 2));
+        }
+
+        const imageInfos = processedFileInfos.filter(info => info.type === 'image' && info.part);
+        if (imageInfos.length > 0) {
+          // 画像を含む場合は multipart で送信し、画像はパート名で参照する
+          const formData = new FormData();
+          formData.append('request', JSON.stringify(requestBody));
+          imageInfos.forEach(info => formData.append(info.part, info.file, info.filename));
+          return fetch(`${BACKEND_URL}/api/chat/multipart`, { method: 'POST', body: formData });
+        }
+
+        return fetch(`${BACKEND_URL}/api/chat`, {
+          method: 'POST',
+          headers: { 'Content-Type': 'application/json' },
+          body: JSON.stringify(requestBody),
+        });
       };
 
-      if (process.env.NODE_ENV === 'development') {
-        console.log("Sending to API:", JSON.stringify(requestBody, null, 2));
+      let response = await postChat(historyHashRef.current);
+      if (response.status === 409) {
+        // サーバー側の履歴と一致しない場合は履歴全体を再送信して再同期する
+        const conflict = await response.json().catch(() => null);
+        if (conflict?.resync) {
+          historyHashRef.current = null;
+          response = await postChat(null);
+        }
       }
 
-      const response = await fetch(`${BACKEND_URL}/api/chat`, {
-        method: 'POST',
-        headers: { 'Content-Type': 'application/json' },
-        body: JSON.stringify(requestBody),
-      });
-
       if (!response.ok) {
         let errorDetail = `HTTP error! status: ${response.status}`;
         let errorData = null;
@@ -369,7 +462,61 @@ const useChat = () => {
       }
 
       // 6. API成功時のUI更新 (アシスタントの応答を追加)
+      if (response.headers.get('Content-Type')?.includes('text/event-stream')) {
+        // ストリーミング応答: 空のアシスタントメッセージを追加し、イベント受信ごとに更新する
+        const assistantMessageId = uuidv4();
+        setMessages(prev => [
+          ...prev,
+          { id: assistantMessageId, role: 'assistant', content: '', reasoning: null, tool_calls: [], executed_tools: [] },
+        ]);
+        const updateAssistantMessage = (updater) => {
+          setMessages(prev => prev.map(msg => msg.id === assistantMessageId ? updater(msg) : msg));
+        };
+
+        await readEventStream(response, (event, payload) => {
+          switch (event) {
+            case 'content':
+              updateAssistantMessage(msg => ({ ...msg, content: msg.content + payload.delta }));
+              break;
+            case 'reasoning':
+              updateAssistantMessage(msg => ({ ...msg, reasoning: (msg.reasoning || '') + payload.delta }));
+              break;
+            case 'tool_call':
+              updateAssistantMessage(msg => {
+                const toolCalls = [...msg.tool_calls];
+                const current = toolCalls[payload.index] || { type: 'function', function: { name: '', arguments: '' } };
+                toolCalls[payload.index] = {
+                  ...current,
+                  function: {
+                    name: current.function.name + (payload.function?.name || ''),
+                    arguments: current.function.arguments + (payload.function?.arguments || ''),
+                  },
+                };
+                return { ...msg, tool_calls: toolCalls };
+              });
+              break;
+            case 'executed_tool':
+              updateAssistantMessage(msg => ({ ...msg, executed_tools: [...msg.executed_tools, payload] }));
+              break;
+            case 'usage':
+              if (process.env.NODE_ENV === 'development') {
+                console.log("Usage:", payload);
+              }
+              break;
+            case 'session':
+              historyHashRef.current = payload.history_hash || null;
+              break;
+            case 'error':
+              throw new Error(payload.detail);
+            default:
+              break;
+          }
+        });
+        return;
+      }
+
       const data = await response.json();
+      historyHashRef.current = data.history_hash || null;
       setMessages(prev => [
         ...prev,
         {
@@ -384,6 +531,9 @@ const useChat = () => {
 
     } catch (err) {
       // 7. APIエラー時の処理 (エラー表示、UIロールバックの一部)
+      // サーバーが今回のターンを履歴に加えたか分からないため、次回は履歴全体を送信して再同期する
+      // (ハッシュを残すと次回は最後のメッセージしか送らず、失敗したターンのユーザーメッセージが失われる)
+      historyHashRef.current = null;
       handleApiError(err, setError, setMessages, newUserTextMessage);
       // エラー発生時は入力欄の内容を戻さない（ユーザーが再編集できるように）
       // ファイルのプレビューもクリアしない（ユーザーが再試行できるように）
@@ -401,6 +551,8 @@ const useChat = () => {
         console.log('useChat: handleClearChat called');
     }
     setMessages(initialMessages); // 初期メッセージの状態に戻す
+    sessionIdRef.current = uuidv4(); // 新しいサーバー側セッションを開始
+    historyHashRef.current = null;
     setError(null);
     setIsLoading(false);
     setInput('');